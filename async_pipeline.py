@@ -0,0 +1,214 @@
+"""
+This module handles ingesting the dataset with an asyncio pipeline, so downloading and decoding pages, classifying and
+writing to sqlite all happen at the same time instead of one after the other.
+The stages are joined by bounded queues, so a fast stage waits for a slow one once its queue is full and memory stays
+bounded to a few pages. The blocking work of each stage runs on a thread, and every sqlite write happens on a single
+dedicated writer thread with its own connection. The whole ingest takes about as long as its slowest stage.
+"""
+from database_functions import *
+from dataset_fetcher import create_pooled_session, _create_page_params, _download_page, NASA_METEORITE_URL
+from run_metrics import stage_timer, increment_counter
+from region_aggregates import AggregateDelta
+import asyncio
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Put on the writer queue once every page has been queued, the writer commits when it reads it.
+_END_OF_PAGES = object()
+# Put on the writer queue when the pipeline fails, the writer rolls back when it reads it.
+_ABORT_WRITE = object()
+
+
+def _abandon_write(db_connection, write_queue, write_failed):
+    """ This function is called when the writer thread fails. It rolls back the writer's transaction, sets
+        write_failed and reads and throws away the rest of the writer queue until the pipeline ends or aborts,
+        so the classification stage is never stuck waiting on a full queue. """
+    if db_connection is not None and db_connection.in_transaction:
+        db_connection.rollback()
+    write_failed.set()
+    while write_queue.get() not in (_END_OF_PAGES, _ABORT_WRITE):
+        pass
+
+
+def _write_region_rows(write_queue, region_names, write_failed, stage_seconds):
+    """ This function runs on the writer thread. It opens its own database connection, recreates the region tables
+        and inserts each dictionary of region rows taken from the writer queue, updating the region summaries
+        after each page, all inside one transaction.
+        The transaction is committed when _END_OF_PAGES is read, or rolled back when _ABORT_WRITE is read.
+        If anything fails, including opening the connection, the write is abandoned with _abandon_write. A sqlite
+        error is printed and 0 is returned, any other error is raised again once the queue has been drained.
+        It returns the rows inserted. """
+    db_connection = None
+    db_cursor_obj = None
+    aggregate_delta = AggregateDelta()
+    rows_inserted = 0
+    try:
+        db_connection = connect_to_database()
+        db_cursor_obj = create_cursor_obj(db_connection)
+        # The DELETEs of create_all_region_tables start the transaction, so the tables are cleared and refilled
+        # together.
+        create_all_region_tables(db_cursor_obj, region_names)
+        if not db_connection.in_transaction:
+            db_cursor_obj.execute('BEGIN')
+        while True:
+            region_rows = write_queue.get()
+            if region_rows is _END_OF_PAGES:
+                with stage_timer('commit'):
+                    db_connection.commit()
+                return rows_inserted
+            if region_rows is _ABORT_WRITE:
+                db_connection.rollback()
+                return 0
+            start_time = time.perf_counter()
+            with stage_timer('insert'):
+                for table_name, rows in region_rows.items():
+                    if rows:
+                        db_cursor_obj.executemany(f'''INSERT INTO {table_name}(name, mass, reclat, reclong)
+                                                      VALUES(?, ?, ?, ?)''', rows)
+                        rows_inserted += len(rows)
+                        aggregate_delta.add_rows(table_name, rows)
+                        increment_counter(f'rows_inserted.{table_name}', len(rows))
+                aggregate_delta.apply(db_cursor_obj)
+            stage_seconds['write'] += time.perf_counter() - start_time
+    except sqlite3.Error as db_error:
+        # If any sqlite exceptions occur, undo the partial ingest and print the error in a formatted message.
+        _abandon_write(db_connection, write_queue, write_failed)
+        print(f'A database error has occurred: {db_error}')
+        return 0
+    except BaseException:
+        # Anything else, such as connect_to_database returning None, is raised once the queue is drained.
+        _abandon_write(db_connection, write_queue, write_failed)
+        raise
+    finally:
+        if db_cursor_obj is not None:
+            close_database(db_connection, db_cursor_obj)
+        elif db_connection is not None:
+            db_connection.close()
+
+
+async def _timed_to_thread(stage_seconds, stage_name, blocking_function, *args):
+    """ This function runs a blocking function on a thread and adds the time it took to the stage's total. """
+    start_time = time.perf_counter()
+    function_result = await asyncio.to_thread(blocking_function, *args)
+    stage_seconds[stage_name] += time.perf_counter() - start_time
+    return function_result
+
+
+async def _fetch_pages(dataset_url, page_size, order_by, fetch_concurrency, max_retries, backoff_base, timeout,
+                       response_cache, records_queue, stage_seconds):
+    """ This function is the download stage. It keeps fetch_concurrency pages downloading at a time with a pooled
+        session. Each page goes through _download_page of dataset_fetcher, so transient errors are retried with
+        backoff the same way as the default ingest, and is decoded to its list of records. The lists are put on the
+        records queue in offset order, up to the first page with fewer than page_size records, followed by None.
+        A PageDownloadError is raised for a page that still fails after its retries. """
+    session = create_pooled_session(fetch_concurrency)
+    # The tasks of the pages downloading, kept in offset order.
+    pending_pages = collections.deque()
+    next_offset = 0
+    dataset_ended = False
+    try:
+        while not dataset_ended:
+            while len(pending_pages) < fetch_concurrency:
+                pending_pages.append(asyncio.create_task(_timed_to_thread(
+                    stage_seconds, 'download', _download_page, session, dataset_url,
+                    _create_page_params(page_size, next_offset, order_by), max_retries, backoff_base, timeout,
+                    response_cache)))
+                next_offset += page_size
+            page_records = await pending_pages.popleft()
+            await records_queue.put(page_records)
+            # A short page means the end of the dataset was reached, the pages after it are past the end.
+            dataset_ended = len(page_records) < page_size
+        await records_queue.put(None)
+    finally:
+        for page_task in pending_pages:
+            page_task.cancel()
+        session.close()
+
+
+async def _run_stages(stage_coroutines):
+    """ This function runs the stage coroutines as tasks until they all finish. If one of them fails the others
+        are cancelled and waited on, then the error of the failed stage is raised. """
+    stage_tasks = [asyncio.create_task(stage_coroutine) for stage_coroutine in stage_coroutines]
+    try:
+        await asyncio.gather(*stage_tasks)
+    except BaseException:
+        for stage_task in stage_tasks:
+            stage_task.cancel()
+        await asyncio.gather(*stage_tasks, return_exceptions=True)
+        raise
+
+
+async def _classify_pages(region_classifier, records_queue, write_queue, write_failed, stage_seconds):
+    """ This function is the classification stage. It groups the records of each page into rows per region and
+        hands them to the writer thread through its bounded queue, waiting while that queue is full. """
+    while True:
+        page_records = await records_queue.get()
+        if page_records is None:
+            break
+        region_rows = await _timed_to_thread(stage_seconds, 'classify', group_rows_by_region, page_records,
+                                             region_classifier)
+        if write_failed.is_set():
+            raise sqlite3.Error('the writer thread stopped after an error')
+        await asyncio.to_thread(write_queue.put, region_rows)
+
+
+async def ingest_dataset_pipelined(dataset_url=NASA_METEORITE_URL, page_size=5000, order_by=':id',
+                                   fetch_concurrency=4, queue_size=4, max_retries=4, backoff_base=0.5, timeout=30,
+                                   response_cache=None, region_classifier=None):
+    """ This function downloads the dataset at the specified URL and replaces the contents of the region tables
+        with its meteors, running the download (with JSON decoding), classification and write stages at the same
+        time. Each queue between two stages holds at most queue_size pages. Failed page downloads are retried up
+        to max_retries times with backoff, like fetch_meteorite_records_concurrently. The writer thread opens its
+        own connection with connect_to_database and commits once every page is written. If a page still fails to
+        download the write is rolled back and a PageDownloadError is raised. The function prints and returns the
+        number of rows inserted per second, along with how long each stage was busy (the download time is summed
+        over the pages downloading at once). """
+    if page_size < 1:
+        raise ValueError('page_size must be at least 1')
+    if fetch_concurrency < 1 or queue_size < 1:
+        raise ValueError('fetch_concurrency and queue_size must be at least 1')
+    if region_classifier is None:
+        region_classifier = create_region_classifier()
+    records_queue = asyncio.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    write_failed = threading.Event()
+    stage_seconds = {'download': 0.0, 'classify': 0.0, 'write': 0.0}
+    start_time = time.perf_counter()
+    writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite_writer')
+    writer_future = asyncio.get_running_loop().run_in_executor(writer_executor, _write_region_rows, write_queue,
+                                                               region_classifier.region_names, write_failed,
+                                                               stage_seconds)
+    try:
+        await _run_stages([_fetch_pages(dataset_url, page_size, order_by, fetch_concurrency, max_retries,
+                                        backoff_base, timeout, response_cache, records_queue, stage_seconds),
+                           _classify_pages(region_classifier, records_queue, write_queue, write_failed,
+                                           stage_seconds)])
+        await asyncio.to_thread(write_queue.put, _END_OF_PAGES)
+    except BaseException:
+        # Roll back the writer's transaction, the region tables are left as they were before the ingest started.
+        await asyncio.to_thread(write_queue.put, _ABORT_WRITE)
+        # If the writer failed with anything but a database error, its error is raised here.
+        await writer_future
+        if write_failed.is_set():
+            # The writer has already printed the database error.
+            return 0.0
+        raise
+    finally:
+        writer_executor.shutdown(wait=False)
+    rows_inserted = await writer_future
+    elapsed_seconds = time.perf_counter() - start_time
+    rows_per_second = rows_inserted / elapsed_seconds if elapsed_seconds > 0 else 0.0
+    print(f'Pipelined ingest inserted {rows_inserted} rows in {elapsed_seconds:.3f} seconds '
+          f'({rows_per_second:.0f} rows per second).')
+    print('Time each stage was busy: ' +
+          ', '.join(f'{stage_name} {busy_seconds:.3f}s' for stage_name, busy_seconds in stage_seconds.items()))
+    return rows_per_second
+
+
+def run_ingest_pipeline(dataset_url=NASA_METEORITE_URL, **pipeline_options):
+    """ This function runs ingest_dataset_pipelined in a new event loop and returns its rows per second,
+        so it can be called from code that isn't async. """
+    return asyncio.run(ingest_dataset_pipelined(dataset_url, **pipeline_options))
@@ -0,0 +1,265 @@
+"""
+This module benchmarks each stage of the ingest on synthetic data shaped like the NASA gh4g-9sfh records.
+The records are generated deterministically from a seed, with string reclat, reclong and mass values, missing fields
+and points that fall outside of every region. For each dataset size the pages are served by a local stub server and
+ingested with the same fetch and ingest functions as main.py (or the scalar one record at a time ingest), and the
+http_get, json_decode, numeric_conversion, classification, insert and commit stage times are read from run_metrics.
+The results are written as JSON with the throughput of each stage and the peak RSS, so runs can be compared over time.
+Run it with "python benchmark_ingest.py --sizes 1000 100000 10000000".
+"""
+from database_functions import *
+from dataset_fetcher import fetch_meteorite_records_concurrently
+from run_metrics import start_run_metrics, finish_run_metrics, stage_timer
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import contextlib
+import http.server
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import urllib.parse
+
+try:
+    import resource
+except ImportError:
+    # The resource module doesn't exist on Windows, so the peak RSS can't be measured there.
+    resource = None
+
+# The records are generated in blocks with their own seed, so record N is the same whichever page it is read in.
+GENERATOR_BLOCK_SIZE = 1000
+DEFAULT_BENCHMARK_SIZES = (1000, 10000, 100000, 1000000)
+# The run_metrics stage timers read for each size. The classification timer includes the numeric conversion, which
+# is taken out of it so every stage is reported on its own.
+BENCHMARK_STAGES = ('http_get', 'json_decode', 'numeric_conversion', 'classification', 'insert', 'commit')
+# vectorized benchmarks the ingest of main.py, scalar benchmarks add_meteorites_to_tables, one INSERT per row.
+INGEST_PATHS = ('vectorized', 'scalar')
+
+_RECORD_CLASSES = ('L6', 'H5', 'L5', 'H6', 'H4', 'LL5', 'LL6', 'L4', 'H4/5', 'CM2', 'Iron, IIIAB', 'Eucrite-pmict')
+
+
+def _generate_coordinates(random_obj, region_boxes):
+    """ This function returns the (reclat, reclong) strings of a synthetic record, or None if it has no coordinates.
+        About 16% of the records have no coordinates and 6% are at 0, 0 like the NASA dataset. Of the rest, most
+        fall inside a random region and the others anywhere on the globe, which is often outside of every region. """
+    coordinate_kind = random_obj.random()
+    if coordinate_kind < 0.16:
+        return None
+    if coordinate_kind < 0.22:
+        return '0.000000', '0.000000'
+    if coordinate_kind < 0.82:
+        left, bottom, right, top = random_obj.choice(region_boxes)
+        lat_value = random_obj.uniform(bottom, top)
+        long_value = random_obj.uniform(left, right)
+    else:
+        lat_value = random_obj.uniform(-90, 90)
+        long_value = random_obj.uniform(-180, 180)
+    return f'{lat_value:.6f}', f'{long_value:.6f}'
+
+
+def _generate_record(random_obj, record_index, region_boxes):
+    """ This function returns one synthetic record with the fields of the NASA dataset. Like the real records every
+        value is a string, and the mass, year and coordinates are sometimes missing. """
+    record = {
+        'name': f'Synthetic {record_index}',
+        'id': str(record_index + 1),
+        'nametype': 'Valid' if random_obj.random() < 0.99 else 'Relict',
+        'recclass': random_obj.choice(_RECORD_CLASSES)
+    }
+    if random_obj.random() < 0.97:
+        # Masses are spread over many orders of magnitude, from a fraction of a gram to tonnes.
+        record['mass'] = f'{10 ** random_obj.uniform(-1, 7):.{random_obj.randint(0, 2)}f}'
+    record['fall'] = 'Fell' if random_obj.random() < 0.03 else 'Found'
+    if random_obj.random() < 0.99:
+        record['year'] = f'{random_obj.randint(1800, 2013)}-01-01T00:00:00.000'
+    coordinates = _generate_coordinates(random_obj, region_boxes)
+    if coordinates is not None:
+        record['reclat'], record['reclong'] = coordinates
+        record['geolocation'] = {'type': 'Point', 'coordinates': [float(coordinates[1]), float(coordinates[0])]}
+    return record
+
+
+def generate_meteorite_records(row_count, seed=0, start_index=0):
+    """ This function is a generator that yields row_count synthetic records starting at record start_index.
+        The same seed always yields the same records, and record N is the same no matter where reading starts. """
+    # The segments of a region that crosses the antimeridian are already split into boxes within -180 to 180.
+    region_boxes = [segment[1:] for segment in create_region_classifier().region_segments]
+    end_index = start_index + row_count
+    record_index = start_index
+    while record_index < end_index:
+        block_index = record_index // GENERATOR_BLOCK_SIZE
+        # A string seed is hashed the same way on every run, unlike a tuple.
+        random_obj = random.Random(f'{seed}:{block_index}')
+        block_start = block_index * GENERATOR_BLOCK_SIZE
+        for block_record_index in range(block_start, min(block_start + GENERATOR_BLOCK_SIZE, end_index)):
+            # Records before start_index still have to be generated to keep the random sequence the same.
+            record = _generate_record(random_obj, block_record_index, region_boxes)
+            if block_record_index >= record_index:
+                yield record
+        record_index = min(block_start + GENERATOR_BLOCK_SIZE, end_index)
+
+
+def _write_page_files(page_dir, row_count, page_size, seed):
+    """ This function writes each page of the synthetic dataset to a JSON file named after its offset,
+        so the stub server only has to send files and generating the records isn't timed as part of the fetch. """
+    record_iterator = generate_meteorite_records(row_count, seed)
+    for page_offset in range(0, row_count, page_size):
+        page_records = [record for _, record in zip(range(page_size), record_iterator)]
+        with open(os.path.join(page_dir, f'{page_offset}.json'), 'w', encoding='utf-8') as page_file:
+            json.dump(page_records, page_file)
+
+
+def _serve_page_files(page_dir, port_queue):
+    """ This function runs in the stub server process. It answers GET requests with the page file matching the
+        $offset query parameter, or an empty list past the end of the dataset, like the Socrata endpoint. """
+
+    class _PageRequestHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            query_params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            page_path = os.path.join(page_dir, f'{int(query_params.get("$offset", ["0"])[0])}.json')
+            try:
+                with open(page_path, 'rb') as page_file:
+                    page_bytes = page_file.read()
+            except FileNotFoundError:
+                page_bytes = b'[]'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(page_bytes)))
+            self.end_headers()
+            self.wfile.write(page_bytes)
+
+        def log_message(self, *args):
+            pass
+
+    stub_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _PageRequestHandler)
+    port_queue.put(stub_server.server_port)
+    stub_server.serve_forever()
+
+
+def _get_peak_rss_bytes():
+    """ This function returns the peak resident set size of the process in bytes, or None if it can't be read. """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports the peak in kilobytes and macOS in bytes.
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def _run_stage_benchmark(row_count, page_size, seed, ingest_path):
+    """ This function runs in a fresh process for each dataset size, so the peak RSS belongs to that size only.
+        It serves the synthetic pages from a stub server and ingests them with the same functions as main.py:
+        fetch_meteorite_records_concurrently downloads and decodes the pages, and add_meteorites_to_tables_vectorized
+        classifies each page with group_rows_by_region and writes its rows with _flush_region_buffer. With the scalar
+        ingest path the records are ingested one at a time with add_meteorites_to_tables instead.
+        The time of each stage is read from the stage timers of run_metrics and the record counts from its counters.
+        It returns the result dictionary of that size. """
+    with tempfile.TemporaryDirectory(prefix='meteorite_benchmark_') as work_dir:
+        page_dir = os.path.join(work_dir, 'pages')
+        os.mkdir(page_dir)
+        _write_page_files(page_dir, row_count, page_size, seed)
+        port_queue = multiprocessing.Queue()
+        server_process = multiprocessing.Process(target=_serve_page_files, args=(page_dir, port_queue), daemon=True)
+        server_process.start()
+        dataset_url = f'http://127.0.0.1:{port_queue.get()}/resource/gh4g-9sfh.json'
+        try:
+            # The ingest functions print a line for every page, which would be timed along with them.
+            with open(os.devnull, 'w') as null_output, contextlib.redirect_stdout(null_output):
+                db_connection = connect_to_database(os.path.join(work_dir, 'benchmark.db'))
+                db_cursor_obj = create_cursor_obj(db_connection)
+                create_all_region_tables(db_cursor_obj)
+                db_connection.commit()
+                start_run_metrics()
+                start_time = time.perf_counter()
+                # One page is downloaded ahead of the page being ingested.
+                record_iterator = fetch_meteorite_records_concurrently(dataset_url, page_size, max_workers=1)
+                if ingest_path == 'scalar':
+                    add_meteorites_to_tables(db_cursor_obj, record_iterator)
+                    with stage_timer('commit'):
+                        db_connection.commit()
+                else:
+                    # Each page is classified as one batch.
+                    add_meteorites_to_tables_vectorized(db_connection, db_cursor_obj, record_iterator,
+                                                        batch_size=page_size)
+                total_seconds = time.perf_counter() - start_time
+                run_report = finish_run_metrics()
+                close_database(db_connection, db_cursor_obj)
+        finally:
+            server_process.terminate()
+            server_process.join()
+    records_seen = run_report['counters'].get('records_seen', 0)
+    rows_inserted = sum(amount for counter_name, amount in run_report['counters'].items()
+                        if counter_name.startswith('rows_inserted.'))
+    stage_seconds = {stage_name: run_report['stages'].get(stage_name, {}).get('seconds', 0.0)
+                     for stage_name in BENCHMARK_STAGES}
+    stage_seconds['classification'] = max(stage_seconds['classification'] - stage_seconds['numeric_conversion'], 0.0)
+    return {
+        'row_count': row_count,
+        'ingest_path': ingest_path,
+        'records_seen': records_seen,
+        'rows_inserted': rows_inserted,
+        'total_seconds': total_seconds,
+        'records_per_second': records_seen / total_seconds if total_seconds > 0 else None,
+        'peak_rss_bytes': _get_peak_rss_bytes(),
+        'stages': {stage_name: {'seconds': busy_seconds,
+                                'records_per_second': records_seen / busy_seconds if busy_seconds > 0 else None}
+                   for stage_name, busy_seconds in stage_seconds.items()}
+    }
+
+
+def run_ingest_benchmarks(row_counts=DEFAULT_BENCHMARK_SIZES, page_size=5000, seed=0, ingest_path='vectorized'):
+    """ This function benchmarks the ingest stages for each dataset size in row_counts and returns a report
+        dictionary holding the settings, the platform and the result of each size. Every size runs in its
+        own process, one after the other. ingest_path is one of INGEST_PATHS. """
+    if page_size < 1:
+        raise ValueError('page_size must be at least 1')
+    if ingest_path not in INGEST_PATHS:
+        raise ValueError(f'ingest_path must be one of {", ".join(INGEST_PATHS)}')
+    size_results = []
+    for row_count in row_counts:
+        if row_count < 1:
+            raise ValueError('every dataset size must be at least 1')
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            size_results.append(executor.submit(_run_stage_benchmark, row_count, page_size, seed,
+                                                ingest_path).result())
+        print(f'Benchmarked {row_count} records in {size_results[-1]["total_seconds"]:.3f} seconds.')
+    return {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python_version': platform.python_version(),
+        'sqlite_version': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'page_size': page_size,
+        'seed': seed,
+        'ingest_path': ingest_path,
+        'results': size_results
+    }
+
+
+def main():
+    """ This function runs the ingest benchmarks and writes the report to a JSON file. """
+    argument_parser = argparse.ArgumentParser(description='Benchmark each ingest stage on synthetic NASA records.')
+    argument_parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_BENCHMARK_SIZES),
+                                 help='number of records in each benchmarked dataset, such as 1000 or 10000000')
+    argument_parser.add_argument('--page-size', type=int, default=5000, help='number of records per fetched page')
+    argument_parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic record generator')
+    argument_parser.add_argument('--ingest-path', choices=INGEST_PATHS, default='vectorized',
+                                 help='vectorized benchmarks the batched NumPy ingest used by main.py, scalar the '
+                                      'ingest that classifies and inserts one record at a time')
+    argument_parser.add_argument('--output', default=f'ingest_benchmark_{time.strftime("%Y%m%d_%H%M%S")}.json',
+                                 help='JSON file the results are written to')
+    arguments = argument_parser.parse_args()
+    benchmark_report = run_ingest_benchmarks(arguments.sizes, arguments.page_size, arguments.seed,
+                                             arguments.ingest_path)
+    with open(arguments.output, 'w', encoding='utf-8') as output_file:
+        json.dump(benchmark_report, output_file, indent=4)
+    print(f'Benchmark results written to {arguments.output}.')
+
+
+if __name__ == '__main__':
+    main()
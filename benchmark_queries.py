@@ -0,0 +1,108 @@
+"""
+This module benchmarks the queries in meteorite_queries against full table scans that answer the same questions.
+It needs a database built with the normalized schema, run it with "python benchmark_queries.py".
+"""
+from database_functions import connect_to_database
+from meteorite_queries import *
+import argparse
+import heapq
+import json
+import time
+
+# A few query points spread over the regions, plus one next to the antimeridian.
+BENCHMARK_POINTS = ((48.85, 2.35), (-33.87, 151.21), (40.71, -74.01), (-15.8, -47.9), (65.0, 179.5))
+
+
+def _time_query(query_function, repeat):
+    """ This function runs a query function repeat times, reading every result, and returns the fastest time. """
+    fastest_seconds = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for _ in query_function():
+            pass
+        elapsed_seconds = time.perf_counter() - start_time
+        if fastest_seconds is None or elapsed_seconds < fastest_seconds:
+            fastest_seconds = elapsed_seconds
+    return fastest_seconds
+
+
+def _scan_bounding_box(db_connection, left, bottom, right, top):
+    """ This function answers a bounding box search by scanning the whole meteorites table. """
+    return db_connection.execute('''SELECT meteorite_id, id, name, mass, reclat, reclong FROM meteorites NOT INDEXED
+                                    WHERE reclong BETWEEN ? AND ? AND reclat BETWEEN ? AND ?''',
+                                 (left, right, bottom, top))
+
+
+def _scan_distances(db_connection, lat_value, long_value):
+    """ This function is a generator that yields the (distance in km, meteorite) tuple of every meteorite
+        with coordinates by scanning the whole meteorites table. """
+    for meteorite_row in db_connection.execute('''SELECT meteorite_id, id, name, mass, reclat, reclong
+                                                  FROM meteorites NOT INDEXED
+                                                  WHERE reclat IS NOT NULL AND reclong IS NOT NULL'''):
+        yield calculate_distance_km(lat_value, long_value, meteorite_row[4], meteorite_row[5]), meteorite_row
+
+
+def _scan_top_by_mass(db_connection, region_name, meteorite_count):
+    """ This function answers a heaviest meteorites query by sorting every meteorite of the region. """
+    return db_connection.execute('''SELECT meteorites.meteorite_id, meteorites.id, meteorites.name, meteorites.mass,
+                                    meteorites.reclat, meteorites.reclong
+                                    FROM region_membership
+                                    JOIN regions ON regions.region_id = region_membership.region_id
+                                    JOIN meteorites NOT INDEXED
+                                        ON meteorites.meteorite_id = region_membership.meteorite_id
+                                    WHERE regions.name = ? AND meteorites.mass IS NOT NULL
+                                    ORDER BY meteorites.mass DESC LIMIT ?''', (region_name, meteorite_count))
+
+
+def run_query_benchmarks(db_connection, repeat=5, radius_km=200, neighbour_count=50, meteorite_count=50):
+    """ This function times each indexed query against its full table scan and returns a dictionary of
+        query name to the fastest indexed time, the fastest scan time and the speedup, all times in seconds. """
+    create_spatial_index(db_connection)
+    region_names = [region_row[0] for region_row in db_connection.execute('''SELECT name FROM regions''')]
+    query_pairs = {
+        'bounding_box': (
+            lambda: [row for lat, long in BENCHMARK_POINTS
+                     for row in search_bounding_box(db_connection, long - 5, lat - 5, long + 5, lat + 5)],
+            lambda: [row for lat, long in BENCHMARK_POINTS
+                     for row in _scan_bounding_box(db_connection, long - 5, lat - 5, long + 5, lat + 5)]),
+        'within_distance': (
+            lambda: [row for lat, long in BENCHMARK_POINTS
+                     for row in find_meteorites_within_distance(db_connection, lat, long, radius_km)],
+            lambda: [row for lat, long in BENCHMARK_POINTS
+                     for row in _scan_distances(db_connection, lat, long) if row[0] <= radius_km]),
+        'nearest_neighbours': (
+            lambda: [row for lat, long in BENCHMARK_POINTS
+                     for row in find_nearest_meteorites(db_connection, lat, long, neighbour_count)],
+            lambda: [row for lat, long in BENCHMARK_POINTS
+                     for row in heapq.nsmallest(neighbour_count, _scan_distances(db_connection, lat, long),
+                                                key=lambda distance_row: distance_row[0])]),
+        'top_by_mass': (
+            lambda: [row for region_name in region_names
+                     for row in top_meteorites_by_mass(db_connection, region_name, meteorite_count)],
+            lambda: [row for region_name in region_names
+                     for row in _scan_top_by_mass(db_connection, region_name, meteorite_count)])
+    }
+    benchmark_results = {}
+    for query_name, (indexed_query, scan_query) in query_pairs.items():
+        indexed_seconds = _time_query(indexed_query, repeat)
+        scan_seconds = _time_query(scan_query, repeat)
+        benchmark_results[query_name] = {
+            'indexed_seconds': indexed_seconds,
+            'full_scan_seconds': scan_seconds,
+            'speedup': scan_seconds / indexed_seconds if indexed_seconds > 0 else None
+        }
+    return benchmark_results
+
+
+def main():
+    """ This function runs the query benchmarks on the database and prints the results as JSON. """
+    argument_parser = argparse.ArgumentParser(description='Benchmark the spatial queries against full table scans.')
+    argument_parser.add_argument('--repeat', type=int, default=5, help='number of times each query is timed')
+    arguments = argument_parser.parse_args()
+    db_connection = connect_to_database()
+    print(json.dumps(run_query_benchmarks(db_connection, arguments.repeat), indent=4))
+    db_connection.close()
+
+
+if __name__ == '__main__':
+    main()
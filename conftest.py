@@ -0,0 +1,93 @@
+"""
+Shared pytest fixtures. stub_server serves a list of records from a local HTTP server the way the Socrata endpoint
+pages them, so the fetchers and the response cache can be tested without the network.
+"""
+import http.server
+import json
+import threading
+import urllib.parse
+import pytest
+
+
+class StubDatasetServer:
+    """ This class runs a local HTTP server that answers $limit/$offset page requests from a list of records.
+        Every page has an ETag and a Last-Modified header, and a matching If-None-Match is answered with a 304.
+        failures maps a page offset to a list of status codes to answer with, one per request, before the page
+        is served normally. Every request is recorded in requests as a (offset, status code, headers) tuple. """
+
+    LAST_MODIFIED = 'Mon, 05 Oct 2026 12:00:00 GMT'
+
+    def __init__(self, records):
+        self.records = records
+        self.failures = {}
+        self.requests = []
+        self.version = 1
+        self._requests_lock = threading.Lock()
+        stub_server = self
+
+        class _PageRequestHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub_server._answer_request(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._http_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _PageRequestHandler)
+        self.url = f'http://127.0.0.1:{self._http_server.server_port}/resource/gh4g-9sfh.json'
+        # A short poll interval makes shutdown() return quickly at the end of each test.
+        self._server_thread = threading.Thread(target=self._http_server.serve_forever, kwargs={'poll_interval': 0.01},
+                                               daemon=True)
+        self._server_thread.start()
+
+    def _answer_request(self, request_handler):
+        query_params = urllib.parse.parse_qs(urllib.parse.urlparse(request_handler.path).query)
+        page_limit = int(query_params.get('$limit', ['1000'])[0])
+        page_offset = int(query_params.get('$offset', ['0'])[0])
+        page_etag = f'"v{self.version}-{page_offset}-{page_limit}"'
+        with self._requests_lock:
+            page_failures = self.failures.get(page_offset)
+            if page_failures:
+                status_code = page_failures.pop(0)
+            elif request_handler.headers.get('If-None-Match') == page_etag:
+                status_code = 304
+            else:
+                status_code = 200
+            self.requests.append((page_offset, status_code, dict(request_handler.headers)))
+        body_bytes = b''
+        request_handler.send_response(status_code)
+        if status_code in (200, 304):
+            request_handler.send_header('ETag', page_etag)
+            request_handler.send_header('Last-Modified', self.LAST_MODIFIED)
+        if status_code == 200:
+            body_bytes = json.dumps(self.records[page_offset:page_offset + page_limit]).encode('utf-8')
+            request_handler.send_header('Content-Type', 'application/json')
+        request_handler.send_header('Content-Length', str(len(body_bytes)))
+        request_handler.end_headers()
+        request_handler.wfile.write(body_bytes)
+
+    def requested_offsets(self, status_code=None):
+        """ This function returns the offset of every request, or only of those answered with status_code. """
+        with self._requests_lock:
+            return [page_offset for page_offset, request_status, _ in self.requests
+                    if status_code is None or request_status == status_code]
+
+    def shutdown(self):
+        self._http_server.shutdown()
+        self._http_server.server_close()
+
+
+def create_stub_records(record_count):
+    """ This function returns record_count records shaped like the NASA dataset, with string values. """
+    return [{'id': str(record_index + 1), 'name': f'Stub {record_index}', 'mass': str(record_index * 3),
+             'reclat': str(record_index % 90), 'reclong': str(record_index % 180)}
+            for record_index in range(record_count)]
+
+
+@pytest.fixture
+def stub_server():
+    """ A stub server holding 23 records, the test can replace its records or add failures before fetching. """
+    stub_server = StubDatasetServer(create_stub_records(23))
+    yield stub_server
+    stub_server.shutdown()
@@ -2,9 +2,30 @@
 This module handles functions involving gathering of the meteor database data, and the creation of the database.
 """
 from utility_functions import *
+from region_classifier import RegionClassifier, check_valid_region_name
+from vectorized_classification import NUMPY_AVAILABLE, convert_coordinate_values, compute_membership_matrix, \
+    count_unusable_coordinates, count_multi_region_hits
+from run_metrics import stage_timer, add_stage_time, increment_counter, merge_counters
+from region_aggregates import AggregateDelta, create_aggregate_tables, clear_region_aggregates
+import hashlib
+import itertools
+import json
+import math
 import sqlite3
+import time
 import requests
 
+# The file of the meteorite database, opened by connect_to_database().
+DATABASE_NAME = 'meteorite_db_all.db'
+# PRAGMA settings that can be passed to add_meteorites_to_tables_bulk() to speed up a large ingest.
+# They trade durability for speed while the ingest runs, so only use them when the database can be rebuilt.
+# journal_mode MEMORY takes the database out of WAL mode, which fails while other connections have it open.
+BULK_INGEST_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -65536
+}
+
 
 def _create_bounding_boxes():
     """ This function creates a dictionary of geolocation bounding boxes
@@ -25,6 +46,11 @@ def _create_bounding_boxes():
     return bound_box_dict
 
 
+def create_region_classifier():
+    """ This function creates a region classifier from the bounding boxes dictionary and returns it. """
+    return RegionClassifier(_create_bounding_boxes())
+
+
 def _check_dict_has_key(dict_record, key):
     """ This function checks to see if a specified dictionary record has a key specified from
         the parameters. If the key is none it will return false, otherwise it will return true.
@@ -36,24 +62,59 @@ def _check_dict_has_key(dict_record, key):
         return True
 
 
-def issue_get_request(request_url):
+def issue_get_request(request_url, query_params=None, session=None, timeout=30, response_cache=None):
     """ This function attempts to issue a GET request to the URL passed as its parameter.
+        Optional query parameters are added to the URL, such as the $limit and $offset of a page.
+        A requests session can be passed to reuse its pooled connections, and the request gives up after
+        timeout seconds. When a response cache is passed, a conditional GET is sent for cached responses and
+        the cached body is served on a 304 (Not Modified), in offline mode only the cache is used.
         A response object is returned with a status code if no exception occurs,
-        when an exception occurs it prints an error with status code. """
+        when an exception occurs it prints an error with status code and returns None. """
+    cache_entry = None
+    request_headers = None
+    if response_cache is not None:
+        cache_entry = response_cache.load_entry(request_url, query_params)
+        if response_cache.offline:
+            # Never touch the network in offline mode.
+            if cache_entry is None:
+                increment_counter('http_offline_misses')
+                print(f'Offline mode: no cached response for {request_url} with parameters {query_params}.')
+                return None
+            increment_counter('http_offline_hits')
+            print('Offline mode: serving the cached response.\n')
+            return response_cache.create_cached_response(cache_entry)
+        request_headers = response_cache.get_conditional_headers(cache_entry)
 
     try:
         # try to create make a get request and assign it a
         # response object with the specified url
-        response_obj = requests.get(request_url)
+        increment_counter('http_requests')
+        with stage_timer('http_get'):
+            if session is None:
+                response_obj = requests.get(request_url, params=query_params, headers=request_headers,
+                                            timeout=timeout)
+            else:
+                response_obj = session.get(request_url, params=query_params, headers=request_headers,
+                                           timeout=timeout)
         # pass any response code that isn't 200(OK) as an exception
         response_obj.raise_for_status()
     except requests.exceptions.RequestException as request_error:
+        increment_counter('http_errors')
         # If a request exception occurs, print the error in a formatted message.
+        status_code = request_error.response.status_code if request_error.response is not None else None
         print(f'An error has occurred while issuing a GET request.\n'
               f'Response: {request_error}\n'
-              f'Status Code: {request_error.response} ')
-        # return the request error
-        return request_error
+              f'Status Code: {status_code} ')
+        # return None, as there is no response to convert
+        return None
+    if response_cache is not None:
+        if response_obj.status_code == 304 and cache_entry is not None:
+            # The cached body is still current, so serve it instead.
+            increment_counter('http_not_modified')
+            print('GET request not modified since it was cached. Serving the cached response.\n')
+            return response_cache.create_cached_response(cache_entry)
+        response_cache.store_response(request_url, query_params, response_obj)
+        response_cache.evict_stale_entries()
     # If no exception occurs, print a GET request successful message with a status code.
     print(f'GET request successful. Response: {response_obj.status_code}. Status Code: {response_obj.status_code}\n')
     # Return the response object.
@@ -63,17 +124,24 @@ def issue_get_request(request_url):
 def convert_content_to_json(response_obj):
     """ This function attempts to convert the contents of a specified response object to a json
         the function will throw an error if a JSON decoder error occurs and will return None,
-        if successful it will return the json object. """
+        if successful it will return the json object. None is also returned if the response object
+        is None, which happens when the GET request failed. """
     # Create an empty json object.
     json_data_obj = None
+    # There is nothing to convert if the GET request failed.
+    if response_obj is None:
+        print('There is no response to convert to a JSON object, did the GET request work correctly?')
+        return json_data_obj
     try:
         # Try to assign the json object the response object passed as a parameter
         # using the JSON decoder.
-        json_data_obj = response_obj.json()
+        with stage_timer('json_decode'):
+            json_data_obj = response_obj.json()
         # Print a message that the json object was converted.
         print(f'Response object content converted to JSON object.\n')
     except requests.exceptions.JSONDecodeError as json_decode_error:
         # If any JSON decoder exceptions occur, print an error in a formatted message.
+        increment_counter('json_decode_errors')
         print(f'An error has occurred while trying to convert the response content to a JSON object.\n'
               f'{json_decode_error}')
     finally:
@@ -81,16 +149,21 @@ def convert_content_to_json(response_obj):
         return json_data_obj
 
 
-def connect_to_database():
-    """ This function attempts to set up a connection with the sqlite database.
+def connect_to_database(db_name=DATABASE_NAME, journal_mode='WAL'):
+    """ This function attempts to set up a connection with the sqlite database, meteorite_db_all.db unless
+        a different db_name is passed. The database is switched to the specified journal mode, WAL by default,
+        so readers on other connections keep reading the last committed data while an ingest writes, instead of
+        waiting on the write lock. Passing journal_mode=None leaves the journal mode of the file as it is.
         If any sqlite exceptions occur it will print an error
         and will return the connection as none. If successful it will return the connection."""
     # Create an empty connection object.
     db_connection = None
     try:
-        # Try to assign a name to the database and connect it.
-        db_name = 'meteorite_db_all.db'
-        db_connection = sqlite3.connect(db_name)
+        # Try to connect to the database with the specified name.
+        with stage_timer('connect'):
+            db_connection = sqlite3.connect(db_name)
+            if journal_mode is not None:
+                _apply_ingest_pragmas(db_connection.cursor(), {'journal_mode': journal_mode})
     except sqlite3.Error as db_error:
         # If a sqlite error occurs print it a formatted message.
         print(f'A database error has occurred: {db_error}')
@@ -116,246 +189,528 @@ def create_cursor_obj(db_connection):
         return db_cursor_obj
 
 
-def create_all_region_tables(db_cursor_obj):
-    """ This function attempts to create all seven tables for each region
-        with the specified cursor object as a parameter, this function creates a table
+def create_all_region_tables(db_cursor_obj, region_names=None, clear_existing=True):
+    """ This function attempts to create a table for each region with the specified cursor object as a parameter,
+        by default the seven regions from the bounding boxes are used, a different list of region names can be
+        passed for regions loaded from a region definition file. This function creates a table
         for each region if it doesn't exist. It will delete any entries from each table if already
-        filled. If any sqlite exceptions occur, it will print an error. """
+        filled, unless clear_existing is False. The summary tables of region_aggregates are created too, and the
+        summaries of cleared tables are reset, along with those of tables that were just created or that replaced
+        a view of the normalized schema. If any sqlite exceptions occur, it will print an error. """
+    if region_names is None:
+        region_names = list(_create_bounding_boxes())
+    # The regions whose table starts out empty, so their summaries have to be reset even if clear_existing is False.
+    new_table_names = []
     try:
-        # Execute Sqlite3 CREATE TABLE function on the cursor object only if it doesn't exist.
-        db_cursor_obj.execute('''CREATE TABLE IF NOT EXISTS Africa_MiddleEast_Meteorites(
-                                name TEXT,
-                                mass TEXT,
-                                reclat TEXT,
-                                reclong TEXT);''')
-        # Execute Delete from table on the cursor object.
-        # Delete any data from the table if it already existed.
-        db_cursor_obj.execute('''DELETE FROM Africa_MiddleEast_Meteorites''')
-
-        # Execute Sqlite3 CREATE TABLE function on the cursor object only if it doesn't exist.
-        db_cursor_obj.execute('''CREATE TABLE IF NOT EXISTS Europe_Meteorites(
-                                name TEXT,
-                                mass TEXT,
-                                reclat TEXT,
-                                reclong TEXT);''')
-        # Execute Delete from table on the cursor object.
-        # Delete any data from the table if it already existed.
-        db_cursor_obj.execute('''DELETE FROM Europe_Meteorites''')
-
-        # Execute Sqlite3 CREATE TABLE function on the cursor object only if it doesn't exist.
-        db_cursor_obj.execute('''CREATE TABLE IF NOT EXISTS Upper_Asia_Meteorites(
-                                name TEXT,
-                                mass TEXT,
-                                reclat TEXT,
-                                reclong TEXT);''')
-        # Execute Delete from table on the cursor object.
-        # Delete any data from the table if it already existed.
-        db_cursor_obj.execute('''DELETE FROM Upper_Asia_Meteorites''')
-
-        # Execute Sqlite3 CREATE TABLE function on the cursor object only if it doesn't exist.
-        db_cursor_obj.execute('''CREATE TABLE IF NOT EXISTS Lower_Asia_Meteorites(
-                                name TEXT,
-                                mass TEXT,
-                                reclat TEXT,
-                                reclong TEXT);''')
-        # Execute Delete from table on the cursor object.
-        # Delete any data from the table if it already existed.
-        db_cursor_obj.execute('''DELETE FROM Lower_Asia_Meteorites''')
-
-        # Execute Sqlite3 CREATE TABLE function on the cursor object only if it doesn't exist.
-        db_cursor_obj.execute('''CREATE TABLE IF NOT EXISTS Australia_Meteorites(
-                                name TEXT,
-                                mass TEXT,
-                                reclat TEXT,
-                                reclong TEXT);''')
-        # Execute Delete from table on the cursor object.
-        # Delete any data from the table if it already existed.
-        db_cursor_obj.execute('''DELETE FROM Australia_Meteorites''')
-
-        # Execute Sqlite3 CREATE TABLE function on the cursor object only if it doesn't exist.
-        db_cursor_obj.execute('''CREATE TABLE IF NOT EXISTS North_America_Meteorites(
-                                name TEXT,
-                                mass TEXT,
-                                reclat TEXT,
-                                reclong TEXT);''')
-        # Execute Delete from table on the cursor object.
-        # Delete any data from the table if it already existed.
-        db_cursor_obj.execute('''DELETE FROM North_America_Meteorites''')
-
-        # Execute Sqlite3 CREATE TABLE function on the cursor object only if it doesn't exist.
-        db_cursor_obj.execute('''CREATE TABLE IF NOT EXISTS South_America_Meteorites(
-                                name TEXT,
-                                mass TEXT,
-                                reclat TEXT,
-                                reclong TEXT);''')
-        # Execute Delete from table on the cursor object.
-        # Delete any data from the table if it already existed.
-        db_cursor_obj.execute('''DELETE FROM South_America_Meteorites''')
+        for table_name in region_names:
+            # Make sure the region name is safe to use as a table name.
+            check_valid_region_name(table_name)
+            db_cursor_obj.execute('''SELECT type FROM sqlite_master WHERE name = ?''', (table_name,))
+            existing_object = db_cursor_obj.fetchone()
+            # The normalized schema uses a view with the same name as the region table, drop it if it exists.
+            if existing_object is not None and existing_object[0] == 'view':
+                db_cursor_obj.execute(f'''DROP VIEW {table_name}''')
+            if existing_object is None or existing_object[0] == 'view':
+                new_table_names.append(table_name)
+            # Execute Sqlite3 CREATE TABLE function on the cursor object only if it doesn't exist.
+            db_cursor_obj.execute(f'''CREATE TABLE IF NOT EXISTS {table_name}(
+                                    name TEXT,
+                                    mass TEXT,
+                                    reclat TEXT,
+                                    reclong TEXT);''')
+            # Execute Delete from table on the cursor object.
+            # Delete any data from the table if it already existed.
+            if clear_existing:
+                db_cursor_obj.execute(f'''DELETE FROM {table_name}''')
+        create_aggregate_tables(db_cursor_obj, region_names)
+        if clear_existing:
+            clear_region_aggregates(db_cursor_obj, region_names)
+        elif new_table_names:
+            clear_region_aggregates(db_cursor_obj, new_table_names)
     except sqlite3.Error as db_error:
         # If any sqlite exceptions occur, print the error in a formatted message.
         print(f'A database error has occurred: {db_error}')
 
 
-def _add_to_region_africa_middle(db_cursor_obj, record):
-    """ This function adds a record to the Africa_MiddleEast_Meteorites
-        with the record specified through a parameter. If any
-        sqlite exceptions occur, an error will print."""
-    try:
-        db_cursor_obj.execute('''INSERT INTO Africa_MiddleEast_Meteorites VALUES(?, ?, ?, ?)''',
-                              (record.get('name', None),
-                               record.get('mass', None),
-                               record.get('reclat', None),
-                               record.get('reclong', None)))
-    except sqlite3.Error as db_error:
-        print(f'A database error has occurred: {db_error}')
-
-
-def _add_to_region_europe(db_cursor_obj, record):
-    """ This function adds a record to the Europe_Meteorites table
-        with the record specified through a parameter. If any
-        sqlite exceptions occur, an error will print."""
-    try:
-        db_cursor_obj.execute('''INSERT INTO Europe_Meteorites VALUES(?, ?, ?, ?)''',
-                              (record.get('name', None),
-                               record.get('mass', None),
-                               record.get('reclat', None),
-                               record.get('reclong', None)))
-    except sqlite3.Error as db_error:
-        print(f'A database error has occurred: {db_error}')
-
-
-def _add_to_region_upper_asia(db_cursor_obj, record):
-    """ This function adds a record to the Upper_Asia_Meteorites table
-        with the record specified through a parameter. If any
-        sqlite exceptions occur, an error will print."""
-    try:
-        db_cursor_obj.execute('''INSERT INTO Upper_Asia_Meteorites VALUES(?, ?, ?, ?)''',
-                              (record.get('name', None),
-                               record.get('mass', None),
-                               record.get('reclat', None),
-                               record.get('reclong', None)))
-    except sqlite3.Error as db_error:
-        print(f'A database error has occurred: {db_error}')
-
-
-def _add_to_region_lower_asia(db_cursor_obj, record):
-    """ This function adds a record to the Lower_Asia_Meteorites table
-        with the record specified through a parameter. If any
-        sqlite exceptions occur, an error will print."""
+def get_record_row(record):
+    """ This function returns the (name, mass, reclat, reclong) tuple of a record
+        in the order the columns are stored in each region table. """
+    return (record.get('name', None),
+            record.get('mass', None),
+            record.get('reclat', None),
+            record.get('reclong', None))
+
+
+def get_record_coordinates(record):
+    """ This function returns the latitude and longitude of a record as a (lat, long) tuple of numbers.
+        None is returned if the record is missing its reclat or reclong value, if either value
+        can't be converted to a finite number or if the latitude is outside of -90 to 90. """
+    return _convert_coordinates(record.get('reclat', None), record.get('reclong', None))
+
+
+def _convert_coordinates(reclat, reclong):
+    """ This function converts a reclat and reclong value to a (lat, long) tuple of numbers, or returns None if
+        either value is missing or can't be converted to a finite number, or the latitude is out of range. These are
+        the same coordinates convert_coordinate_values turns into NaN, so every ingest skips the same records. """
+    # Check first if the specified meteor has a reclat and reclong value.
+    if reclat is None or reclong is None:
+        return None
+    # The values in the JSON file are strings, so convert them using the
+    # convert function the utility functions file.
+    lat_value = convert_string_to_numerical(reclat)
+    long_value = convert_string_to_numerical(reclong)
+    if lat_value is None or long_value is None:
+        return None
+    # NaN and infinite values convert, but aren't a place on the globe. Neither is a latitude past a pole.
+    if not math.isfinite(lat_value) or not math.isfinite(long_value) or not -90 <= lat_value <= 90:
+        return None
+    return lat_value, long_value
+
+
+def _create_record_counts():
+    """ This function returns a dictionary of the record counters of run_metrics, all starting at 0.
+        The ingest functions count into it while they loop and add it to the run's counters once at the end,
+        which is much faster than incrementing a counter for every record. """
+    return {'records_seen': 0,
+            'records_skipped_missing_coordinates': 0,
+            'records_skipped_unparseable_coordinates': 0,
+            'multi_region_hits': 0}
+
+
+def _get_skip_reason(record):
+    """ This function returns the name of the counter for a record that get_record_coordinates returned None for,
+        depending on if its reclat or reclong value is missing or just can't be converted to a number. """
+    if _check_dict_has_key(record, 'reclat') and _check_dict_has_key(record, 'reclong'):
+        return 'records_skipped_unparseable_coordinates'
+    return 'records_skipped_missing_coordinates'
+
+
+def get_record_columns(records):
+    """ This function returns the name, mass, reclat and reclong values of a list of records as a tuple of four lists,
+        in the order the columns are stored in each region table. The columns are all a worker process needs to
+        classify the records, and pickling them is several times cheaper than pickling the full records. """
+    return ([record.get('name', None) for record in records],
+            [record.get('mass', None) for record in records],
+            [record.get('reclat', None) for record in records],
+            [record.get('reclong', None) for record in records])
+
+
+def _group_columns_by_region(record_columns, region_classifier):
+    """ This function does the classification of group_columns_by_region, without timing it. """
+    name_column, mass_column, lat_column, long_column = record_columns
+    region_rows = {table_name: [] for table_name in region_classifier.region_names}
+    record_counts = _create_record_counts()
+    record_counts['records_seen'] = len(lat_column)
+    if NUMPY_AVAILABLE:
+        # The conversion is timed on its own as well as being part of the classification stage around it.
+        with stage_timer('numeric_conversion'):
+            lat_array, long_array = convert_coordinate_values(lat_column, long_column)
+        membership_matrix = compute_membership_matrix(lat_array, long_array, region_classifier)
+        for region_index, table_name in enumerate(region_classifier.region_names):
+            region_rows[table_name] = [(name_column[record_index], mass_column[record_index],
+                                        lat_column[record_index], long_column[record_index])
+                                       for record_index in membership_matrix[:, region_index].nonzero()[0]]
+        missing_count = sum(1 for lat_value, long_value in zip(lat_column, long_column)
+                            if lat_value is None or long_value is None)
+        record_counts['records_skipped_missing_coordinates'] = missing_count
+        record_counts['records_skipped_unparseable_coordinates'] = \
+            count_unusable_coordinates(lat_array, long_array) - missing_count
+        record_counts['multi_region_hits'] = count_multi_region_hits(membership_matrix)
+    else:
+        with stage_timer('numeric_conversion'):
+            coordinate_column = [_convert_coordinates(lat_value, long_value)
+                                 for lat_value, long_value in zip(lat_column, long_column)]
+        for row, coordinates in zip(zip(name_column, mass_column, lat_column, long_column), coordinate_column):
+            if row[2] is None or row[3] is None:
+                record_counts['records_skipped_missing_coordinates'] += 1
+                continue
+            if coordinates is None:
+                record_counts['records_skipped_unparseable_coordinates'] += 1
+                continue
+            region_names = region_classifier.classify(*coordinates)
+            if len(region_names) > 1:
+                record_counts['multi_region_hits'] += 1
+            for table_name in region_names:
+                region_rows[table_name].append(row)
+    merge_counters(record_counts)
+    return region_rows
+
+
+def group_columns_by_region(record_columns, region_classifier):
+    """ This function classifies the records of a tuple of columns from get_record_columns and returns a dictionary
+        of region table name to the list of rows (see get_record_row) that belong in that table. Records without
+        usable coordinates are left out. The whole batch is classified at once with NumPy when it is installed,
+        otherwise one record at a time. It is timed as the classification stage, and converting the coordinate
+        strings to numbers inside it is also timed as the numeric_conversion stage. The records are counted in the
+        run metrics, a NaN or infinite value or a latitude outside of -90 to 90 counts as unparseable. """
+    with stage_timer('classification'):
+        return _group_columns_by_region(record_columns, region_classifier)
+
+
+def group_rows_by_region(records, region_classifier):
+    """ This function is the version of group_columns_by_region for a list of record dictionaries. """
+    with stage_timer('classification'):
+        return _group_columns_by_region(get_record_columns(records), region_classifier)
+
+
+def _add_to_region_table(db_cursor_obj, table_name, record, aggregate_delta, record_counts):
+    """ This function adds a record to the specified region table
+        with the record specified through a parameter, and counts it in the aggregate delta and in the
+        record counts of the ingest. If any sqlite exceptions occur, an error will print."""
     try:
-        db_cursor_obj.execute('''INSERT INTO Lower_Asia_Meteorites VALUES(?, ?, ?, ?)''',
-                              (record.get('name', None),
-                               record.get('mass', None),
-                               record.get('reclat', None),
-                               record.get('reclong', None)))
+        row = get_record_row(record)
+        db_cursor_obj.execute(f'''INSERT INTO {table_name}(name, mass, reclat, reclong) VALUES(?, ?, ?, ?)''', row)
+        aggregate_delta.add_rows(table_name, (row,))
+        counter_name = f'rows_inserted.{table_name}'
+        record_counts[counter_name] = record_counts.get(counter_name, 0) + 1
     except sqlite3.Error as db_error:
         print(f'A database error has occurred: {db_error}')
 
 
-def _add_to_region_australia(db_cursor_obj, record):
-    """ This function adds a record to the Australia_Meteorites table
-        with the record specified through a parameter. If any
-        sqlite exceptions occur, an error will print."""
+def add_meteorites_to_tables(db_cursor_obj, json_data_obj, region_classifier=None):
+    """ This functions adds a meteor from the JSON data object to the corresponding table depending on if
+    its reclat and reclong values fall between a certain bounding box. The function loops through every meteor in the JSON object.
+    The region classifier looks up which bounding boxes contain the meteors latitude and longitude, by default
+    it is built from the seven bounding boxes. Meteors without numeric coordinates are skipped. """
+    # Create the region classifier from the bounding boxes if one wasn't passed in.
+    if region_classifier is None:
+        region_classifier = create_region_classifier()
+    record_counts = _create_record_counts()
+    # The time of each stage is added up locally and added to the run metrics once at the end, like the counters.
+    # As in group_columns_by_region, the classification stage includes the numeric conversion.
+    stage_seconds = {'numeric_conversion': 0.0, 'classification': 0.0, 'insert': 0.0}
+    aggregate_delta = AggregateDelta()
     try:
-        db_cursor_obj.execute('''INSERT INTO Australia_Meteorites VALUES(?, ?, ?, ?)''',
-                              (record.get('name', None),
-                               record.get('mass', None),
-                               record.get('reclat', None),
-                               record.get('reclong', None)))
+        # Loop through each meteor in the JSON object, if the JSON object is empty,
+        # print an error message.
+        for record in json_data_obj:
+            record_counts['records_seen'] += 1
+            conversion_start = time.perf_counter()
+            coordinates = get_record_coordinates(record)
+            stage_seconds['numeric_conversion'] += time.perf_counter() - conversion_start
+            # If the meteor has no usable latitude and longitude, skip it and count why.
+            if coordinates is None:
+                stage_seconds['classification'] += time.perf_counter() - conversion_start
+                record_counts[_get_skip_reason(record)] += 1
+                continue
+            # Add the meteor to the table of every region it falls in.
+            # If the meteor doesn't fit in any bounding box, the list is empty.
+            region_names = region_classifier.classify(*coordinates)
+            insert_start = time.perf_counter()
+            stage_seconds['classification'] += insert_start - conversion_start
+            if len(region_names) > 1:
+                record_counts['multi_region_hits'] += 1
+            for table_name in region_names:
+                _add_to_region_table(db_cursor_obj, table_name, record, aggregate_delta, record_counts)
+            stage_seconds['insert'] += time.perf_counter() - insert_start
+        # Update the region summaries with every row that was added.
+        aggregate_delta.apply(db_cursor_obj)
     except sqlite3.Error as db_error:
         print(f'A database error has occurred: {db_error}')
-
-
-def _add_to_region_north_america(db_cursor_obj, record):
-    """ This function adds a record to the North_America_Meteorites table
-        with the record specified through a parameter. If any
-        sqlite exceptions occur, an error will print."""
+    except TypeError:
+        # A typeError occurs if the JSON file is empty. Which can result from not properly
+        # doing a GET request on the data.
+        print('A TypeError has occurred, your JSON file could be empty! Did you GET request work correctly?')
+    finally:
+        merge_counters(record_counts)
+        for stage_name, busy_seconds in stage_seconds.items():
+            add_stage_time(stage_name, busy_seconds)
+
+
+def _apply_ingest_pragmas(db_cursor_obj, ingest_pragmas):
+    """ This function executes each PRAGMA from the specified dictionary on the cursor object.
+        Only the journal_mode, synchronous and cache_size pragmas are allowed, any other
+        pragma name or a value that isn't a plain word or number raises a ValueError. """
+    allowed_pragmas = ('journal_mode', 'synchronous', 'cache_size')
+    for pragma_name, pragma_value in ingest_pragmas.items():
+        # PRAGMA values can't be passed as sqlite parameters, so check them before
+        # putting them in the statement.
+        if pragma_name not in allowed_pragmas:
+            raise ValueError(f'Unsupported ingest pragma: {pragma_name}')
+        if not str(pragma_value).lstrip('-').isalnum():
+            raise ValueError(f'Invalid value for pragma {pragma_name}: {pragma_value}')
+        db_cursor_obj.execute(f'PRAGMA {pragma_name} = {pragma_value}')
+
+
+def _flush_region_buffer(db_cursor_obj, table_name, row_buffer, aggregate_delta):
+    """ This function inserts every buffered row into the specified region table with a single
+        executemany call, counts the rows in the aggregate delta and empties the buffer.
+        It returns the number of rows inserted. """
+    with stage_timer('insert'):
+        db_cursor_obj.executemany(f'''INSERT INTO {table_name}(name, mass, reclat, reclong) VALUES(?, ?, ?, ?)''',
+                                  row_buffer)
+    aggregate_delta.add_rows(table_name, row_buffer)
+    row_count = len(row_buffer)
+    increment_counter(f'rows_inserted.{table_name}', row_count)
+    row_buffer.clear()
+    return row_count
+
+
+def add_meteorites_to_tables_bulk(db_connection, db_cursor_obj, json_data_obj, batch_size=5000, ingest_pragmas=None,
+                                  region_classifier=None):
+    """ This function is the bulk version of add_meteorites_to_tables. Each meteor is classified
+        into regions the same way, but instead of one INSERT per meteor the rows are buffered per region
+        and written with executemany once a buffer holds batch_size rows. All rows are written inside one
+        explicit transaction which is committed at the end, or rolled back if an error occurs. A transaction that is
+        already open is carried on instead. Optional ingest_pragmas (see BULK_INGEST_PRAGMAS) are applied before
+        the transaction starts, committing any open transaction first.
+        The function prints and returns the number of rows inserted per second. """
+    if batch_size < 1:
+        raise ValueError('batch_size must be at least 1')
+    if region_classifier is None:
+        region_classifier = create_region_classifier()
+    # Create an empty row buffer for every region table.
+    region_buffers = {table_name: [] for table_name in region_classifier.region_names}
+    record_counts = _create_record_counts()
+    aggregate_delta = AggregateDelta()
+    rows_inserted = 0
+    start_time = time.perf_counter()
     try:
-        db_cursor_obj.execute('''INSERT INTO North_America_Meteorites VALUES(?, ?, ?, ?)''',
-                              (record.get('name', None),
-                               record.get('mass', None),
-                               record.get('reclat', None),
-                               record.get('reclong', None)))
+        if ingest_pragmas:
+            # Commit anything still pending, journal_mode can't be changed inside a transaction.
+            if db_connection.in_transaction:
+                db_connection.commit()
+            _apply_ingest_pragmas(db_cursor_obj, ingest_pragmas)
+        # A transaction that is already open (such as the DELETEs of create_all_region_tables)
+        # is carried on, so clearing and refilling the tables happens together.
+        if not db_connection.in_transaction:
+            db_cursor_obj.execute('BEGIN')
+        for record in json_data_obj:
+            record_counts['records_seen'] += 1
+            coordinates = get_record_coordinates(record)
+            # Skip the meteor if it has no usable latitude and longitude.
+            if coordinates is None:
+                record_counts[_get_skip_reason(record)] += 1
+                continue
+            row = get_record_row(record)
+            region_names = region_classifier.classify(*coordinates)
+            if len(region_names) > 1:
+                record_counts['multi_region_hits'] += 1
+            for table_name in region_names:
+                region_buffers[table_name].append(row)
+                # Write the buffer out once it is full, so memory stays bounded.
+                if len(region_buffers[table_name]) >= batch_size:
+                    rows_inserted += _flush_region_buffer(db_cursor_obj, table_name, region_buffers[table_name],
+                                                          aggregate_delta)
+        # Write out whatever is left in each buffer, update the region summaries and commit the transaction.
+        for table_name, row_buffer in region_buffers.items():
+            if row_buffer:
+                rows_inserted += _flush_region_buffer(db_cursor_obj, table_name, row_buffer, aggregate_delta)
+        aggregate_delta.apply(db_cursor_obj)
+        with stage_timer('commit'):
+            db_connection.commit()
     except sqlite3.Error as db_error:
+        # If any sqlite exceptions occur, undo the partial ingest and print the error in a formatted message.
+        if db_connection.in_transaction:
+            db_connection.rollback()
         print(f'A database error has occurred: {db_error}')
-
-
-def _add_to_region_south_america(db_cursor_obj, record):
-    """ This function adds a record to the South_America_Meteorites table
-        with the record specified through a parameter. If any
-        sqlite exceptions occur, an error will print."""
+        return 0.0
+    except TypeError:
+        # A typeError occurs if the JSON file is empty. Which can result from not properly
+        # doing a GET request on the data.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        print('A TypeError has occurred, your JSON file could be empty! Did you GET request work correctly?')
+        return 0.0
+    except BaseException:
+        # Undo the partial ingest if anything else stops it, such as a page failing to download.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        raise
+    finally:
+        merge_counters(record_counts)
+    elapsed_seconds = time.perf_counter() - start_time
+    rows_per_second = rows_inserted / elapsed_seconds if elapsed_seconds > 0 else 0.0
+    print(f'Bulk ingest inserted {rows_inserted} rows in {elapsed_seconds:.3f} seconds '
+          f'({rows_per_second:.0f} rows per second).')
+    return rows_per_second
+
+
+def add_meteorites_to_tables_vectorized(db_connection, db_cursor_obj, json_data_obj, batch_size=50000,
+                                        region_classifier=None):
+    """ This function is the vectorized version of add_meteorites_to_tables. The meteors are read in batches of
+        batch_size records, the coordinates of each batch are classified at once with NumPy, and the records of each
+        region are written with one executemany call per batch. All rows are written inside one explicit transaction.
+        The tables end up identical to the ones built by add_meteorites_to_tables. If NumPy isn't installed
+        the scalar bulk path is used instead. The function prints and returns the number of rows inserted per second. """
+    if not NUMPY_AVAILABLE:
+        print('NumPy is not installed, using the scalar bulk ingest instead.')
+        return add_meteorites_to_tables_bulk(db_connection, db_cursor_obj, json_data_obj,
+                                             region_classifier=region_classifier)
+    if batch_size < 1:
+        raise ValueError('batch_size must be at least 1')
+    if region_classifier is None:
+        region_classifier = create_region_classifier()
+    aggregate_delta = AggregateDelta()
+    rows_inserted = 0
+    start_time = time.perf_counter()
     try:
-        db_cursor_obj.execute('''INSERT INTO South_America_Meteorites VALUES(?, ?, ?, ?)''',
-                              (record.get('name', None),
-                               record.get('mass', None),
-                               record.get('reclat', None),
-                               record.get('reclong', None)))
+        if not db_connection.in_transaction:
+            db_cursor_obj.execute('BEGIN')
+        record_iterator = iter(json_data_obj)
+        while True:
+            # Read the next batch of records, stop once there are none left.
+            record_batch = list(itertools.islice(record_iterator, batch_size))
+            if not record_batch:
+                break
+            for table_name, region_rows in group_rows_by_region(record_batch, region_classifier).items():
+                if region_rows:
+                    rows_inserted += _flush_region_buffer(db_cursor_obj, table_name, region_rows, aggregate_delta)
+            # Update the region summaries once per batch, so the delta stays small.
+            aggregate_delta.apply(db_cursor_obj)
+        with stage_timer('commit'):
+            db_connection.commit()
     except sqlite3.Error as db_error:
+        # If any sqlite exceptions occur, undo the partial ingest and print the error in a formatted message.
+        if db_connection.in_transaction:
+            db_connection.rollback()
         print(f'A database error has occurred: {db_error}')
-
-
-def add_meteorites_to_tables(db_cursor_obj, json_data_obj):
-    """ This functions adds a meteor from the JSON data object to the corresponding table depending on if
-    its reclat and reclong values fall between a certain bounding box. The function loops through every meteor in the JSON object.
-    The tuple values of each box are called in an if statement to check if the meteors
-    latitude and longitude fall within the values of the bounding box. """
-    # Call create_bounding_boxes function to create the bounding boxes
-    bounding_boxes = _create_bounding_boxes()
-    # Get the tuple values of each bounding box and assign it to a corresponding variable
-    africa_middle_values = bounding_boxes.get('Africa_MiddleEast_Meteorites')
-    europe_values = bounding_boxes.get('Europe_Meteorites')
-    upper_asia_values = bounding_boxes.get('Upper_Asia_Meteorites')
-    lower_asia_values = bounding_boxes.get('Lower_Asia_Meteorites')
-    australia_values = bounding_boxes.get('Australia_Meteorites')
-    north_america_values = bounding_boxes.get('North_America_Meteorites')
-    south_america_values = bounding_boxes.get('South_America_Meteorites')
+        return 0.0
+    except TypeError:
+        # A typeError occurs if the JSON file is empty. Which can result from not properly
+        # doing a GET request on the data.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        print('A TypeError has occurred, your JSON file could be empty! Did you GET request work correctly?')
+        return 0.0
+    except BaseException:
+        # Undo the partial ingest if anything else stops it, such as a page failing to download.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        raise
+    elapsed_seconds = time.perf_counter() - start_time
+    rows_per_second = rows_inserted / elapsed_seconds if elapsed_seconds > 0 else 0.0
+    print(f'Vectorized ingest inserted {rows_inserted} rows in {elapsed_seconds:.3f} seconds '
+          f'({rows_per_second:.0f} rows per second).')
+    return rows_per_second
+
+
+def _compute_row_hash(row):
+    """ This function returns a hash of the values stored for a record, used to tell if a record changed. """
+    return hashlib.sha1(json.dumps(row).encode('utf-8')).hexdigest()
+
+
+def _ensure_refresh_columns(db_cursor_obj, table_name):
+    """ This function adds the id and content_hash columns used by the incremental refresh to a region table
+        if it doesn't have them yet, and creates a unique index on id. """
+    db_cursor_obj.execute(f'''PRAGMA table_info({table_name})''')
+    column_names = [column_info[1] for column_info in db_cursor_obj.fetchall()]
+    if 'id' not in column_names:
+        db_cursor_obj.execute(f'''ALTER TABLE {table_name} ADD COLUMN id TEXT''')
+    if 'content_hash' not in column_names:
+        db_cursor_obj.execute(f'''ALTER TABLE {table_name} ADD COLUMN content_hash TEXT''')
+    db_cursor_obj.execute(f'''CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_id_index ON {table_name}(id)''')
+
+
+def _read_rows_by_id(db_cursor_obj, table_name, row_ids):
+    """ This function returns the (name, mass, reclat, reclong) values of the rows of a region table with the
+        specified ids, which are needed to take changed and removed rows out of the region summaries. """
+    stored_rows = []
+    for row_id in row_ids:
+        db_cursor_obj.execute(f'''SELECT name, mass, reclat, reclong FROM {table_name} WHERE id = ?''', (row_id,))
+        stored_rows.extend(db_cursor_obj.fetchall())
+    return stored_rows
+
+
+def refresh_region_tables_incrementally(db_connection, db_cursor_obj, json_data_obj, region_classifier=None):
+    """ This function refreshes the region tables without deleting and reloading them. Rows are keyed on each
+        record's id field and a hash of the stored values. Records that are new to a region are inserted, records
+        whose values changed are updated and rows whose record is no longer in the region are deleted. Rows left
+        by a full reload have no id, so they are deleted and their records inserted again on the first refresh.
+        Records without an id are skipped, and only the first record with a given id is used.
+        All changes are made in one transaction, along with the matching changes to the region summaries.
+        The function prints and returns a dictionary with the number of rows 'added', 'changed' and 'removed',
+        or None if an error occurred. """
+    if region_classifier is None:
+        region_classifier = create_region_classifier()
+    refresh_counts = {'added': 0, 'changed': 0, 'removed': 0}
+    record_counts = _create_record_counts()
+    aggregate_delta = AggregateDelta()
     try:
-        # Loop through each meteor in the JSON object, if the JSON object is empty,
-        # print an error message.
+        create_all_region_tables(db_cursor_obj, region_classifier.region_names, clear_existing=False)
+        if not db_connection.in_transaction:
+            db_cursor_obj.execute('BEGIN')
+        # Read the id and hash of every row already in each region table.
+        existing_hashes = {}
+        for table_name in region_classifier.region_names:
+            _ensure_refresh_columns(db_cursor_obj, table_name)
+            db_cursor_obj.execute(f'''SELECT name, mass, reclat, reclong FROM {table_name} WHERE id IS NULL''')
+            aggregate_delta.remove_rows(table_name, db_cursor_obj.fetchall())
+            db_cursor_obj.execute(f'''DELETE FROM {table_name} WHERE id IS NULL''')
+            refresh_counts['removed'] += db_cursor_obj.rowcount
+            db_cursor_obj.execute(f'''SELECT id, content_hash FROM {table_name}''')
+            existing_hashes[table_name] = dict(db_cursor_obj.fetchall())
+        # Work out which rows have to be inserted or updated in each region table.
+        rows_to_insert = {table_name: [] for table_name in region_classifier.region_names}
+        rows_to_update = {table_name: [] for table_name in region_classifier.region_names}
+        seen_ids = set()
         for record in json_data_obj:
-            # Check first if the specified meteor has a reclat and reclong value
-            # If not it will skip the meteor entry.
-            if _check_dict_has_key(record, 'reclat')\
-                    and _check_dict_has_key(record, 'reclong'):
-                # Assign the latitude and longitude values of the current meteor
-                # to variables. It will first convert the values into floats using
-                # the convert function the utility functions file. As the values
-                # in the JSON file are strings.
-                lat_value = convert_string_to_numerical(record.get('reclat'))
-                long_value = convert_string_to_numerical(record.get('reclong'))
-                # Check both the latitude values and longitude values of the meteor see if they fit
-                # in the range of the bounding box. The corresponding indexes are called
-                # from the values of the bounding box to properly check. If the meteor
-                # falls into one of the bounding boxes, call the corresponding add to table function
-                # on that meteor as a parameter.
-                if africa_middle_values[0] <= long_value <= africa_middle_values[2] and \
-                        africa_middle_values[1] <= lat_value <= africa_middle_values[3]:
-                    _add_to_region_africa_middle(db_cursor_obj, record)
-                if europe_values[0] <= long_value <= europe_values[2] and \
-                        europe_values[1] <= lat_value <= europe_values[3]:
-                    _add_to_region_europe(db_cursor_obj, record)
-                if upper_asia_values[0] <= long_value <= upper_asia_values[2] and \
-                        upper_asia_values[1] <= lat_value <= upper_asia_values[3]:
-                    _add_to_region_upper_asia(db_cursor_obj, record)
-                if lower_asia_values[0] <= long_value <= lower_asia_values[2] and \
-                        lower_asia_values[1] <= lat_value <= lower_asia_values[3]:
-                    _add_to_region_lower_asia(db_cursor_obj, record)
-                if australia_values[0] <= long_value <= australia_values[2] and \
-                        australia_values[1] <= lat_value <= australia_values[3]:
-                    _add_to_region_australia(db_cursor_obj, record)
-                if north_america_values[0] <= long_value <= north_america_values[2] and \
-                        north_america_values[1] <= lat_value <= north_america_values[3]:
-                    _add_to_region_north_america(db_cursor_obj, record)
-                if south_america_values[0] <= long_value <= south_america_values[2] and \
-                        south_america_values[1] <= lat_value <= south_america_values[3]:
-                    _add_to_region_south_america(db_cursor_obj, record)
-            # If the meteor doesn't fit in any bounding box, skip it.
-            else:
+            record_counts['records_seen'] += 1
+            record_id = record.get('id', None)
+            if record_id is None or record_id in seen_ids:
+                continue
+            seen_ids.add(record_id)
+            coordinates = get_record_coordinates(record)
+            if coordinates is None:
+                record_counts[_get_skip_reason(record)] += 1
                 continue
+            row = get_record_row(record)
+            row_hash = _compute_row_hash(row)
+            region_names = region_classifier.classify(*coordinates)
+            if len(region_names) > 1:
+                record_counts['multi_region_hits'] += 1
+            for table_name in region_names:
+                # Each id left in existing_hashes afterwards is a row that has to be deleted.
+                existing_hash = existing_hashes[table_name].pop(record_id, None)
+                if existing_hash is None:
+                    rows_to_insert[table_name].append(row + (record_id, row_hash))
+                elif existing_hash != row_hash:
+                    rows_to_update[table_name].append(row + (row_hash, record_id))
+        # Apply the changes to each region table, taking the old values of changed and removed rows out of the
+        # region summaries and adding the new values.
+        for table_name in region_classifier.region_names:
+            aggregate_delta.remove_rows(table_name, _read_rows_by_id(
+                db_cursor_obj, table_name,
+                [update_row[-1] for update_row in rows_to_update[table_name]] + list(existing_hashes[table_name])))
+            aggregate_delta.add_rows(table_name, [insert_row[:4] for insert_row in rows_to_insert[table_name]])
+            aggregate_delta.add_rows(table_name, [update_row[:4] for update_row in rows_to_update[table_name]])
+            db_cursor_obj.executemany(f'''INSERT INTO {table_name}(name, mass, reclat, reclong, id, content_hash)
+                                         VALUES(?, ?, ?, ?, ?, ?)''', rows_to_insert[table_name])
+            db_cursor_obj.executemany(f'''UPDATE {table_name} SET name = ?, mass = ?, reclat = ?, reclong = ?,
+                                         content_hash = ? WHERE id = ?''', rows_to_update[table_name])
+            db_cursor_obj.executemany(f'''DELETE FROM {table_name} WHERE id = ?''',
+                                      [(removed_id,) for removed_id in existing_hashes[table_name]])
+            refresh_counts['added'] += len(rows_to_insert[table_name])
+            refresh_counts['changed'] += len(rows_to_update[table_name])
+            refresh_counts['removed'] += len(existing_hashes[table_name])
+            increment_counter(f'rows_inserted.{table_name}', len(rows_to_insert[table_name]))
+        aggregate_delta.apply(db_cursor_obj)
+        with stage_timer('commit'):
+            db_connection.commit()
+    except sqlite3.Error as db_error:
+        # If any sqlite exceptions occur, undo the partial refresh and print the error in a formatted message.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        print(f'A database error has occurred: {db_error}')
+        return None
     except TypeError:
         # A typeError occurs if the JSON file is empty. Which can result from not properly
         # doing a GET request on the data.
+        if db_connection.in_transaction:
+            db_connection.rollback()
         print('A TypeError has occurred, your JSON file could be empty! Did you GET request work correctly?')
+        return None
+    except BaseException:
+        # Undo the partial refresh if anything else stops it, such as a page failing to download.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        raise
+    finally:
+        merge_counters(record_counts)
+    merge_counters({f'rows_{change_name}': change_count for change_name, change_count in refresh_counts.items()})
+    print(f'Incremental refresh: {refresh_counts["added"]} rows added, {refresh_counts["changed"]} rows changed, '
+          f'{refresh_counts["removed"]} rows removed.')
+    return refresh_counts
 
 
 def close_database(db_connection, db_cursor_obj):
@@ -364,8 +719,9 @@ def close_database(db_connection, db_cursor_obj):
         sucessful it closes the database and print a message if it hasn't already closed. """
     try:
         # Attempt to commit the database and close the cursor
-        db_connection.commit()
-        db_cursor_obj.close()
+        with stage_timer('close'):
+            db_connection.commit()
+            db_cursor_obj.close()
     except sqlite3.Error as db_error:
         # If any sqlite exceptions occur, print the error in a formatted message.
         print(f'A Database Error has occurred: {db_error}')
@@ -0,0 +1,190 @@
+"""
+This module handles fetching the NASA meteorite dataset one page at a time.
+The Socrata endpoint only returns a limited number of rows per request, so the dataset is walked
+with the $limit and $offset query parameters and the records are yielded one by one as each page arrives.
+Pages can also be downloaded concurrently on a bounded thread pool that shares one pooled requests session,
+with transient errors retried using jittered exponential backoff.
+"""
+from run_metrics import stage_timer, increment_counter
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+NASA_METEORITE_URL = 'https://data.nasa.gov/resource/gh4g-9sfh.json'
+
+# HTTP status codes that are worth retrying, the server may answer the same request on a later attempt.
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class PageDownloadError(Exception):
+    """ This exception is raised when one or more pages of the dataset could not be downloaded.
+        failed_pages maps the offset of each failed page to a message describing why it failed. """
+
+    def __init__(self, failed_pages):
+        self.failed_pages = failed_pages
+        page_messages = '\n'.join(f'  Page at offset {page_offset}: {failure_message}'
+                                  for page_offset, failure_message in sorted(failed_pages.items()))
+        super().__init__(f'{len(failed_pages)} page(s) of the dataset could not be downloaded:\n{page_messages}')
+
+
+def _create_page_params(page_size, page_offset, order_by):
+    """ This function returns the Socrata query parameters for one page of the dataset. """
+    return {'$limit': page_size, '$offset': page_offset, '$order': order_by}
+
+
+def fetch_meteorite_records(dataset_url=NASA_METEORITE_URL, page_size=5000, order_by=':id', response_cache=None,
+                            max_retries=4, backoff_base=0.5, timeout=30):
+    """ This function is a generator that walks the dataset at the specified URL one page at a time and yields
+        each record. Pages are requested with $limit and $offset, ordered by order_by so that the pages don't
+        overlap or skip rows. Only one page is held in memory at a time, so memory use stays the same no matter how
+        many rows the dataset holds. Fetching stops after the first page with fewer than page_size records.
+        Each page is downloaded with _download_page, so transient errors are retried with backoff the same way as
+        fetch_meteorite_records_concurrently. If a page still can't be downloaded or isn't a list of records, a
+        PageDownloadError is raised, so the ingest reading the records is rolled back instead of committing part
+        of the dataset. Pages go through the optional response cache, whose stale entries are evicted at the end. """
+    if page_size < 1:
+        raise ValueError('page_size must be at least 1')
+    session = create_pooled_session(1)
+    page_offset = 0
+    try:
+        while True:
+            page_records = _download_page(session, dataset_url, _create_page_params(page_size, page_offset, order_by),
+                                          max_retries, backoff_base, timeout, response_cache)
+            yield from page_records
+            # A short page means the end of the dataset was reached.
+            if len(page_records) < page_size:
+                return
+            page_offset += page_size
+    finally:
+        session.close()
+        if response_cache is not None:
+            response_cache.evict_stale_entries()
+
+
+def create_pooled_session(pool_size=8):
+    """ This function creates a requests session whose connection pool can keep pool_size connections
+        open to the same host, so concurrent page downloads reuse connections instead of opening new ones. """
+    session = requests.Session()
+    http_adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', http_adapter)
+    session.mount('http://', http_adapter)
+    return session
+
+
+def _get_backoff_seconds(attempt_number, backoff_base, response_obj=None):
+    """ This function returns how long to wait before retrying. The wait is a random amount up to
+        backoff_base * 2 ** attempt_number (full jitter), or the server's numeric Retry-After header if that is longer. """
+    backoff_seconds = random.uniform(0, backoff_base * 2 ** attempt_number)
+    if response_obj is not None:
+        retry_after = response_obj.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            backoff_seconds = max(backoff_seconds, int(retry_after))
+    return backoff_seconds
+
+
+def _download_page(session, dataset_url, page_params, max_retries, backoff_base, timeout, response_cache=None):
+    """ This function downloads one page of the dataset with the shared session and returns its list of records.
+        Connection errors, timeouts, broken responses and transient status codes are retried up to max_retries times
+        with jittered exponential backoff. A PageDownloadError is raised if the page still can't be downloaded.
+        With a response cache the page is fetched with a conditional GET, or only read from the cache in offline mode. """
+    page_offset = page_params['$offset']
+    cache_entry = None
+    request_headers = None
+    if response_cache is not None:
+        cache_entry = response_cache.load_entry(dataset_url, page_params)
+        if response_cache.offline:
+            if cache_entry is None:
+                increment_counter('http_offline_misses')
+                raise PageDownloadError({page_offset: 'the page is not cached and offline mode is on'})
+            increment_counter('http_offline_hits')
+            return response_cache.create_cached_response(cache_entry).json()
+        request_headers = response_cache.get_conditional_headers(cache_entry)
+    attempt_number = 0
+    while True:
+        response_obj = None
+        try:
+            increment_counter('http_requests')
+            with stage_timer('http_get'):
+                response_obj = session.get(dataset_url, params=page_params, headers=request_headers, timeout=timeout)
+            if response_obj.status_code == 304 and cache_entry is not None:
+                # The cached page is still current.
+                increment_counter('http_not_modified')
+                return response_cache.create_cached_response(cache_entry).json()
+            if response_obj.status_code not in TRANSIENT_STATUS_CODES:
+                # Any other error status (such as 404) won't change on a retry.
+                response_obj.raise_for_status()
+                with stage_timer('json_decode'):
+                    page_records = response_obj.json()
+                if not isinstance(page_records, list):
+                    raise PageDownloadError({page_offset: 'the page is not a list of records'})
+                if response_cache is not None:
+                    response_cache.store_response(dataset_url, page_params, response_obj)
+                return page_records
+            failure_message = f'status code {response_obj.status_code}'
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError, requests.exceptions.JSONDecodeError) as request_error:
+            failure_message = str(request_error)
+        except requests.exceptions.RequestException as request_error:
+            increment_counter('http_errors')
+            raise PageDownloadError({page_offset: str(request_error)}) from request_error
+        increment_counter('http_errors')
+        if attempt_number >= max_retries:
+            raise PageDownloadError({page_offset: f'{failure_message} (gave up after {attempt_number + 1} attempts)'})
+        increment_counter('http_retries')
+        time.sleep(_get_backoff_seconds(attempt_number, backoff_base, response_obj))
+        attempt_number += 1
+
+
+def fetch_meteorite_records_concurrently(dataset_url=NASA_METEORITE_URL, page_size=5000, order_by=':id',
+                                         max_workers=4, max_retries=4, backoff_base=0.5, timeout=30,
+                                         response_cache=None):
+    """ This function is a generator that downloads pages of the dataset on a pool of max_workers threads
+        and yields the records in the same order as fetch_meteorite_records. Up to max_workers pages are downloaded
+        ahead of the page being yielded, so fetch time scales with the number of workers instead of the latency of
+        each request, while memory stays bounded to that many pages. All threads share one pooled session.
+        If any page fails after its retries, the pages still downloading are waited on and a PageDownloadError
+        listing every failed page is raised. Pages go through the optional response cache, whose stale entries
+        are evicted once the download finishes. """
+    if page_size < 1:
+        raise ValueError('page_size must be at least 1')
+    if max_workers < 1:
+        raise ValueError('max_workers must be at least 1')
+    session = create_pooled_session(max_workers)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    # Each pending page is an (offset, future) tuple, kept in offset order.
+    pending_pages = collections.deque()
+    next_offset = 0
+    try:
+        while True:
+            # Keep max_workers pages downloading ahead of the page being yielded.
+            while len(pending_pages) < max_workers:
+                page_params = _create_page_params(page_size, next_offset, order_by)
+                pending_pages.append((next_offset, executor.submit(_download_page, session, dataset_url, page_params,
+                                                                   max_retries, backoff_base, timeout,
+                                                                   response_cache)))
+                next_offset += page_size
+            page_offset, page_future = pending_pages.popleft()
+            try:
+                page_records = page_future.result()
+            except PageDownloadError as page_error:
+                # Wait for the other pages so every failed page can be reported together.
+                failed_pages = dict(page_error.failed_pages)
+                for other_offset, other_future in pending_pages:
+                    try:
+                        other_future.result()
+                    except PageDownloadError as other_error:
+                        failed_pages.update(other_error.failed_pages)
+                raise PageDownloadError(failed_pages) from page_error
+            print(f'Downloaded page at offset {page_offset} with {len(page_records)} records.')
+            yield from page_records
+            # A short page means the end of the dataset was reached, the pages after it aren't needed.
+            if len(page_records) < page_size:
+                return
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        session.close()
+        if response_cache is not None:
+            response_cache.evict_stale_entries()
@@ -0,0 +1,190 @@
+"""
+This module handles reading meteorite records from local files instead of the NASA URL.
+JSON arrays, NDJSON (one JSON record per line), gzip compressed NDJSON or JSON and the NASA CSV export are supported.
+Every reader is a generator that yields one record dictionary at a time, in the same shape as the records from the
+NASA endpoint. Plain files are read through a read-only memory map, so a large archive is never read into memory
+all at once.
+"""
+import codecs
+import csv
+import gzip
+import json
+import mmap
+import os
+
+# The number of bytes decoded at a time when reading a JSON array.
+READ_CHUNK_SIZE = 1024 * 1024
+# The file extensions read_records_from_file() knows how to read.
+SUPPORTED_INPUT_EXTENSIONS = ('.json', '.ndjson', '.jsonl', '.gz', '.csv')
+
+
+def _read_mapped_chunks(file_path):
+    """ This function is a generator that memory maps a file and yields it in READ_CHUNK_SIZE byte chunks. """
+    # An empty file can't be memory mapped.
+    if os.path.getsize(file_path) == 0:
+        return
+    with open(file_path, 'rb') as input_file, \
+            mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+        for chunk_start in range(0, len(mapped_file), READ_CHUNK_SIZE):
+            yield mapped_file[chunk_start:chunk_start + READ_CHUNK_SIZE]
+
+
+def _read_mapped_lines(file_path):
+    """ This function is a generator that memory maps a file and yields each of its lines as bytes. """
+    if os.path.getsize(file_path) == 0:
+        return
+    with open(file_path, 'rb') as input_file, \
+            mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+        yield from iter(mapped_file.readline, b'')
+
+
+# The characters that can continue a JSON number, such as the fraction or exponent of 1.5e-3.
+_NUMBER_CHARACTERS = frozenset('0123456789.eE+-')
+
+
+def _is_cut_off(json_error, text_buffer):
+    """ This function returns True if a JSON decode error was caused by the text buffer ending in the middle of an
+        item, so decoding it again once the next chunk is added can succeed. That is the case when the error is at
+        the end of the buffer, within the length of the longest literal or escape, or when a string runs to the end
+        of the buffer. """
+    return json_error.msg.startswith('Unterminated string') or len(text_buffer) - json_error.pos <= 6
+
+
+def _may_continue(json_item, item_end, text_buffer):
+    """ This function returns True if an item decoded from the text buffer could still be part of a longer item
+        once the next chunk is added. That is the case when it ends exactly at the end of the buffer, or when it is a
+        number followed only by characters that could continue it, such as the '.' of a fraction that was cut off. """
+    if item_end == len(text_buffer):
+        return True
+    return isinstance(json_item, (int, float)) and not isinstance(json_item, bool) \
+        and _NUMBER_CHARACTERS.issuperset(text_buffer[item_end:])
+
+
+def _parse_json_array(byte_chunks, file_path):
+    """ This function is a generator that yields each item of a JSON array read from chunks of UTF-8 bytes.
+        Only the item being decoded and the rest of the current chunk are held in memory.
+        A ValueError is raised if the data isn't a JSON array, ends before the array does, or with the character
+        offset of the first item or separator that isn't valid JSON. """
+    json_decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    text_buffer = ''
+    # The number of characters read before the start of the text buffer, used for the offset in error messages.
+    buffer_offset = 0
+    array_started = False
+    # After the opening bracket or a comma an item is expected, after an item a comma or the closing bracket.
+    expecting_item = True
+    item_count = 0
+    byte_chunks = iter(byte_chunks)
+    last_chunk = False
+    while not last_chunk:
+        byte_chunk = next(byte_chunks, None)
+        last_chunk = byte_chunk is None
+        text_buffer += text_decoder.decode(byte_chunk or b'', final=last_chunk)
+        buffer_position = 0
+        while True:
+            # Skip the whitespace between items and separators.
+            while buffer_position < len(text_buffer) and text_buffer[buffer_position] in ' \t\r\n':
+                buffer_position += 1
+            if buffer_position == len(text_buffer):
+                break
+            next_character = text_buffer[buffer_position]
+            if not array_started:
+                if next_character != '[':
+                    raise ValueError(f'{file_path} does not contain a JSON array.')
+                array_started = True
+                buffer_position += 1
+            elif not expecting_item:
+                if next_character == ']':
+                    return
+                if next_character != ',':
+                    raise ValueError(f'{file_path} has invalid JSON at character {buffer_offset + buffer_position}: '
+                                     f'Expecting \',\' delimiter')
+                expecting_item = True
+                buffer_position += 1
+            elif next_character == ']' and item_count == 0:
+                # An empty array.
+                return
+            else:
+                try:
+                    json_item, item_end = json_decoder.raw_decode(text_buffer, buffer_position)
+                except json.JSONDecodeError as json_error:
+                    if not last_chunk and _is_cut_off(json_error, text_buffer):
+                        # The item continues in the next chunk.
+                        break
+                    raise ValueError(f'{file_path} has invalid JSON at character {buffer_offset + json_error.pos}: '
+                                     f'{json_error.msg}') from json_error
+                if not last_chunk and _may_continue(json_item, item_end, text_buffer):
+                    break
+                buffer_position = item_end
+                expecting_item = False
+                item_count += 1
+                yield json_item
+        buffer_offset += buffer_position
+        text_buffer = text_buffer[buffer_position:]
+    raise ValueError(f'{file_path} ended before the end of its JSON array.')
+
+
+def _parse_ndjson_lines(byte_lines):
+    """ This function is a generator that yields the JSON record on each line, skipping blank lines. """
+    for byte_line in byte_lines:
+        byte_line = byte_line.strip()
+        if byte_line:
+            yield json.loads(byte_line)
+
+
+def read_json_file(file_path):
+    """ This function is a generator that yields each record of a file holding one JSON array of records,
+        such as a saved response from the NASA endpoint. """
+    yield from _parse_json_array(_read_mapped_chunks(file_path), file_path)
+
+
+def read_ndjson_file(file_path):
+    """ This function is a generator that yields each record of an NDJSON file, which holds one JSON record
+        per line. """
+    yield from _parse_ndjson_lines(_read_mapped_lines(file_path))
+
+
+def read_gzip_json_file(file_path):
+    """ This function is a generator that yields each record of a gzip compressed NDJSON or JSON array file.
+        The file is decompressed as it is read, its first character decides if it is read as a JSON array. """
+    with gzip.open(file_path, 'rb') as input_file:
+        if input_file.peek(READ_CHUNK_SIZE).lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'['):
+            yield from _parse_json_array(iter(lambda: input_file.read(READ_CHUNK_SIZE), b''), file_path)
+        else:
+            yield from _parse_ndjson_lines(input_file)
+
+
+def _normalize_csv_header(header_name):
+    """ This function converts a NASA CSV column header to the matching JSON field name,
+        for example 'mass (g)' becomes 'mass' and 'GeoLocation' becomes 'geolocation'. """
+    return header_name.split('(')[0].strip().lower()
+
+
+def read_csv_file(file_path):
+    """ This function is a generator that yields each row of a NASA CSV export as a record dictionary with the same
+        field names as the JSON records. All values stay strings, like the JSON records, and empty values are left
+        out of the record so they count as missing. """
+    csv_lines = (byte_line.decode('utf-8-sig') for byte_line in _read_mapped_lines(file_path))
+    csv_reader = csv.reader(csv_lines)
+    header_row = next(csv_reader, None)
+    if header_row is None:
+        return
+    field_names = [_normalize_csv_header(header_name) for header_name in header_row]
+    for csv_row in csv_reader:
+        yield {field_name: field_value for field_name, field_value in zip(field_names, csv_row) if field_value != ''}
+
+
+def read_records_from_file(file_path):
+    """ This function returns a record generator for a local file, chosen by its extension.
+        .json files are read as a JSON array, .ndjson and .jsonl files as NDJSON, .gz files as gzip compressed
+        NDJSON or JSON and .csv files as a NASA CSV export. A ValueError is raised for any other extension. """
+    lower_path = file_path.lower()
+    if lower_path.endswith('.gz'):
+        return read_gzip_json_file(file_path)
+    if lower_path.endswith('.json'):
+        return read_json_file(file_path)
+    if lower_path.endswith(('.ndjson', '.jsonl')):
+        return read_ndjson_file(file_path)
+    if lower_path.endswith('.csv'):
+        return read_csv_file(file_path)
+    raise ValueError(f'Unsupported input file type: {file_path}. Use one of {", ".join(SUPPORTED_INPUT_EXTENSIONS)}')
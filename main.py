@@ -1,18 +1,129 @@
 from database_functions import *
+import argparse
+import os
+from dataset_fetcher import fetch_meteorite_records_concurrently, PageDownloadError, NASA_METEORITE_URL
+from response_cache import ResponseCache, DEFAULT_CACHE_DIR
+from normalized_schema import create_normalized_schema, add_meteorites_to_normalized_tables
+from file_input_adapters import read_records_from_file, SUPPORTED_INPUT_EXTENSIONS
+from parallel_ingest import add_meteorites_to_tables_in_parallel
+from async_pipeline import run_ingest_pipeline
+from run_metrics import start_run_metrics, finish_run_metrics, write_run_report
+from region_snapshots import export_region_snapshots
+from staged_refresh import refresh_region_tables_staged
 
 
-def main():
+def _parse_arguments(argv):
+    """ This function parses the command line arguments and returns them. """
+    argument_parser = argparse.ArgumentParser(description='Sort the NASA meteorite data set into region tables.')
+    source_group = argument_parser.add_mutually_exclusive_group()
+    source_group.add_argument('--url', default=NASA_METEORITE_URL,
+                              help='URL of the dataset to download (default: the NASA meteorite landings dataset)')
+    source_group.add_argument('--input-file',
+                              help='read the records from a local .json, .ndjson, .jsonl, .gz or .csv file '
+                                   'instead of downloading them')
+    argument_parser.add_argument('--cache-dir',
+                                 help=f'directory of the cached dataset pages (default: {DEFAULT_CACHE_DIR})')
+    argument_parser.add_argument('--offline', action='store_true',
+                                 help='only read the dataset pages from the cache, never from the network')
+    argument_parser.add_argument('--refresh-mode', choices=('full', 'incremental', 'staged'), default='full',
+                                 help='full deletes and reloads every region table, incremental only applies '
+                                      'the rows that were added, changed or removed since the last run, staged '
+                                      'loads a staging database and swaps it into the region tables in one '
+                                      'transaction')
+    argument_parser.add_argument('--schema', choices=('regions', 'normalized'), default='regions',
+                                 help='regions stores one table per region, normalized stores every meteorite once '
+                                      'with typed columns and keeps views named after the region tables')
+    argument_parser.add_argument('--workers', type=int,
+                                 help='classify the records on this many processes, each writing to its own '
+                                      'staging file that is merged into the region tables at the end')
+    argument_parser.add_argument('--pipelined', action='store_true',
+                                 help='download, decode, classify and write the pages at the same time, '
+                                      'joined by bounded queues')
+    argument_parser.add_argument('--metrics-report',
+                                 help='write the stage times and record counters of the run to this file, as JSON '
+                                      'or in the Prometheus text format if it ends with .prom')
+    argument_parser.add_argument('--profile', action='store_true',
+                                 help='profile the run with cProfile and add the slowest functions to the report')
+    argument_parser.add_argument('--trace-memory', action='store_true',
+                                 help='trace memory with tracemalloc and add the largest allocations to the report')
+    argument_parser.add_argument('--snapshot-dir',
+                                 help='after the ingest, export each region as a columnar binary snapshot file '
+                                      'in this directory')
+    arguments = argument_parser.parse_args(argv)
+    if (arguments.profile or arguments.trace_memory) and arguments.metrics_report is None:
+        argument_parser.error('--profile and --trace-memory need a --metrics-report file')
+    if arguments.workers is not None:
+        if arguments.workers < 1:
+            argument_parser.error('--workers must be at least 1')
+        if arguments.schema != 'regions' or arguments.refresh_mode != 'full':
+            argument_parser.error('--workers only supports the regions schema with --refresh-mode full')
+    if arguments.schema == 'normalized' and arguments.refresh_mode != 'full':
+        argument_parser.error('the normalized schema only supports --refresh-mode full')
+    if arguments.pipelined:
+        if arguments.input_file is not None or arguments.workers is not None:
+            argument_parser.error('--pipelined downloads the dataset itself and can\'t be used with --input-file '
+                                  'or --workers')
+        if arguments.schema != 'regions' or arguments.refresh_mode != 'full':
+            argument_parser.error('--pipelined only supports the regions schema with --refresh-mode full')
+    if arguments.input_file is not None:
+        if arguments.offline or arguments.cache_dir is not None:
+            argument_parser.error('--offline and --cache-dir only apply to downloading, not to --input-file')
+        if not os.path.isfile(arguments.input_file):
+            argument_parser.error(f'the input file {arguments.input_file} does not exist')
+        if not arguments.input_file.lower().endswith(SUPPORTED_INPUT_EXTENSIONS):
+            argument_parser.error(f'the input file must end with one of {", ".join(SUPPORTED_INPUT_EXTENSIONS)}')
+    return arguments
+
+
+def main(argv=None):
     """ This function call the necessary functions from the database_functions module
-        that are required for the program to fully run, each object(response, json, connection,
+        that are required for the program to fully run, each object(record generator, connection,
         cursor) is assigned to a variable, so it can easily use as parameters
         for calling future functions."""
-    response_obj = issue_get_request('https://data.nasa.gov/resource/gh4g-9sfh.json')
-    json_obj = convert_content_to_json(response_obj)
+    arguments = _parse_arguments(argv)
+    start_run_metrics(profile=arguments.profile, trace_memory=arguments.trace_memory)
+    response_cache = None
+    json_obj = None
+    if arguments.input_file is not None:
+        # The records are read from the local file one at a time while they are being added to the tables.
+        json_obj = read_records_from_file(arguments.input_file)
+    else:
+        # The records are fetched several pages at a time while they are being added to the tables.
+        # Pages that haven't changed since the last run are served from the response cache.
+        # In offline mode only the cached pages are read, a page missing from the cache fails the download.
+        response_cache = ResponseCache(arguments.cache_dir or DEFAULT_CACHE_DIR, offline=arguments.offline)
+        if not arguments.pipelined:
+            json_obj = fetch_meteorite_records_concurrently(arguments.url, response_cache=response_cache)
     db_connection = connect_to_database()
     db_cursor_obj = create_cursor_obj(db_connection)
-    create_all_region_tables(db_cursor_obj)
-    add_meteorites_to_tables(db_cursor_obj, json_obj)
+    try:
+        if arguments.schema == 'normalized':
+            create_normalized_schema(db_cursor_obj)
+            # The normalized ingest also rebuilds the R*Tree spatial index in its transaction.
+            add_meteorites_to_normalized_tables(db_connection, db_cursor_obj, json_obj)
+        elif arguments.refresh_mode == 'incremental':
+            refresh_region_tables_incrementally(db_connection, db_cursor_obj, json_obj)
+        elif arguments.refresh_mode == 'staged':
+            refresh_region_tables_staged(db_connection, json_obj)
+        elif arguments.pipelined:
+            # The pipeline fetches the pages itself and writes them through its own connection.
+            run_ingest_pipeline(arguments.url, response_cache=response_cache)
+        elif arguments.workers is not None:
+            create_all_region_tables(db_cursor_obj)
+            add_meteorites_to_tables_in_parallel(db_connection, db_cursor_obj, json_obj, arguments.workers)
+        else:
+            create_all_region_tables(db_cursor_obj)
+            add_meteorites_to_tables_vectorized(db_connection, db_cursor_obj, json_obj)
+        if arguments.snapshot_dir is not None:
+            export_region_snapshots(db_connection, arguments.snapshot_dir)
+    except PageDownloadError as download_error:
+        # The ingest was rolled back, so the tables are left as they were before it started.
+        print(f'An error has occurred while downloading the dataset.\n{download_error}')
     close_database(db_connection, db_cursor_obj)
+    run_report = finish_run_metrics()
+    if arguments.metrics_report is not None:
+        write_run_report(run_report, arguments.metrics_report)
+        print(f'Run metrics written to {arguments.metrics_report}.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+"""
+This module handles region and spatial queries on the normalized meteorite database.
+An R*Tree virtual table over the meteorite coordinates is rebuilt after each ingest, and is used for
+bounding box searches, distance searches and nearest neighbour searches. Every query function is a generator,
+so the results are streamed from sqlite instead of being loaded into a list first.
+Each meteorite is returned as a (meteorite_id, id, name, mass, reclat, reclong) tuple.
+"""
+from region_classifier import split_bounding_box
+import heapq
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+# Half of the earth's circumference, no two points are further apart than this.
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM
+
+_METEORITE_COLUMNS = 'meteorites.meteorite_id, meteorites.id, meteorites.name, meteorites.mass, ' \
+                     'meteorites.reclat, meteorites.reclong'
+
+
+def create_spatial_index(db_connection):
+    """ This function creates the meteorite_rtree R*Tree table over the coordinates of the meteorites table, filled
+        with the meteorites already stored. The normalized schema must already exist.
+        add_meteorites_to_normalized_tables rebuilds the R*Tree in the same transaction as each ingest, so this is
+        only needed for a database that was loaded before the R*Tree existed. """
+    with db_connection:
+        rebuild_spatial_index(db_connection.cursor())
+
+
+def rebuild_spatial_index(db_cursor_obj):
+    """ This function drops and recreates the meteorite_rtree table from the coordinates of every meteorite.
+        Dropping the table is much faster than deleting its rows, and rebuilding it once after an ingest is much
+        faster than keeping it up to date row by row with triggers. """
+    db_cursor_obj.execute('''DROP TABLE IF EXISTS meteorite_rtree''')
+    db_cursor_obj.execute('''CREATE VIRTUAL TABLE meteorite_rtree USING rtree(
+                            meteorite_id, min_lat, max_lat, min_long, max_long)''')
+    db_cursor_obj.execute('''INSERT INTO meteorite_rtree
+                            SELECT meteorite_id, reclat, reclat, reclong, reclong FROM meteorites
+                            WHERE reclat IS NOT NULL AND reclong IS NOT NULL''')
+
+
+def calculate_distance_km(lat_a, long_a, lat_b, long_b):
+    """ This function returns the great-circle distance in kilometres between two coordinates
+        using the haversine formula. """
+    lat_a_radians = math.radians(lat_a)
+    lat_b_radians = math.radians(lat_b)
+    half_lat_change = math.sin((lat_b_radians - lat_a_radians) / 2)
+    half_long_change = math.sin(math.radians(long_b - long_a) / 2)
+    haversine_value = half_lat_change ** 2 + \
+        math.cos(lat_a_radians) * math.cos(lat_b_radians) * half_long_change ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(haversine_value)))
+
+
+def search_bounding_box(db_connection, left, bottom, right, top):
+    """ This function is a generator that yields every meteorite whose coordinates fall inside the bounding box
+        (left - long min, bottom - lat min, right - long max, top - lat max). Boxes that cross the antimeridian are
+        searched on both sides of it. The R*Tree finds the candidates and the exact coordinates are checked after,
+        as the R*Tree only stores 32-bit values. """
+    for segment_left, segment_bottom, segment_right, segment_top in split_bounding_box((left, bottom, right, top)):
+        yield from db_connection.execute(f'''SELECT {_METEORITE_COLUMNS} FROM meteorite_rtree
+                                            JOIN meteorites ON meteorites.meteorite_id = meteorite_rtree.meteorite_id
+                                            WHERE meteorite_rtree.max_long >= ? AND meteorite_rtree.min_long <= ?
+                                            AND meteorite_rtree.max_lat >= ? AND meteorite_rtree.min_lat <= ?
+                                            AND meteorites.reclong BETWEEN ? AND ?
+                                            AND meteorites.reclat BETWEEN ? AND ?''',
+                                         (segment_left, segment_right, segment_bottom, segment_top,
+                                          segment_left, segment_right, segment_bottom, segment_top))
+
+
+def _get_search_box(lat_value, long_value, radius_km):
+    """ This function returns the smallest bounding box that contains every point within radius_km of the
+        coordinates. When the circle reaches a pole the box covers every longitude. """
+    angular_radius = radius_km / EARTH_RADIUS_KM
+    lat_change = math.degrees(angular_radius)
+    bottom = lat_value - lat_change
+    top = lat_value + lat_change
+    if bottom <= -90 or top >= 90:
+        return -180, max(bottom, -90), 180, min(top, 90)
+    # The widest longitude range of a circle on a sphere, see "Finding Points Within a Distance of a
+    # Latitude/Longitude Using Bounding Coordinates" by Jan Philip Matuschek.
+    long_change = math.degrees(math.asin(min(1.0, math.sin(angular_radius) / math.cos(math.radians(lat_value)))))
+    return long_value - long_change, bottom, long_value + long_change, top
+
+
+def find_meteorites_within_distance(db_connection, lat_value, long_value, radius_km):
+    """ This function is a generator that yields a (distance in km, meteorite) tuple for every meteorite within
+        radius_km of the coordinates, in no particular order. The R*Tree narrows the search to the bounding box of
+        the circle and the great-circle distance of each candidate is then checked. """
+    for meteorite_row in search_bounding_box(db_connection, *_get_search_box(lat_value, long_value, radius_km)):
+        distance_km = calculate_distance_km(lat_value, long_value, meteorite_row[4], meteorite_row[5])
+        if distance_km <= radius_km:
+            yield distance_km, meteorite_row
+
+
+def find_nearest_meteorites(db_connection, lat_value, long_value, neighbour_count, start_radius_km=50):
+    """ This function is a generator that yields the neighbour_count nearest meteorites to the coordinates as
+        (distance in km, meteorite) tuples, nearest first. The search radius starts at start_radius_km and doubles
+        until it holds enough meteorites, so only the R*Tree entries near the point are read. """
+    if neighbour_count < 1:
+        return
+    radius_km = start_radius_km
+    while True:
+        nearest_rows = heapq.nsmallest(neighbour_count,
+                                       find_meteorites_within_distance(db_connection, lat_value, long_value, radius_km),
+                                       key=lambda distance_row: distance_row[0])
+        # Every meteorite outside the radius is further away than the ones found inside it.
+        if len(nearest_rows) == neighbour_count or radius_km >= MAX_DISTANCE_KM:
+            yield from nearest_rows
+            return
+        radius_km = min(radius_km * 2, MAX_DISTANCE_KM)
+
+
+def top_meteorites_by_mass(db_connection, region_name, meteorite_count):
+    """ This function is a generator that yields the meteorite_count heaviest meteorites of a region, heaviest
+        first. Meteorites without a mass are left out. The mass index is read from the heaviest meteorite down and
+        each meteorite's region membership is looked up by primary key, so the search stops after
+        meteorite_count matches instead of sorting the whole region. """
+    yield from db_connection.execute(f'''SELECT {_METEORITE_COLUMNS} FROM meteorites
+                                        WHERE meteorites.mass IS NOT NULL AND EXISTS(
+                                            SELECT 1 FROM region_membership
+                                            WHERE region_membership.meteorite_id = meteorites.meteorite_id
+                                            AND region_membership.region_id =
+                                                (SELECT region_id FROM regions WHERE name = ?))
+                                        ORDER BY meteorites.mass DESC LIMIT ?''', (region_name, meteorite_count))
+
+
+def top_meteorites_by_mass_per_region(db_connection, meteorite_count):
+    """ This function is a generator that yields a (region name, list of meteorites) tuple for each region,
+        holding the meteorite_count heaviest meteorites of that region. """
+    region_names = [region_row[0] for region_row in
+                    db_connection.execute('''SELECT name FROM regions ORDER BY region_id''')]
+    for region_name in region_names:
+        yield region_name, list(top_meteorites_by_mass(db_connection, region_name, meteorite_count))
@@ -0,0 +1,194 @@
+"""
+This module handles the normalized version of the meteorite database.
+Every meteor is stored once in a meteorites table with REAL mass, reclat and reclong columns,
+and the regions it fell in are stored in a compact region_membership table. Views named after the
+old region tables (such as Europe_Meteorites) keep existing queries working.
+"""
+from database_functions import create_region_classifier, get_record_coordinates, _create_record_counts, \
+    _get_skip_reason
+from meteorite_queries import rebuild_spatial_index
+from region_aggregates import AggregateDelta, create_aggregate_tables, clear_region_aggregates
+from run_metrics import stage_timer, merge_counters
+from utility_functions import convert_string_to_numerical
+import sqlite3
+
+
+def _convert_to_real(in_value):
+    """ This function converts a dataset value to a float, or returns None if it is missing or not a number. """
+    if in_value is None:
+        return None
+    numerical_value = convert_string_to_numerical(in_value)
+    return float(numerical_value) if numerical_value is not None else None
+
+
+def _get_meteorite_row(meteorite_id, record, coordinates):
+    """ This function returns the values of a record in the column order of the meteorites table.
+        coordinates is the (lat, long) tuple from get_record_coordinates, or None if the record has none. """
+    lat_value, long_value = coordinates if coordinates is not None else (None, None)
+    return (meteorite_id,
+            record.get('id', None),
+            record.get('name', None),
+            record.get('nametype', None),
+            record.get('recclass', None),
+            _convert_to_real(record.get('mass', None)),
+            record.get('fall', None),
+            record.get('year', None),
+            float(lat_value) if lat_value is not None else None,
+            float(long_value) if long_value is not None else None)
+
+
+def _drop_schema_object(db_cursor_obj, object_name):
+    """ This function drops the table or view with the specified name if it exists. """
+    db_cursor_obj.execute('''SELECT type FROM sqlite_master WHERE name = ? AND type IN ('table', 'view')''',
+                          (object_name,))
+    object_row = db_cursor_obj.fetchone()
+    if object_row is not None:
+        db_cursor_obj.execute(f'''DROP {object_row[0].upper()} {object_name}''')
+
+
+def create_normalized_schema(db_cursor_obj, region_classifier=None):
+    """ This function attempts to create the normalized tables, their indexes and a compatibility view
+        for each region with the specified cursor object as a parameter. A region table left by the
+        regions schema is dropped and replaced by its view. The region summary tables are created too.
+        If any sqlite exceptions occur, it will print an error. """
+    if region_classifier is None:
+        region_classifier = create_region_classifier()
+    try:
+        # meteorite_id is the rowid of the table, the dataset's own id is kept in the id column.
+        db_cursor_obj.execute('''CREATE TABLE IF NOT EXISTS meteorites(
+                                meteorite_id INTEGER PRIMARY KEY,
+                                id TEXT UNIQUE,
+                                name TEXT,
+                                nametype TEXT,
+                                recclass TEXT,
+                                mass REAL,
+                                fall TEXT,
+                                year TEXT,
+                                reclat REAL,
+                                reclong REAL);''')
+        db_cursor_obj.execute('''CREATE TABLE IF NOT EXISTS regions(
+                                region_id INTEGER PRIMARY KEY,
+                                name TEXT UNIQUE NOT NULL);''')
+        # WITHOUT ROWID stores each membership as just its primary key.
+        db_cursor_obj.execute('''CREATE TABLE IF NOT EXISTS region_membership(
+                                region_id INTEGER NOT NULL,
+                                meteorite_id INTEGER NOT NULL,
+                                PRIMARY KEY(region_id, meteorite_id)) WITHOUT ROWID;''')
+        db_cursor_obj.execute('''CREATE INDEX IF NOT EXISTS meteorites_coordinates_index
+                                ON meteorites(reclat, reclong)''')
+        db_cursor_obj.execute('''CREATE INDEX IF NOT EXISTS meteorites_mass_index ON meteorites(mass)''')
+        db_cursor_obj.execute('''CREATE INDEX IF NOT EXISTS region_membership_meteorite_index
+                                ON region_membership(meteorite_id)''')
+        for region_name in region_classifier.region_names:
+            # Replace the old region table (or an older view) with a view over the normalized tables.
+            _drop_schema_object(db_cursor_obj, region_name)
+            db_cursor_obj.execute(f'''CREATE VIEW {region_name} AS
+                                    SELECT meteorites.name, meteorites.mass, meteorites.reclat, meteorites.reclong
+                                    FROM region_membership
+                                    JOIN meteorites ON meteorites.meteorite_id = region_membership.meteorite_id
+                                    WHERE region_membership.region_id =
+                                        (SELECT region_id FROM regions WHERE name = '{region_name}')''')
+        create_aggregate_tables(db_cursor_obj, region_classifier.region_names)
+    except sqlite3.Error as db_error:
+        # If any sqlite exceptions occur, print the error in a formatted message.
+        print(f'A database error has occurred: {db_error}')
+
+
+def _flush_normalized_rows(db_cursor_obj, meteorite_rows, membership_rows):
+    """ This function writes the buffered meteorite and membership rows and empties both buffers. """
+    with stage_timer('insert'):
+        db_cursor_obj.executemany('''INSERT INTO meteorites(meteorite_id, id, name, nametype, recclass, mass, fall,
+                                     year, reclat, reclong) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', meteorite_rows)
+        db_cursor_obj.executemany('''INSERT INTO region_membership(region_id, meteorite_id) VALUES(?, ?)''',
+                                  membership_rows)
+    meteorite_rows.clear()
+    membership_rows.clear()
+
+
+def add_meteorites_to_normalized_tables(db_connection, db_cursor_obj, json_data_obj, batch_size=5000,
+                                        region_classifier=None):
+    """ This function replaces the contents of the normalized tables with the meteors from the JSON data object.
+        Every meteor is stored once in the meteorites table, including meteors without coordinates, and a
+        region_membership row is added for each region it falls in. Only the first meteor with a given id is kept.
+        Rows are written with executemany in batches of batch_size inside one transaction, and the region summaries
+        and the meteorite_rtree spatial index are rebuilt from the new rows in the same transaction.
+        The records are counted in the run metrics like the other ingests, with each region membership counted as a
+        row inserted into that region. The function returns the number of meteorites stored, or None if an error
+        occurred. """
+    if batch_size < 1:
+        raise ValueError('batch_size must be at least 1')
+    if region_classifier is None:
+        region_classifier = create_region_classifier()
+    region_ids = {region_name: region_id
+                  for region_id, region_name in enumerate(region_classifier.region_names, start=1)}
+    meteorite_rows = []
+    membership_rows = []
+    aggregate_delta = AggregateDelta()
+    record_counts = _create_record_counts()
+    seen_ids = set()
+    meteorite_count = 0
+    try:
+        if not db_connection.in_transaction:
+            db_cursor_obj.execute('BEGIN')
+        db_cursor_obj.execute('''DELETE FROM region_membership''')
+        db_cursor_obj.execute('''DELETE FROM meteorites''')
+        db_cursor_obj.execute('''DELETE FROM regions''')
+        clear_region_aggregates(db_cursor_obj, region_classifier.region_names)
+        db_cursor_obj.executemany('''INSERT INTO regions(region_id, name) VALUES(?, ?)''',
+                                  [(region_id, region_name) for region_name, region_id in region_ids.items()])
+        for record in json_data_obj:
+            record_counts['records_seen'] += 1
+            record_id = record.get('id', None)
+            if record_id is not None:
+                if record_id in seen_ids:
+                    continue
+                seen_ids.add(record_id)
+            # The meteorite ids are assigned here, so the membership rows can refer to them without a lookup.
+            meteorite_count += 1
+            coordinates = get_record_coordinates(record)
+            meteorite_row = _get_meteorite_row(meteorite_count, record, coordinates)
+            meteorite_rows.append(meteorite_row)
+            if coordinates is None:
+                record_counts[_get_skip_reason(record)] += 1
+            else:
+                # The summaries count the same (name, mass, reclat, reclong) values the region views show.
+                summary_row = (meteorite_row[2], meteorite_row[5], meteorite_row[8], meteorite_row[9])
+                region_names = region_classifier.classify(*coordinates)
+                if len(region_names) > 1:
+                    record_counts['multi_region_hits'] += 1
+                for region_name in region_names:
+                    membership_rows.append((region_ids[region_name], meteorite_count))
+                    aggregate_delta.add_rows(region_name, (summary_row,))
+                    counter_name = f'rows_inserted.{region_name}'
+                    record_counts[counter_name] = record_counts.get(counter_name, 0) + 1
+            if len(meteorite_rows) >= batch_size:
+                _flush_normalized_rows(db_cursor_obj, meteorite_rows, membership_rows)
+        _flush_normalized_rows(db_cursor_obj, meteorite_rows, membership_rows)
+        aggregate_delta.apply(db_cursor_obj)
+        # Build the R*Tree of meteorite_queries over the new rows, in the same transaction.
+        with stage_timer('spatial_index'):
+            rebuild_spatial_index(db_cursor_obj)
+        with stage_timer('commit'):
+            db_connection.commit()
+    except sqlite3.Error as db_error:
+        # If any sqlite exceptions occur, undo the partial ingest and print the error in a formatted message.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        print(f'A database error has occurred: {db_error}')
+        return None
+    except TypeError:
+        # A typeError occurs if the JSON file is empty. Which can result from not properly
+        # doing a GET request on the data.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        print('A TypeError has occurred, your JSON file could be empty! Did you GET request work correctly?')
+        return None
+    except BaseException:
+        # Undo the partial ingest if anything else stops it, such as a page failing to download.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        raise
+    finally:
+        merge_counters(record_counts)
+    print(f'Normalized ingest stored {meteorite_count} meteorites.')
+    return meteorite_count
@@ -0,0 +1,189 @@
+"""
+This module handles ingesting very large datasets on several processes at once.
+The records are split into chunks and the name, mass, reclat and reclong columns of each chunk are classified on a
+process pool. Every worker process writes its
+rows into its own staging sqlite file, and once all chunks are done the staging files are attached to the main
+database and copied into the region tables with INSERT ... SELECT in one transaction.
+"""
+from database_functions import create_all_region_tables, create_region_classifier, get_record_columns, \
+    group_columns_by_region
+from run_metrics import stage_timer, increment_counter, take_counters, merge_counters, take_stage_times, \
+    merge_stage_times
+from region_aggregates import AggregateDelta
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import itertools
+import os
+import sqlite3
+import tempfile
+import time
+
+# The state of a worker process, set up once by _initialize_worker().
+_worker_state = {}
+
+
+def _initialize_worker(staging_dir, region_classifier):
+    """ This function runs once in each worker process. It creates the worker's staging database with an empty table
+        for every region and keeps the region classifier used for its chunks. """
+    # A forked worker starts with a copy of the parent's counters and stage times, throw them away so only the
+    # worker's own work is sent back and nothing is counted twice.
+    take_counters()
+    take_stage_times()
+    staging_path = os.path.join(staging_dir, f'staging_{os.getpid()}.db')
+    staging_connection = sqlite3.connect(staging_path)
+    # The staging file is thrown away if anything fails, so it doesn't need to survive a crash.
+    staging_connection.execute('PRAGMA synchronous = OFF')
+    create_all_region_tables(staging_connection.cursor(), region_classifier.region_names, clear_existing=False)
+    staging_connection.commit()
+    _worker_state['staging_path'] = staging_path
+    _worker_state['connection'] = staging_connection
+    _worker_state['classifier'] = region_classifier
+
+
+def _ingest_chunk(record_columns):
+    """ This function classifies a chunk of records, sent as the columns of get_record_columns, in a worker process
+        and writes the rows of each region into the worker's staging database. It returns the path of the staging
+        database, the number of rows written, the record counters and stage times of the chunk, as the run metrics
+        of a worker process aren't seen by the main process, and the chunk's change to the region summaries, so the
+        summaries are also worked out in parallel. """
+    staging_connection = _worker_state['connection']
+    region_classifier = _worker_state['classifier']
+    aggregate_delta = AggregateDelta()
+    row_count = 0
+    with staging_connection:
+        for table_name, rows in group_columns_by_region(record_columns, region_classifier).items():
+            staging_connection.executemany(f'''INSERT INTO {table_name}(name, mass, reclat, reclong)
+                                               VALUES(?, ?, ?, ?)''', rows)
+            aggregate_delta.add_rows(table_name, rows)
+            row_count += len(rows)
+    return _worker_state['staging_path'], row_count, take_counters(), take_stage_times(), aggregate_delta
+
+
+def _collect_chunk_result(chunk_future, staging_paths, aggregate_delta):
+    """ This function adds the staging path of a finished chunk to the set of staging paths, its record
+        counters and stage times to the run metrics and its summary changes to the aggregate delta. """
+    staging_path, _, chunk_counters, chunk_stages, chunk_delta = chunk_future.result()
+    staging_paths.add(staging_path)
+    merge_counters(chunk_counters)
+    merge_stage_times(chunk_stages)
+    aggregate_delta.merge(chunk_delta)
+
+
+def _combine_staging_files(staging_paths, region_names, attach_limit):
+    """ This function copies the rows of the staging files beyond attach_limit into the first attach_limit staging
+        files, as sqlite can only attach a limited number of databases at once. It returns the staging files left. """
+    kept_paths = staging_paths[:attach_limit]
+    for extra_index, extra_path in enumerate(staging_paths[attach_limit:]):
+        target_connection = sqlite3.connect(kept_paths[extra_index % attach_limit])
+        target_connection.execute('''ATTACH DATABASE ? AS extra_staging''', (extra_path,))
+        with target_connection:
+            for table_name in region_names:
+                target_connection.execute(f'''INSERT INTO main.{table_name}(name, mass, reclat, reclong)
+                                              SELECT name, mass, reclat, reclong FROM extra_staging.{table_name}''')
+        target_connection.execute('''DETACH DATABASE extra_staging''')
+        target_connection.close()
+    return kept_paths
+
+
+def _merge_staging_files(db_connection, staging_paths, region_names, aggregate_delta):
+    """ This function attaches every staging file to the main database and copies their rows into the region tables
+        with one INSERT ... SELECT per table and staging file, then applies the aggregate delta to the region
+        summaries, all in one transaction. It returns the rows copied. """
+    staging_aliases = [f'staging_{staging_index}' for staging_index in range(len(staging_paths))]
+    for staging_path, staging_alias in zip(staging_paths, staging_aliases):
+        db_connection.execute(f'''ATTACH DATABASE ? AS {staging_alias}''', (staging_path,))
+    rows_merged = 0
+    try:
+        if not db_connection.in_transaction:
+            db_connection.execute('BEGIN')
+        for table_name in region_names:
+            for staging_alias in staging_aliases:
+                merge_cursor = db_connection.execute(f'''INSERT INTO main.{table_name}(name, mass, reclat, reclong)
+                                                         SELECT name, mass, reclat, reclong
+                                                         FROM {staging_alias}.{table_name}''')
+                rows_merged += merge_cursor.rowcount
+                increment_counter(f'rows_inserted.{table_name}', merge_cursor.rowcount)
+        aggregate_delta.apply(db_connection.cursor())
+        db_connection.commit()
+    except BaseException:
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        raise
+    finally:
+        # Databases can only be detached outside of a transaction.
+        for staging_alias in staging_aliases:
+            db_connection.execute(f'''DETACH DATABASE {staging_alias}''')
+    return rows_merged
+
+
+def add_meteorites_to_tables_in_parallel(db_connection, db_cursor_obj, json_data_obj, worker_count=None,
+                                         chunk_size=20000, region_classifier=None):
+    """ This function classifies the meteors of the JSON data object on a pool of worker_count processes (the number
+        of CPU cores by default) and adds them to the region tables, which must already exist.
+        The records are sent to the workers in chunks of chunk_size, with at most two chunks per worker waiting at a
+        time so memory stays bounded. Each worker writes into its own staging file, and the staging files are merged
+        into the region tables in one transaction together with anything already pending on the connection, such as
+        the DELETEs of create_all_region_tables. The rows of each table end up grouped by worker, so their order can
+        differ from the other ingest paths. The function prints and returns the number of rows inserted per second. """
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be at least 1')
+    if worker_count is None:
+        worker_count = os.cpu_count() or 1
+    if worker_count < 1:
+        raise ValueError('worker_count must be at least 1')
+    if region_classifier is None:
+        region_classifier = create_region_classifier()
+    start_time = time.perf_counter()
+    staging_paths = set()
+    aggregate_delta = AggregateDelta()
+    try:
+        with tempfile.TemporaryDirectory(prefix='meteorite_staging_') as staging_dir:
+            # The classifier is pickled and sent to each worker once, instead of with every chunk.
+            with ProcessPoolExecutor(max_workers=worker_count, initializer=_initialize_worker,
+                                     initargs=(staging_dir, region_classifier)) as executor:
+                pending_chunks = set()
+                record_iterator = iter(json_data_obj)
+                while True:
+                    record_chunk = list(itertools.islice(record_iterator, chunk_size))
+                    if not record_chunk:
+                        break
+                    # Wait for a chunk to finish before sending more, so the input isn't read far ahead of the workers.
+                    if len(pending_chunks) >= worker_count * 2:
+                        finished_chunks, pending_chunks = wait(pending_chunks, return_when=FIRST_COMPLETED)
+                        for finished_chunk in finished_chunks:
+                            _collect_chunk_result(finished_chunk, staging_paths, aggregate_delta)
+                    # Only the four columns of the region tables are sent, pickling the full records would take the
+                    # main process longer than classifying them.
+                    pending_chunks.add(executor.submit(_ingest_chunk, get_record_columns(record_chunk)))
+                for pending_chunk in pending_chunks:
+                    _collect_chunk_result(pending_chunk, staging_paths, aggregate_delta)
+            # The workers have exited, so every staging file is complete and closed.
+            attach_limit = db_connection.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+            with stage_timer('staging_merge'):
+                merge_paths = _combine_staging_files(sorted(staging_paths), region_classifier.region_names,
+                                                     attach_limit)
+                rows_inserted = _merge_staging_files(db_connection, merge_paths, region_classifier.region_names,
+                                                     aggregate_delta)
+    except sqlite3.Error as db_error:
+        # If any sqlite exceptions occur, undo the partial ingest and print the error in a formatted message.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        print(f'A database error has occurred: {db_error}')
+        return 0.0
+    except TypeError:
+        # A typeError occurs if the JSON file is empty. Which can result from not properly
+        # doing a GET request on the data.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        print('A TypeError has occurred, your JSON file could be empty! Did you GET request work correctly?')
+        return 0.0
+    except BaseException:
+        # Undo the pending work on the connection if anything else stops the ingest, such as a page failing to
+        # download or a worker process dying.
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        raise
+    elapsed_seconds = time.perf_counter() - start_time
+    rows_per_second = rows_inserted / elapsed_seconds if elapsed_seconds > 0 else 0.0
+    print(f'Parallel ingest on {worker_count} processes inserted {rows_inserted} rows in {elapsed_seconds:.3f} '
+          f'seconds ({rows_per_second:.0f} rows per second).')
+    return rows_per_second
@@ -0,0 +1,93 @@
+"""
+This module handles a small pool of read-only connections to the meteorite database, for services that query it
+while an ingest or refresh is running. The database is in WAL mode (see connect_to_database), so each query reads
+the last committed version of the tables and never waits on the writer or sees a partly written ingest.
+The connections are opened lazily, reused instead of being reopened for every query, and can be handed between
+threads. They read the file through a shared memory map, so they share the operating system's page cache instead of
+each caching its own copy of the pages.
+"""
+from database_functions import DATABASE_NAME
+import contextlib
+import pathlib
+import queue
+import sqlite3
+import threading
+
+# The number of bytes of the database file each connection reads through the memory map.
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+
+
+class ReaderConnectionPool:
+    """ This class holds up to pool_size read-only connections to a database file. connection() lends one out for
+        the length of a with block, waiting for one to be returned if they are all in use. Setting shared_cache to
+        True opens the connections in sqlite's shared-cache mode as well, so they also share one page cache inside
+        the process; sqlite discourages that mode, as the connections then take turns with table level locks, so
+        it is off by default. A sqlite3.Error is raised if the database can't be opened. The pool can be used in a
+        with statement to close it. """
+
+    def __init__(self, db_name=DATABASE_NAME, pool_size=4, shared_cache=False, mmap_size=DEFAULT_MMAP_SIZE,
+                 timeout=5.0):
+        if pool_size < 1:
+            raise ValueError('pool_size must be at least 1')
+        # mode=ro opens the file read-only, and fails instead of creating the database if it doesn't exist.
+        self._db_uri = f'{pathlib.Path(db_name).resolve().as_uri()}?mode=ro'
+        if shared_cache:
+            self._db_uri += '&cache=shared'
+        self._mmap_size = int(mmap_size)
+        self._timeout = timeout
+        # The most recently returned connection is lent out first, as its pages are the most likely to be cached.
+        self._idle_connections = queue.LifoQueue()
+        self._free_slots = threading.BoundedSemaphore(pool_size)
+        self._closed = False
+
+    def _open_connection(self):
+        """ This function opens a new read-only connection that can be used from any thread. """
+        db_connection = sqlite3.connect(self._db_uri, uri=True, timeout=self._timeout, check_same_thread=False)
+        try:
+            db_connection.execute('PRAGMA query_only = ON')
+            db_connection.execute(f'PRAGMA mmap_size = {self._mmap_size}')
+        except sqlite3.Error:
+            db_connection.close()
+            raise
+        return db_connection
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ This function is a context manager that lends out a connection for the length of its with block.
+            Any read transaction left open is ended when the connection is returned, so the next query sees the
+            latest committed data. """
+        if self._closed:
+            raise sqlite3.ProgrammingError('the reader connection pool is closed')
+        self._free_slots.acquire()
+        try:
+            try:
+                db_connection = self._idle_connections.get_nowait()
+            except queue.Empty:
+                db_connection = self._open_connection()
+            try:
+                yield db_connection
+            finally:
+                if db_connection.in_transaction:
+                    db_connection.rollback()
+                if self._closed:
+                    db_connection.close()
+                else:
+                    self._idle_connections.put(db_connection)
+        finally:
+            self._free_slots.release()
+
+    def close(self):
+        """ This function closes every idle connection. Connections that are lent out are closed when they are
+            returned. """
+        self._closed = True
+        while True:
+            try:
+                self._idle_connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
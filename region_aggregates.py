@@ -0,0 +1,214 @@
+"""
+This module handles summary tables of each region, so dashboards can read per-region counts, mass totals,
+mass histograms and density tiles without scanning the region tables and casting their TEXT columns.
+The ingest functions collect the change to the summaries in an AggregateDelta while they write rows, and apply it
+with a few UPSERTs per batch in the same transaction, so the summaries are updated as rows are added and removed
+instead of being recomputed. Reading the summaries only touches a few rows per region.
+"""
+import bisect
+import math
+
+# Masses are counted in decade buckets: bucket 0 holds masses below 1 g, bucket 1 holds 1 g up to 10 g and so on,
+# the last bucket holds every mass of 10 tonnes or more.
+MASS_BUCKET_EDGES = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+# The size in degrees of each density tile.
+DENSITY_TILE_SIZE = 5.0
+
+
+class AggregateDelta:
+    """ This class collects the change to the summary tables caused by rows being added to or removed from
+        the region tables. Each row is a (name, mass, reclat, reclong) tuple like the rows of get_record_row.
+        apply() writes the change with UPSERTs and starts the delta again from empty. Deltas can be built in
+        worker processes and combined with merge(). """
+
+    def __init__(self):
+        # region name -> [meteorite count, mass count, mass sum]
+        self.region_totals = {}
+        # (region name, bucket index) -> meteorite count
+        self.mass_buckets = {}
+        # (region name, tile lat, tile long) -> meteorite count
+        self.density_tiles = {}
+
+    def add_rows(self, region_name, rows, row_sign=1):
+        """ This function counts rows added to a region table, or removed from it when row_sign is -1.
+            It runs for every row written, so the values are converted inline with float() and the totals are kept
+            in locals until the end. """
+        mass_buckets = self.mass_buckets
+        density_tiles = self.density_tiles
+        bisect_right = bisect.bisect_right
+        last_tile_lat = int(180 // DENSITY_TILE_SIZE) - 1
+        last_tile_long = int(360 // DENSITY_TILE_SIZE) - 1
+        row_count = 0
+        mass_count = 0
+        mass_sum = 0.0
+        for _, mass, reclat, reclong in rows:
+            row_count += 1
+            try:
+                mass_value = float(mass)
+            except (TypeError, ValueError):
+                mass_value = -1.0
+            # NaN fails the comparison, so it is left out like a missing mass.
+            if mass_value >= 0:
+                mass_count += 1
+                mass_sum += mass_value
+                bucket_key = (region_name, bisect_right(MASS_BUCKET_EDGES, mass_value))
+                mass_buckets[bucket_key] = mass_buckets.get(bucket_key, 0) + row_sign
+            try:
+                tile_lat = int((float(reclat) + 90) // DENSITY_TILE_SIZE)
+                # Longitudes past the antimeridian are wrapped into -180 to 180 before finding their tile.
+                tile_long = int(((float(reclong) + 180) % 360) // DENSITY_TILE_SIZE)
+            except (TypeError, ValueError, OverflowError):
+                # Missing, unparseable, NaN and infinite coordinates have no tile.
+                continue
+            tile_key = (region_name, tile_lat if tile_lat < last_tile_lat else last_tile_lat,
+                        tile_long if tile_long < last_tile_long else last_tile_long)
+            density_tiles[tile_key] = density_tiles.get(tile_key, 0) + row_sign
+        region_totals = self.region_totals.setdefault(region_name, [0, 0, 0.0])
+        region_totals[0] += row_sign * row_count
+        region_totals[1] += row_sign * mass_count
+        region_totals[2] += row_sign * mass_sum
+
+    def remove_rows(self, region_name, rows):
+        """ This function counts rows removed from a region table. """
+        self.add_rows(region_name, rows, row_sign=-1)
+
+    def merge(self, other_delta):
+        """ This function adds the changes collected by another delta to this one. """
+        for region_name, (meteorite_count, mass_count, mass_sum) in other_delta.region_totals.items():
+            region_totals = self.region_totals.setdefault(region_name, [0, 0, 0.0])
+            region_totals[0] += meteorite_count
+            region_totals[1] += mass_count
+            region_totals[2] += mass_sum
+        for bucket_key, meteorite_count in other_delta.mass_buckets.items():
+            self.mass_buckets[bucket_key] = self.mass_buckets.get(bucket_key, 0) + meteorite_count
+        for tile_key, meteorite_count in other_delta.density_tiles.items():
+            self.density_tiles[tile_key] = self.density_tiles.get(tile_key, 0) + meteorite_count
+
+    def apply(self, db_cursor_obj):
+        """ This function adds the collected changes to the summary tables with one UPSERT per changed row of the
+            summaries, removes histogram buckets and tiles that dropped to zero and clears the delta.
+            It should run in the same transaction as the changes to the region tables. """
+        db_cursor_obj.executemany('''INSERT INTO region_summary(region_name, meteorite_count, mass_count, mass_sum)
+                                     VALUES(?, ?, ?, ?)
+                                     ON CONFLICT(region_name) DO UPDATE SET
+                                        meteorite_count = meteorite_count + excluded.meteorite_count,
+                                        mass_count = mass_count + excluded.mass_count,
+                                        mass_sum = mass_sum + excluded.mass_sum''',
+                                  [(region_name,) + tuple(region_totals)
+                                   for region_name, region_totals in self.region_totals.items()])
+        db_cursor_obj.executemany('''INSERT INTO region_mass_histogram(region_name, bucket_index, meteorite_count)
+                                     VALUES(?, ?, ?)
+                                     ON CONFLICT(region_name, bucket_index) DO UPDATE SET
+                                        meteorite_count = meteorite_count + excluded.meteorite_count''',
+                                  [bucket_key + (meteorite_count,)
+                                   for bucket_key, meteorite_count in self.mass_buckets.items() if meteorite_count])
+        db_cursor_obj.executemany('''INSERT INTO region_density_tiles(region_name, tile_lat, tile_long, meteorite_count)
+                                     VALUES(?, ?, ?, ?)
+                                     ON CONFLICT(region_name, tile_lat, tile_long) DO UPDATE SET
+                                        meteorite_count = meteorite_count + excluded.meteorite_count''',
+                                  [tile_key + (meteorite_count,)
+                                   for tile_key, meteorite_count in self.density_tiles.items() if meteorite_count])
+        db_cursor_obj.execute('''DELETE FROM region_mass_histogram WHERE meteorite_count = 0''')
+        db_cursor_obj.execute('''DELETE FROM region_density_tiles WHERE meteorite_count = 0''')
+        self.region_totals.clear()
+        self.mass_buckets.clear()
+        self.density_tiles.clear()
+
+
+def create_aggregate_tables(db_cursor_obj, region_names):
+    """ This function creates the summary tables if they don't exist. When they are first created, the summaries of
+        every region table (or view) that already holds rows are filled in from its rows, so a database built before
+        the summaries existed can still be updated incrementally. """
+    db_cursor_obj.execute('''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'region_summary' ''')
+    if db_cursor_obj.fetchone() is not None:
+        return
+    db_cursor_obj.execute('''CREATE TABLE region_summary(
+                            region_name TEXT PRIMARY KEY,
+                            meteorite_count INTEGER NOT NULL,
+                            mass_count INTEGER NOT NULL,
+                            mass_sum REAL NOT NULL);''')
+    # WITHOUT ROWID stores each bucket and tile as just its primary key and count.
+    db_cursor_obj.execute('''CREATE TABLE region_mass_histogram(
+                            region_name TEXT NOT NULL,
+                            bucket_index INTEGER NOT NULL,
+                            meteorite_count INTEGER NOT NULL,
+                            PRIMARY KEY(region_name, bucket_index)) WITHOUT ROWID;''')
+    db_cursor_obj.execute('''CREATE TABLE region_density_tiles(
+                            region_name TEXT NOT NULL,
+                            tile_lat INTEGER NOT NULL,
+                            tile_long INTEGER NOT NULL,
+                            meteorite_count INTEGER NOT NULL,
+                            PRIMARY KEY(region_name, tile_lat, tile_long)) WITHOUT ROWID;''')
+    aggregate_delta = AggregateDelta()
+    for region_name in region_names:
+        db_cursor_obj.execute('''SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?''',
+                              (region_name,))
+        if db_cursor_obj.fetchone() is not None:
+            aggregate_delta.add_rows(region_name, db_cursor_obj.execute(f'''SELECT name, mass, reclat, reclong
+                                                                            FROM {region_name}''').fetchall())
+    aggregate_delta.apply(db_cursor_obj)
+
+
+def clear_region_aggregates(db_cursor_obj, region_names):
+    """ This function resets the summaries of the specified regions to empty, used when their tables are cleared. """
+    for table_name in ('region_summary', 'region_mass_histogram', 'region_density_tiles'):
+        db_cursor_obj.executemany(f'''DELETE FROM {table_name} WHERE region_name = ?''',
+                                  [(region_name,) for region_name in region_names])
+
+
+def get_mass_histogram(db_connection, region_name):
+    """ This function returns the mass histogram of a region as a list of (lower mass, upper mass, meteorite count)
+        tuples in mass order, including empty buckets. The first lower mass is 0 and the last upper mass is None. """
+    bucket_counts = dict(db_connection.execute('''SELECT bucket_index, meteorite_count FROM region_mass_histogram
+                                                  WHERE region_name = ?''', (region_name,)))
+    bucket_bounds = (0,) + MASS_BUCKET_EDGES + (None,)
+    return [(bucket_bounds[bucket_index], bucket_bounds[bucket_index + 1], bucket_counts.get(bucket_index, 0))
+            for bucket_index in range(len(MASS_BUCKET_EDGES) + 1)]
+
+
+def estimate_median_mass(mass_histogram):
+    """ This function estimates the median mass from a mass histogram. The median is placed inside its bucket
+        assuming the masses are spread evenly on a log scale, like the buckets are. None is returned for an empty
+        histogram. """
+    mass_count = sum(bucket_count for _, _, bucket_count in mass_histogram)
+    if mass_count == 0:
+        return None
+    middle_position = mass_count / 2
+    for lower_mass, upper_mass, bucket_count in mass_histogram:
+        if bucket_count and middle_position <= bucket_count:
+            bucket_fraction = middle_position / bucket_count
+            # The open ended buckets use a lower or upper bound one decade away.
+            lower_log = math.log10(lower_mass) if lower_mass else math.log10(upper_mass) - 1
+            upper_log = math.log10(upper_mass) if upper_mass is not None else lower_log + 1
+            return 10 ** (lower_log + bucket_fraction * (upper_log - lower_log))
+        middle_position -= bucket_count
+    return None
+
+
+def get_region_summaries(db_connection):
+    """ This function returns a list with a dictionary for each region holding its meteorite count, how many of
+        them have a mass, the total and mean mass and an estimated median mass, read from the summary tables. """
+    region_summaries = []
+    for region_name, meteorite_count, mass_count, mass_sum in db_connection.execute(
+            '''SELECT region_name, meteorite_count, mass_count, mass_sum FROM region_summary
+               ORDER BY region_name''').fetchall():
+        region_summaries.append({
+            'region_name': region_name,
+            'meteorite_count': meteorite_count,
+            'mass_count': mass_count,
+            'mass_sum': mass_sum,
+            'mean_mass': mass_sum / mass_count if mass_count else None,
+            'median_mass_estimate': estimate_median_mass(get_mass_histogram(db_connection, region_name))
+        })
+    return region_summaries
+
+
+def get_density_tiles(db_connection, region_name):
+    """ This function is a generator that yields each non-empty density tile of a region as a
+        (south, west, north, east, meteorite count) tuple. """
+    for tile_lat, tile_long, meteorite_count in db_connection.execute(
+            '''SELECT tile_lat, tile_long, meteorite_count FROM region_density_tiles WHERE region_name = ?
+               ORDER BY tile_lat, tile_long''', (region_name,)):
+        south = tile_lat * DENSITY_TILE_SIZE - 90
+        west = tile_long * DENSITY_TILE_SIZE - 180
+        yield south, west, south + DENSITY_TILE_SIZE, west + DENSITY_TILE_SIZE, meteorite_count
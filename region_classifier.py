@@ -0,0 +1,140 @@
+"""
+This module handles classifying a meteor's latitude and longitude into the regions it fell in.
+The regions are stored in a uniform grid index, so each lookup only checks the bounding boxes
+that overlap the grid cell of the meteor instead of every bounding box.
+"""
+import json
+import math
+
+
+def check_valid_region_name(region_name):
+    """ This function checks that a region name can be used as a sqlite table name.
+        A ValueError is raised if the name isn't a valid identifier. """
+    if not isinstance(region_name, str) or not region_name.isidentifier():
+        raise ValueError(f'Invalid region name: {region_name!r}. Region names are used as table names '
+                         f'and must only contain letters, digits and underscores.')
+
+
+def _normalize_longitude(long_value):
+    """ This function wraps a longitude value into the -180 to 180 range and returns it.
+        Values already inside the range are returned unchanged. """
+    if -180 <= long_value <= 180:
+        return long_value
+    return ((long_value + 180) % 360) - 180
+
+
+def split_bounding_box(box_values):
+    """ This function splits a bounding box (left, bottom, right, top) into a list of boxes that
+        don't cross the antimeridian. A box with both longitudes past the same side of the 180th meridian is first
+        shifted by 360 degrees into the -180 to 180 range. A box with a right value above 180 (Upper Asia's 190.4),
+        a left value below -180 or a left value greater than its right value is then split into two boxes, one on
+        each side of the 180th meridian. Any other box is returned as the only item in the list. """
+    left, bottom, right, top = box_values
+    if left > 180 and right > 180:
+        left, right = left - 360, right - 360
+    elif left < -180 and right < -180:
+        left, right = left + 360, right + 360
+    if right > 180:
+        return [(left, bottom, 180, top), (-180, bottom, right - 360, top)]
+    if left < -180:
+        return [(left + 360, bottom, 180, top), (-180, bottom, right, top)]
+    if left > right:
+        return [(left, bottom, 180, top), (-180, bottom, right, top)]
+    return [(left, bottom, right, top)]
+
+
+def load_region_definitions(file_path):
+    """ This function loads region bounding boxes from a JSON file and returns them as a dictionary.
+        The file must hold an object mapping each region name to a list of four numbers
+        (left - long min, bottom - lat min, right - long max, top - lat max), the same layout
+        used by the bounding box dictionary in database_functions. Longitudes may run past 180 or -180 to describe a
+        box that crosses the antimeridian. A ValueError is raised if a region name or its bounding box is invalid,
+        such as a bottom above its top or a longitude beyond -360 to 360. """
+    with open(file_path, 'r', encoding='utf-8') as region_file:
+        region_data = json.load(region_file)
+    if not isinstance(region_data, dict):
+        raise ValueError(f'{file_path} must contain a JSON object of region names to bounding boxes.')
+    bound_box_dict = {}
+    for region_name, box_values in region_data.items():
+        check_valid_region_name(region_name)
+        if not isinstance(box_values, list) or len(box_values) != 4 \
+                or not all(isinstance(value, (int, float)) for value in box_values):
+            raise ValueError(f'The bounding box for {region_name} must be a list of four numbers.')
+        left, bottom, right, top = box_values
+        if not all(math.isfinite(value) for value in box_values) or bottom > top:
+            raise ValueError(f'The bounding box for {region_name} must have finite values and a bottom that is '
+                             f'not above its top.')
+        if not -360 <= left <= 360 or not -360 <= right <= 360:
+            raise ValueError(f'The longitudes of the bounding box for {region_name} must be between -360 and 360.')
+        bound_box_dict[region_name] = tuple(box_values)
+    return bound_box_dict
+
+
+class RegionClassifier:
+    """ This class classifies coordinates into the regions whose bounding boxes contain them.
+        Every bounding box is split at the antimeridian if needed and then registered in each cell of a
+        uniform grid that it overlaps. A lookup only checks the boxes registered in the coordinate's cell,
+        so the cost of a lookup depends on how many boxes overlap that cell rather than the total number
+        of regions. """
+
+    def __init__(self, bounding_boxes, cell_size=10.0):
+        """ This function builds the grid index from a dictionary of region names to bounding boxes.
+            The cell size is in degrees, smaller cells mean fewer candidate boxes per lookup
+            but more cells to store when there are many large boxes. """
+        if cell_size <= 0:
+            raise ValueError('cell_size must be greater than 0')
+        self.cell_size = cell_size
+        self.region_names = []
+        # Each segment is a tuple of (region index, left, bottom, right, top) that doesn't cross the antimeridian.
+        self.region_segments = []
+        self._grid = {}
+        self._column_count = math.ceil(360 / cell_size)
+        self._row_count = math.ceil(180 / cell_size)
+        for region_name, box_values in bounding_boxes.items():
+            check_valid_region_name(region_name)
+            region_index = len(self.region_names)
+            self.region_names.append(region_name)
+            for segment in split_bounding_box(box_values):
+                self._add_segment(region_index, segment)
+
+    @classmethod
+    def from_region_file(cls, file_path, cell_size=10.0):
+        """ This function creates a classifier from a region definition JSON file,
+            see load_region_definitions() for the file layout. """
+        return cls(load_region_definitions(file_path), cell_size)
+
+    def _column_index(self, long_value):
+        """ This function returns the grid column of a longitude, clamped to the grid. """
+        return min(max(int((long_value + 180) // self.cell_size), 0), self._column_count - 1)
+
+    def _row_index(self, lat_value):
+        """ This function returns the grid row of a latitude, clamped to the grid. """
+        return min(max(int((lat_value + 90) // self.cell_size), 0), self._row_count - 1)
+
+    def _add_segment(self, region_index, segment):
+        """ This function stores a segment and registers it in every grid cell it overlaps. """
+        left, bottom, right, top = segment
+        region_segment = (region_index, left, bottom, right, top)
+        self.region_segments.append(region_segment)
+        # A box entirely outside of the latitude range can never contain a coordinate.
+        if bottom > 90 or top < -90:
+            return
+        for column in range(self._column_index(left), self._column_index(right) + 1):
+            for row in range(self._row_index(bottom), self._row_index(top) + 1):
+                self._grid.setdefault((column, row), []).append(region_segment)
+
+    def classify(self, lat_value, long_value):
+        """ This function returns a list of the region names whose bounding box contains the coordinates,
+            in the same order the regions were defined. An empty list is returned if the coordinates
+            don't fall in any region. """
+        if not -90 <= lat_value <= 90 or not math.isfinite(long_value):
+            return []
+        long_value = _normalize_longitude(long_value)
+        candidate_segments = self._grid.get((self._column_index(long_value), self._row_index(lat_value)), ())
+        # Segments are registered in region order, so the matches are already in order.
+        region_indexes = [region_index for region_index, left, bottom, right, top in candidate_segments
+                          if left <= long_value <= right and bottom <= lat_value <= top]
+        # A region split at the antimeridian can match twice on the 180th meridian itself.
+        if len(region_indexes) > 1:
+            region_indexes = sorted(set(region_indexes))
+        return [self.region_names[region_index] for region_index in region_indexes]
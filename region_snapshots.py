@@ -0,0 +1,217 @@
+"""
+This module handles exporting the region tables as columnar binary snapshots and reading them back, so analytics
+don't have to re-read sqlite into a dictionary per meteor.
+Each region is written to its own <region name>.metsnap file holding a small header, little-endian float64 columns
+of reclat, reclong and mass (NaN where a value is missing) and a packed table of the UTF-8 names.
+A snapshot is read through a read-only memory map, and its columns are NumPy arrays (or memoryviews when NumPy
+isn't installed) looking straight into the mapped file, so nothing is copied until it is used.
+Record objects are only created for the rows that are asked for.
+"""
+from database_functions import create_region_classifier
+import array
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SNAPSHOT_EXTENSION = '.metsnap'
+SNAPSHOT_MAGIC = b'METSNAP\x00'
+SNAPSHOT_VERSION = 1
+# magic, version, row count, size of the name data in bytes. The header is 24 bytes, so the float64 columns that
+# follow it start on an 8 byte boundary.
+_SNAPSHOT_HEADER = struct.Struct('<8sIIQ')
+# The float64 columns in the order they are stored, after the header.
+_FLOAT_COLUMNS = ('reclat', 'reclong', 'mass')
+
+
+def _convert_to_float(in_value):
+    """ This function converts a value from a region table to a float, or NaN if it is missing or not a number. """
+    try:
+        return float(in_value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _write_snapshot_file(file_path, name_offsets, name_data, float_columns):
+    """ This function writes the header, float columns, name offsets and name data of a snapshot to a temporary file
+        and then moves it over the file path, so a reader never maps a half written snapshot. """
+    # The columns are always stored little-endian.
+    if sys.byteorder == 'big':
+        for column_values in float_columns + [name_offsets]:
+            column_values.byteswap()
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as snapshot_file:
+        snapshot_file.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(name_offsets) - 1,
+                                                  len(name_data)))
+        for column_values in float_columns:
+            column_values.tofile(snapshot_file)
+        name_offsets.tofile(snapshot_file)
+        snapshot_file.write(name_data)
+    os.replace(temp_path, file_path)
+
+
+def export_region_snapshots(db_connection, snapshot_dir, region_names=None):
+    """ This function writes a snapshot of each region table (or view of the normalized schema) to snapshot_dir,
+        creating the directory if it doesn't exist, and returns the list of file paths written.
+        By default the regions of the bounding boxes are exported. Missing names are stored as empty strings.
+        If any sqlite exceptions occur the error is printed and the snapshots written so far are kept. """
+    if region_names is None:
+        region_names = create_region_classifier().region_names
+    os.makedirs(snapshot_dir, exist_ok=True)
+    snapshot_paths = []
+    rows_exported = 0
+    start_time = time.perf_counter()
+    try:
+        for region_name in region_names:
+            float_columns = [array.array('d') for _ in _FLOAT_COLUMNS]
+            lat_column, long_column, mass_column = float_columns
+            # The offset of the end of each name in the name data, after the offset 0 of the first name.
+            name_offsets = array.array('I', [0])
+            name_data = bytearray()
+            for name, mass, reclat, reclong in db_connection.execute(f'''SELECT name, mass, reclat, reclong
+                                                                          FROM {region_name}'''):
+                lat_column.append(_convert_to_float(reclat))
+                long_column.append(_convert_to_float(reclong))
+                mass_column.append(_convert_to_float(mass))
+                if name is not None:
+                    name_data += str(name).encode('utf-8')
+                name_offsets.append(len(name_data))
+            snapshot_path = os.path.join(snapshot_dir, f'{region_name}{SNAPSHOT_EXTENSION}')
+            _write_snapshot_file(snapshot_path, name_offsets, name_data, float_columns)
+            snapshot_paths.append(snapshot_path)
+            rows_exported += len(lat_column)
+    except sqlite3.Error as db_error:
+        print(f'A database error has occurred: {db_error}')
+        return snapshot_paths
+    elapsed_seconds = time.perf_counter() - start_time
+    print(f'Exported {rows_exported} rows of {len(snapshot_paths)} regions to {snapshot_dir} '
+          f'in {elapsed_seconds:.3f} seconds.')
+    return snapshot_paths
+
+
+def _create_column_view(mapped_file, column_offset, item_count, numpy_type, array_typecode):
+    """ This function returns a read-only view of item_count values of a column of the mapped file.
+        A NumPy array or memoryview is returned without copying the values. Only when NumPy isn't installed and
+        the machine is big-endian are the values copied into a byte swapped array. """
+    if numpy is not None:
+        return numpy.frombuffer(mapped_file, dtype=numpy_type, count=item_count, offset=column_offset)
+    column_view = memoryview(mapped_file)[column_offset:column_offset + item_count * struct.calcsize(array_typecode)]
+    if sys.byteorder == 'little':
+        return column_view.cast(array_typecode)
+    column_values = array.array(array_typecode, column_view)
+    column_values.byteswap()
+    return column_values
+
+
+class SnapshotRecord:
+    """ This class holds one meteor read from a snapshot. Missing values are None, like in the dataset records.
+        __slots__ keeps each record to the size of its four values. """
+    __slots__ = ('name', 'mass', 'reclat', 'reclong')
+
+    def __init__(self, name, mass, reclat, reclong):
+        self.name = name
+        self.mass = mass
+        self.reclat = reclat
+        self.reclong = reclong
+
+    def __repr__(self):
+        return f'SnapshotRecord(name={self.name!r}, mass={self.mass!r}, reclat={self.reclat!r}, ' \
+               f'reclong={self.reclong!r})'
+
+
+class RegionSnapshot:
+    """ This class reads a snapshot written by export_region_snapshots through a read-only memory map.
+        The reclat, reclong and mass attributes are zero-copy float64 columns of the mapped file. Indexing or
+        iterating the snapshot creates a SnapshotRecord for each row that is read. A ValueError is raised if the
+        file isn't a snapshot. The snapshot can be used in a with statement to close it. """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.region_name = os.path.basename(file_path)[:-len(SNAPSHOT_EXTENSION)]
+        with open(file_path, 'rb') as snapshot_file:
+            if os.fstat(snapshot_file.fileno()).st_size < _SNAPSHOT_HEADER.size:
+                raise ValueError(f'{file_path} is too short to be a meteorite snapshot')
+            self._mapped_file = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, row_count, name_data_size = _SNAPSHOT_HEADER.unpack_from(self._mapped_file)
+        column_offset = _SNAPSHOT_HEADER.size
+        names_offset = column_offset + len(_FLOAT_COLUMNS) * 8 * row_count
+        name_data_offset = names_offset + 4 * (row_count + 1)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or \
+                len(self._mapped_file) != name_data_offset + name_data_size:
+            self._mapped_file.close()
+            raise ValueError(f'{file_path} is not a version {SNAPSHOT_VERSION} meteorite snapshot')
+        self.row_count = row_count
+        for column_name in _FLOAT_COLUMNS:
+            setattr(self, column_name, _create_column_view(self._mapped_file, column_offset, row_count, '<f8', 'd'))
+            column_offset += 8 * row_count
+        self._name_offsets = _create_column_view(self._mapped_file, names_offset, row_count + 1, '<u4', 'I')
+        self._name_data = memoryview(self._mapped_file)[name_data_offset:]
+
+    def get_name(self, row_index):
+        """ This function decodes the name of a row from the name table, or returns None if it is missing. """
+        name_start = int(self._name_offsets[row_index])
+        name_end = int(self._name_offsets[row_index + 1])
+        if name_start == name_end:
+            return None
+        return str(self._name_data[name_start:name_end], 'utf-8')
+
+    def __len__(self):
+        return self.row_count
+
+    def __getitem__(self, row_index):
+        """ This function creates the SnapshotRecord of a row. Negative indexes count from the end. """
+        if row_index < 0:
+            row_index += self.row_count
+        if not 0 <= row_index < self.row_count:
+            raise IndexError('snapshot row index out of range')
+        row_values = [float(self.mass[row_index]), float(self.reclat[row_index]), float(self.reclong[row_index])]
+        return SnapshotRecord(self.get_name(row_index),
+                              *[None if math.isnan(row_value) else row_value for row_value in row_values])
+
+    def __iter__(self):
+        """ This function is a generator that yields the SnapshotRecord of each row, one at a time. """
+        for row_index in range(self.row_count):
+            yield self[row_index]
+
+    def close(self):
+        """ This function drops the column views and unmaps the file. If a column taken from the snapshot is
+            still referenced elsewhere, the file stays mapped until that column is garbage collected. """
+        self.reclat = self.reclong = self.mass = None
+        self._name_offsets = None
+        if self._name_data is not None:
+            self._name_data.release()
+            self._name_data = None
+        try:
+            self._mapped_file.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+def load_region_snapshots(snapshot_dir):
+    """ This function opens every snapshot in snapshot_dir and returns a dictionary of region name to RegionSnapshot,
+        in region name order. Only the headers are read, the rows are paged in from the files when they are used. """
+    region_snapshots = {}
+    try:
+        for file_name in sorted(os.listdir(snapshot_dir)):
+            if file_name.endswith(SNAPSHOT_EXTENSION):
+                region_snapshot = RegionSnapshot(os.path.join(snapshot_dir, file_name))
+                region_snapshots[region_snapshot.region_name] = region_snapshot
+    except BaseException:
+        # Don't leave the snapshots opened so far mapped if one of them can't be read.
+        for region_snapshot in region_snapshots.values():
+            region_snapshot.close()
+        raise
+    return region_snapshots
@@ -0,0 +1,143 @@
+"""
+This module handles an on-disk cache of GET responses from the NASA endpoint.
+Each response body is stored gzip compressed next to a small JSON file holding its ETag and Last-Modified headers.
+Later requests send If-None-Match/If-Modified-Since, and when the server answers 304 (Not Modified)
+the cached body is served instead of downloading it again. In offline mode the network is never used.
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import requests
+
+DEFAULT_CACHE_DIR = '.http_cache'
+
+
+def _create_cache_key(request_url, query_params):
+    """ This function returns a file name safe key for a URL and its query parameters.
+        The parameters are sorted, so the same request always gets the same key. """
+    sorted_params = sorted((str(param_name), str(param_value))
+                           for param_name, param_value in (query_params or {}).items())
+    key_source = json.dumps([request_url, sorted_params])
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+
+def _write_file_atomically(file_path, file_bytes):
+    """ This function writes bytes to a temporary file and then moves it over the file path,
+        so a reader never sees a half written file. """
+    temp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(file_bytes)
+    os.replace(temp_path, file_path)
+
+
+class ResponseCache:
+    """ This class stores compressed response bodies with their validators in a cache directory.
+        Entries that haven't been used for max_entry_age seconds are evicted, and the least recently used entries
+        are evicted while the cache holds more than max_cache_bytes. When offline is True, callers
+        should only serve cached entries and never touch the network. """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_cache_bytes=256 * 1024 * 1024,
+                 max_entry_age=30 * 24 * 60 * 60, offline=False):
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.max_entry_age = max_entry_age
+        self.offline = offline
+        self._cache_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_paths(self, request_url, query_params):
+        """ This function returns the (body path, metadata path) of a cache entry. """
+        cache_key = _create_cache_key(request_url, query_params)
+        return (os.path.join(self.cache_dir, f'{cache_key}.body.gz'),
+                os.path.join(self.cache_dir, f'{cache_key}.meta.json'))
+
+    def load_entry(self, request_url, query_params=None):
+        """ This function returns the cached (metadata dictionary, body bytes) of a request, or None
+            if the request isn't cached or its files can't be read. Loading an entry marks it as recently used. """
+        body_path, meta_path = self._entry_paths(request_url, query_params)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as meta_file:
+                entry_meta = json.load(meta_file)
+            with gzip.open(body_path, 'rb') as body_file:
+                body_bytes = body_file.read()
+            # Update the modification time, which is used to find stale and least recently used entries.
+            os.utime(body_path)
+        except (OSError, ValueError, EOFError):
+            return None
+        return entry_meta, body_bytes
+
+    def get_conditional_headers(self, cache_entry):
+        """ This function returns the If-None-Match/If-Modified-Since headers for a cached entry,
+            or an empty dictionary if there is no entry or it has no validators. """
+        request_headers = {}
+        if cache_entry is not None:
+            entry_meta = cache_entry[0]
+            if entry_meta.get('etag'):
+                request_headers['If-None-Match'] = entry_meta['etag']
+            if entry_meta.get('last_modified'):
+                request_headers['If-Modified-Since'] = entry_meta['last_modified']
+        return request_headers
+
+    def store_response(self, request_url, query_params, response_obj):
+        """ This function stores the body of a successful response compressed, along with its ETag and
+            Last-Modified headers. Responses without either header are still stored, so they can be served offline. """
+        body_path, meta_path = self._entry_paths(request_url, query_params)
+        entry_meta = {
+            'url': request_url,
+            'params': {str(param_name): str(param_value) for param_name, param_value in (query_params or {}).items()},
+            'etag': response_obj.headers.get('ETag'),
+            'last_modified': response_obj.headers.get('Last-Modified'),
+            'content_type': response_obj.headers.get('Content-Type', 'application/json'),
+            'stored_at': time.time()
+        }
+        with self._cache_lock:
+            _write_file_atomically(body_path, gzip.compress(response_obj.content))
+            _write_file_atomically(meta_path, json.dumps(entry_meta).encode('utf-8'))
+
+    def create_cached_response(self, cache_entry):
+        """ This function creates a requests response object with a status code of 200 from a cached entry,
+            so it can be used the same way as a response that was downloaded. """
+        entry_meta, body_bytes = cache_entry
+        response_obj = requests.Response()
+        response_obj.status_code = 200
+        response_obj.url = entry_meta.get('url')
+        response_obj.headers['Content-Type'] = entry_meta.get('content_type', 'application/json')
+        response_obj.encoding = 'utf-8'
+        response_obj._content = body_bytes
+        return response_obj
+
+    def evict_stale_entries(self):
+        """ This function deletes entries that haven't been used within max_entry_age seconds, then deletes the least
+            recently used entries until the compressed size of the cache is at most max_cache_bytes.
+            It returns the number of entries deleted. """
+        with self._cache_lock:
+            cache_entries = []
+            for file_name in os.listdir(self.cache_dir):
+                if not file_name.endswith('.body.gz'):
+                    continue
+                body_path = os.path.join(self.cache_dir, file_name)
+                try:
+                    file_stats = os.stat(body_path)
+                except FileNotFoundError:
+                    continue
+                cache_entries.append((file_stats.st_mtime, file_stats.st_size, body_path))
+            # Sort the oldest entries first, so they are the first to be evicted.
+            cache_entries.sort()
+            cache_bytes = sum(entry_size for _, entry_size, _ in cache_entries)
+            oldest_allowed = time.time() - self.max_entry_age
+            evicted_count = 0
+            for last_used, entry_size, body_path in cache_entries:
+                if last_used >= oldest_allowed and cache_bytes <= self.max_cache_bytes:
+                    break
+                meta_path = body_path[:-len('.body.gz')] + '.meta.json'
+                for entry_path in (body_path, meta_path):
+                    try:
+                        os.remove(entry_path)
+                    except FileNotFoundError:
+                        pass
+                cache_bytes -= entry_size
+                evicted_count += 1
+            return evicted_count
@@ -0,0 +1,205 @@
+"""
+This module handles collecting metrics about a run of the program, so we can see where the time goes and what
+happened to every record instead of only reading the printed messages.
+Timing spans add up the time spent in each stage (such as http_get, json_decode or insert) and counters count events
+(such as records_seen or rows_inserted.Europe_Meteorites). A run can optionally be profiled with cProfile and have its
+memory traced with tracemalloc. finish_run_metrics() returns a run report, which can be written as JSON or in the
+Prometheus text format so monitoring can scrape it. Every function is safe to call from several threads.
+"""
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+# The number of functions and allocation sites listed in the profile and memory sections of a run report.
+REPORT_TOP_COUNT = 25
+
+_metrics_lock = threading.Lock()
+# The state of the current run, reset by start_run_metrics().
+_run_state = {
+    'started_at': time.time(),
+    'start_time': time.perf_counter(),
+    'stages': {},
+    'counters': {},
+    'profiler': None,
+    'trace_memory': False
+}
+
+
+def start_run_metrics(profile=False, trace_memory=False):
+    """ This function starts a new run, clearing every stage time and counter. When profile is True the calling
+        thread is profiled with cProfile, and when trace_memory is True every allocation is traced with tracemalloc,
+        both until finish_run_metrics() is called. Both slow the run down, so they are off by default. """
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+    with _metrics_lock:
+        _run_state['started_at'] = time.time()
+        _run_state['start_time'] = time.perf_counter()
+        _run_state['stages'] = {}
+        _run_state['counters'] = {}
+        _run_state['profiler'] = profiler
+        _run_state['trace_memory'] = trace_memory
+    if trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+
+
+def add_stage_time(stage_name, elapsed_seconds):
+    """ This function adds one span of elapsed_seconds to the total of a stage. """
+    with _metrics_lock:
+        stage_totals = _run_state['stages'].setdefault(stage_name, {'seconds': 0.0, 'count': 0, 'max_seconds': 0.0})
+        stage_totals['seconds'] += elapsed_seconds
+        stage_totals['count'] += 1
+        stage_totals['max_seconds'] = max(stage_totals['max_seconds'], elapsed_seconds)
+
+
+@contextlib.contextmanager
+def stage_timer(stage_name):
+    """ This function is a context manager that times the code inside its with block as one span of a stage.
+        The span is still counted if the block raises an exception. """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(stage_name, time.perf_counter() - start_time)
+
+
+def increment_counter(counter_name, amount=1):
+    """ This function adds amount to a counter, starting it at 0 if it hasn't been counted yet this run. """
+    with _metrics_lock:
+        _run_state['counters'][counter_name] = _run_state['counters'].get(counter_name, 0) + amount
+
+
+def take_counters():
+    """ This function returns the counters counted so far and clears them. A worker process uses it to send its
+        counters back to the main process, which adds them to its own with merge_counters(). """
+    with _metrics_lock:
+        counters = _run_state['counters']
+        _run_state['counters'] = {}
+    return counters
+
+
+def take_stage_times():
+    """ This function returns the stage times timed so far and clears them, so a worker process can send them back
+        to the main process, which adds them to its own with merge_stage_times(). """
+    with _metrics_lock:
+        stages = _run_state['stages']
+        _run_state['stages'] = {}
+    return stages
+
+
+def merge_counters(counters):
+    """ This function adds every counter of a dictionary from take_counters() to the counters of this run. """
+    with _metrics_lock:
+        for counter_name, amount in counters.items():
+            _run_state['counters'][counter_name] = _run_state['counters'].get(counter_name, 0) + amount
+
+
+def merge_stage_times(stages):
+    """ This function adds every stage of a dictionary from take_stage_times() to the stage times of this run. """
+    with _metrics_lock:
+        for stage_name, other_totals in stages.items():
+            stage_totals = _run_state['stages'].setdefault(stage_name, {'seconds': 0.0, 'count': 0, 'max_seconds': 0.0})
+            stage_totals['seconds'] += other_totals['seconds']
+            stage_totals['count'] += other_totals['count']
+            stage_totals['max_seconds'] = max(stage_totals['max_seconds'], other_totals['max_seconds'])
+
+
+def _create_profile_summary(profiler):
+    """ This function returns the REPORT_TOP_COUNT functions with the most cumulative time in a profile,
+        each as a dictionary. """
+    profile_stats = pstats.Stats(profiler, stream=io.StringIO())
+    profile_stats.sort_stats(pstats.SortKey.CUMULATIVE)
+    function_summaries = []
+    for function_key in profile_stats.fcn_list[:REPORT_TOP_COUNT]:
+        primitive_calls, total_calls, total_seconds, cumulative_seconds, _ = profile_stats.stats[function_key]
+        file_name, line_number, function_name = function_key
+        function_summaries.append({
+            'function': f'{file_name}:{line_number}({function_name})',
+            'calls': total_calls,
+            'total_seconds': total_seconds,
+            'cumulative_seconds': cumulative_seconds
+        })
+    return function_summaries
+
+
+def _create_memory_summary():
+    """ This function returns the current and peak traced memory and the REPORT_TOP_COUNT source lines holding the
+        most memory, then stops tracemalloc. """
+    current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    memory_snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return {
+        'current_bytes': current_bytes,
+        'peak_bytes': peak_bytes,
+        'top_allocations': [{'location': f'{line_stats.traceback[0].filename}:{line_stats.traceback[0].lineno}',
+                             'bytes': line_stats.size,
+                             'blocks': line_stats.count}
+                            for line_stats in memory_snapshot.statistics('lineno')[:REPORT_TOP_COUNT]]
+    }
+
+
+def finish_run_metrics():
+    """ This function ends the current run and returns its report, a dictionary holding when the run started,
+        its duration, the total, count and longest span of every stage and every counter. The profile and memory
+        sections are only included if they were turned on in start_run_metrics(). """
+    with _metrics_lock:
+        profiler = _run_state['profiler']
+        trace_memory = _run_state['trace_memory']
+        _run_state['profiler'] = None
+        _run_state['trace_memory'] = False
+    if profiler is not None:
+        profiler.disable()
+    with _metrics_lock:
+        run_report = {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(_run_state['started_at'])),
+            'duration_seconds': time.perf_counter() - _run_state['start_time'],
+            'stages': {stage_name: dict(stage_totals) for stage_name, stage_totals in _run_state['stages'].items()},
+            'counters': dict(_run_state['counters'])
+        }
+    if profiler is not None:
+        run_report['profile'] = _create_profile_summary(profiler)
+    if trace_memory and tracemalloc.is_tracing():
+        run_report['memory'] = _create_memory_summary()
+    return run_report
+
+
+def _write_text_atomically(file_path, file_text):
+    """ This function writes text to a temporary file and then moves it over the file path,
+        so a scraper never reads a half written report. """
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as temp_file:
+        temp_file.write(file_text)
+    os.replace(temp_path, file_path)
+
+
+def _format_prometheus_metrics(run_report):
+    """ This function returns the stage times and counters of a run report in the Prometheus text format.
+        Counters named like rows_inserted.Europe_Meteorites become a region label on the rows_inserted metric. """
+    metric_lines = [f'meteorite_run_duration_seconds {run_report["duration_seconds"]}']
+    for stage_name, stage_totals in sorted(run_report['stages'].items()):
+        metric_lines.append(f'meteorite_stage_seconds_total{{stage="{stage_name}"}} {stage_totals["seconds"]}')
+        metric_lines.append(f'meteorite_stage_spans_total{{stage="{stage_name}"}} {stage_totals["count"]}')
+    for counter_name, amount in sorted(run_report['counters'].items()):
+        metric_name, _, region_name = counter_name.partition('.')
+        region_label = f'{{region="{region_name}"}}' if region_name else ''
+        metric_lines.append(f'meteorite_{metric_name}_total{region_label} {amount}')
+    if 'memory' in run_report:
+        metric_lines.append(f'meteorite_traced_memory_peak_bytes {run_report["memory"]["peak_bytes"]}')
+    return '\n'.join(metric_lines) + '\n'
+
+
+def write_run_report(run_report, file_path):
+    """ This function writes a run report to a file. A path ending in .prom is written in the Prometheus text format
+        (for the node exporter textfile collector), any other path as indented JSON. """
+    if file_path.endswith('.prom'):
+        _write_text_atomically(file_path, _format_prometheus_metrics(run_report))
+    else:
+        _write_text_atomically(file_path, json.dumps(run_report, indent=4))
@@ -0,0 +1,135 @@
+"""
+This module handles refreshing the region tables without making readers wait for, or see, a half loaded database.
+The new rows are ingested into a separate staging database file first, while the live database stays untouched and
+readable. The staging file is then attached to the live database and swapped in with one short WAL transaction that
+clears the region tables and summaries and copies the staged ones in, so a reader sees either every old row or every
+new row. The write lock of the live database is only held for that copy, not for the download and classification.
+"""
+from database_functions import connect_to_database, create_cursor_obj, create_all_region_tables, \
+    create_region_classifier, add_meteorites_to_tables_vectorized
+from run_metrics import stage_timer, increment_counter, take_counters, merge_counters
+import os
+import sqlite3
+import time
+
+# The summary tables of region_aggregates and their columns, copied along with the region tables.
+_SUMMARY_TABLE_COLUMNS = {
+    'region_summary': 'region_name, meteorite_count, mass_count, mass_sum',
+    'region_mass_histogram': 'region_name, bucket_index, meteorite_count',
+    'region_density_tiles': 'region_name, tile_lat, tile_long, meteorite_count'
+}
+
+
+def _get_staging_path(db_connection):
+    """ This function returns the path of the staging database, next to the file of the live database. """
+    for _, schema_name, file_path in db_connection.execute('''PRAGMA database_list'''):
+        if schema_name == 'main':
+            return f'{file_path}.staging'
+
+
+def _remove_staging_file(staging_path):
+    """ This function deletes the staging database and its rollback journal if they exist. """
+    for file_path in (staging_path, f'{staging_path}-journal'):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def _build_staging_database(staging_path, json_data_obj, region_classifier):
+    """ This function creates a new staging database and ingests the JSON data object into its region tables with
+        add_meteorites_to_tables_vectorized. It returns the number of rows staged.
+        The rows_inserted counters of the staging ingest are dropped, the swap counts the rows it copies into the
+        live tables instead. The other counters, such as records_seen and the HTTP counters, are kept. """
+    _remove_staging_file(staging_path)
+    run_counters = take_counters()
+    try:
+        return _ingest_staging_database(staging_path, json_data_obj, region_classifier)
+    finally:
+        staging_counters = take_counters()
+        merge_counters(run_counters)
+        merge_counters({counter_name: amount for counter_name, amount in staging_counters.items()
+                        if not counter_name.startswith('rows_inserted.')})
+
+
+def _ingest_staging_database(staging_path, json_data_obj, region_classifier):
+    """ This function does the ingest of _build_staging_database into a new staging file. """
+    # The staging file is thrown away if anything fails, so it doesn't need WAL or to survive a crash.
+    staging_connection = connect_to_database(staging_path, journal_mode=None)
+    staging_cursor_obj = create_cursor_obj(staging_connection)
+    try:
+        staging_connection.execute('PRAGMA synchronous = OFF')
+        create_all_region_tables(staging_cursor_obj, region_classifier.region_names)
+        # Keep the empty tables if the ingest is rolled back, so the staged rows can still be counted.
+        staging_connection.commit()
+        add_meteorites_to_tables_vectorized(staging_connection, staging_cursor_obj, json_data_obj,
+                                            region_classifier=region_classifier)
+        return staging_connection.execute('''SELECT COALESCE(SUM(meteorite_count), 0) FROM region_summary''') \
+            .fetchone()[0]
+    finally:
+        staging_connection.close()
+
+
+def _swap_in_staging_tables(db_connection, staging_path, region_names):
+    """ This function attaches the staging database and replaces the rows of the live region tables and their
+        summaries with the staged ones in one transaction. It returns the number of rows copied. """
+    db_connection.execute('''ATTACH DATABASE ? AS staging''', (staging_path,))
+    rows_swapped = 0
+    try:
+        # Commit anything still pending, then take the write lock up front so the swap can't fail halfway
+        # on a busy database.
+        if db_connection.in_transaction:
+            db_connection.commit()
+        db_connection.execute('BEGIN IMMEDIATE')
+        db_cursor_obj = db_connection.cursor()
+        # Creates any missing region or summary table and clears the rows and summaries of every region.
+        create_all_region_tables(db_cursor_obj, region_names)
+        for table_name in region_names:
+            swap_cursor = db_connection.execute(f'''INSERT INTO main.{table_name}(name, mass, reclat, reclong)
+                                                    SELECT name, mass, reclat, reclong FROM staging.{table_name}''')
+            rows_swapped += swap_cursor.rowcount
+            increment_counter(f'rows_inserted.{table_name}', swap_cursor.rowcount)
+        for summary_table, summary_columns in _SUMMARY_TABLE_COLUMNS.items():
+            db_connection.execute(f'''INSERT INTO main.{summary_table}({summary_columns})
+                                      SELECT {summary_columns} FROM staging.{summary_table}''')
+        with stage_timer('commit'):
+            db_connection.commit()
+    except BaseException:
+        if db_connection.in_transaction:
+            db_connection.rollback()
+        raise
+    finally:
+        # Databases can only be detached outside of a transaction.
+        db_connection.execute('''DETACH DATABASE staging''')
+    return rows_swapped
+
+
+def refresh_region_tables_staged(db_connection, json_data_obj, region_classifier=None):
+    """ This function replaces the contents of the region tables with the meteors of the JSON data object.
+        The meteors are first ingested into a staging database next to the live one (<database>.staging), then
+        swapped into the live region tables in one transaction, so readers never see a partly loaded table and
+        are only held up, if at all, for the length of the copy. If no rows were staged, because the ingest failed
+        or the data was empty, the live tables are left as they were. The staging file is always deleted.
+        The function prints and returns the number of rows swapped in per second of the whole refresh. """
+    if region_classifier is None:
+        region_classifier = create_region_classifier()
+    staging_path = _get_staging_path(db_connection)
+    start_time = time.perf_counter()
+    try:
+        rows_staged = _build_staging_database(staging_path, json_data_obj, region_classifier)
+        if rows_staged == 0:
+            print('No rows were staged, the live region tables were left unchanged.')
+            return 0.0
+        swap_start_time = time.perf_counter()
+        with stage_timer('staging_swap'):
+            rows_swapped = _swap_in_staging_tables(db_connection, staging_path, region_classifier.region_names)
+        swap_seconds = time.perf_counter() - swap_start_time
+    except sqlite3.Error as db_error:
+        # If any sqlite exceptions occur, print the error in a formatted message. The swap was rolled back.
+        print(f'A database error has occurred: {db_error}')
+        return 0.0
+    finally:
+        _remove_staging_file(staging_path)
+    elapsed_seconds = time.perf_counter() - start_time
+    rows_per_second = rows_swapped / elapsed_seconds if elapsed_seconds > 0 else 0.0
+    print(f'Staged refresh swapped in {rows_swapped} rows in {elapsed_seconds:.3f} seconds '
+          f'({rows_per_second:.0f} rows per second), holding the write lock for {swap_seconds:.3f} seconds.')
+    return rows_per_second
@@ -0,0 +1,63 @@
+"""
+Tests for the pipelined ingest against the local stub server of conftest.py, including a writer thread that fails
+before or while writing, which must never leave the other stages waiting on a full queue.
+Run with: python -m pytest -q
+"""
+import asyncio
+import sqlite3
+import threading
+import pytest
+import async_pipeline
+from conftest import create_stub_records
+
+
+def _run_pipeline_in_thread(stub_server):
+    """ This function runs the pipeline on its own thread, one record per page so the writer queue fills up, and
+        returns the thread and a dictionary holding the rows per second or the error raised. """
+    pipeline_result = {}
+
+    def run_pipeline():
+        try:
+            pipeline_result['rows_per_second'] = asyncio.run(async_pipeline.ingest_dataset_pipelined(
+                stub_server.url, page_size=1, fetch_concurrency=2, queue_size=1, backoff_base=0.001))
+        except BaseException as pipeline_error:
+            pipeline_result['error'] = pipeline_error
+
+    pipeline_thread = threading.Thread(target=run_pipeline, daemon=True)
+    pipeline_thread.start()
+    pipeline_thread.join(timeout=60)
+    return pipeline_thread, pipeline_result
+
+
+def test_pipeline_writes_every_page(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    stub_server.records = create_stub_records(12)
+    pipeline_thread, pipeline_result = _run_pipeline_in_thread(stub_server)
+    assert not pipeline_thread.is_alive()
+    assert 'error' not in pipeline_result
+    db_connection = sqlite3.connect('meteorite_db_all.db')
+    table_names = [row[0] for row in db_connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'region_%'")]
+    assert sum(db_connection.execute(f'SELECT COUNT(*) FROM {table_name}').fetchone()[0]
+               for table_name in table_names) > 0
+    db_connection.close()
+
+
+def test_writer_without_a_connection_does_not_hang(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(async_pipeline, 'connect_to_database', lambda: None)
+    pipeline_thread, pipeline_result = _run_pipeline_in_thread(stub_server)
+    assert not pipeline_thread.is_alive()
+    assert isinstance(pipeline_result.get('error'), AttributeError)
+
+
+def test_writer_database_error_does_not_hang(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def fail_to_create_tables(db_cursor_obj, region_names):
+        raise sqlite3.OperationalError('disk I/O error')
+
+    monkeypatch.setattr(async_pipeline, 'create_all_region_tables', fail_to_create_tables)
+    pipeline_thread, pipeline_result = _run_pipeline_in_thread(stub_server)
+    assert not pipeline_thread.is_alive()
+    assert pipeline_result == {'rows_per_second': 0.0}
@@ -0,0 +1,92 @@
+"""
+Tests for walking the dataset one page at a time with both fetchers, against the local stub server of conftest.py.
+Run with: python -m pytest -q
+"""
+import pytest
+from conftest import create_stub_records
+from dataset_fetcher import fetch_meteorite_records, fetch_meteorite_records_concurrently, PageDownloadError
+
+
+def _fetch_sequentially(dataset_url, page_size, **fetch_options):
+    return list(fetch_meteorite_records(dataset_url, page_size, backoff_base=0.001, **fetch_options))
+
+
+def _fetch_concurrently(dataset_url, page_size, **fetch_options):
+    return list(fetch_meteorite_records_concurrently(dataset_url, page_size, max_workers=3, backoff_base=0.001,
+                                                     **fetch_options))
+
+
+@pytest.mark.parametrize('fetch_records', [_fetch_sequentially, _fetch_concurrently])
+@pytest.mark.parametrize('record_count', [0, 1, 4, 5, 23, 25])
+def test_fetch_walks_every_page(stub_server, fetch_records, record_count):
+    stub_server.records = create_stub_records(record_count)
+    assert fetch_records(stub_server.url, 5) == stub_server.records
+
+
+def test_fetch_stops_after_the_short_page(stub_server):
+    assert _fetch_sequentially(stub_server.url, 5) == stub_server.records
+    # 23 records in pages of 5, the page at offset 20 only has 3 records so it is the last one requested.
+    assert stub_server.requested_offsets() == [0, 5, 10, 15, 20]
+
+
+def test_fetch_requests_one_empty_page_after_an_exact_multiple(stub_server):
+    stub_server.records = create_stub_records(20)
+    assert _fetch_sequentially(stub_server.url, 5) == stub_server.records
+    assert stub_server.requested_offsets() == [0, 5, 10, 15, 20]
+
+
+def test_fetch_raises_instead_of_stopping_early(stub_server):
+    stub_server.failures[10] = [500] * 3
+    record_iterator = fetch_meteorite_records(stub_server.url, 5, max_retries=2, backoff_base=0.001)
+    fetched_records = []
+    with pytest.raises(PageDownloadError) as download_error:
+        for record in record_iterator:
+            fetched_records.append(record)
+    assert fetched_records == stub_server.records[:10]
+    assert list(download_error.value.failed_pages) == [10]
+
+
+def test_fetch_rejects_an_invalid_page_size(stub_server):
+    with pytest.raises(ValueError):
+        _fetch_sequentially(stub_server.url, 0)
+
+
+@pytest.mark.parametrize('fetch_records', [_fetch_sequentially, _fetch_concurrently])
+def test_transient_errors_are_retried(stub_server, fetch_records):
+    stub_server.failures[5] = [503, 503]
+    stub_server.failures[15] = [429, 502, 504]
+    assert fetch_records(stub_server.url, 5, max_retries=3) == stub_server.records
+    assert stub_server.requested_offsets(503) == [5, 5]
+    assert stub_server.requested_offsets(200).count(15) == 1
+
+
+@pytest.mark.parametrize('fetch_records', [_fetch_sequentially, _fetch_concurrently])
+def test_transient_errors_give_up_after_max_retries(stub_server, fetch_records):
+    stub_server.failures[5] = [503] * 10
+    with pytest.raises(PageDownloadError) as download_error:
+        fetch_records(stub_server.url, 5, max_retries=2)
+    assert stub_server.requested_offsets().count(5) == 3
+    assert 'status code 503 (gave up after 3 attempts)' in download_error.value.failed_pages[5]
+
+
+@pytest.mark.parametrize('fetch_records', [_fetch_sequentially, _fetch_concurrently])
+def test_client_errors_are_not_retried(stub_server, fetch_records):
+    stub_server.failures[10] = [404]
+    with pytest.raises(PageDownloadError) as download_error:
+        fetch_records(stub_server.url, 5, max_retries=4)
+    assert stub_server.requested_offsets().count(10) == 1
+    assert list(download_error.value.failed_pages) == [10]
+    assert '404' in download_error.value.failed_pages[10]
+
+
+def test_every_failed_page_is_reported_together(stub_server):
+    stub_server.failures[0] = [503] * 10
+    stub_server.failures[5] = [404]
+    stub_server.failures[10] = [500] * 10
+    with pytest.raises(PageDownloadError) as download_error:
+        _fetch_concurrently(stub_server.url, 5, max_retries=1)
+    assert sorted(download_error.value.failed_pages) == [0, 5, 10]
+    error_message = str(download_error.value)
+    assert error_message.startswith('3 page(s) of the dataset could not be downloaded')
+    assert 'Page at offset 0: status code 503' in error_message
+    assert 'Page at offset 10: status code 500' in error_message
@@ -0,0 +1,105 @@
+"""
+Tests for decoding JSON arrays that arrive in chunks, as read_json_file and read_gzip_json_file read them, with every
+chunk size cutting the items, strings, escapes and numbers at a different place.
+Run with: python -m pytest -q
+"""
+import gzip
+import json
+import pytest
+import file_input_adapters
+from file_input_adapters import _parse_json_array, read_json_file, read_gzip_json_file
+
+CHUNK_SIZES = [1, 2, 3, 5, 7, 16, 64, 1024 * 1024]
+
+RECORDS = [
+    {'name': 'Aachen', 'id': '1', 'mass': '21', 'reclat': '50.775000', 'reclong': '6.083330',
+     'geolocation': {'type': 'Point', 'coordinates': [6.08333, 50.775]}},
+    {'name': 'Ørsted ☄ 𝔐', 'id': '2', 'note': 'quote " backslash \\ slash / tab \t newline \n', 'fell': True},
+    {'name': 'No coordinates', 'id': '3', 'mass': None, 'tags': [], 'extra': {}},
+]
+
+ITEM_TEXTS = [
+    '[-25000000000.0, 1.5e-300, 12, -0, 0.25, 1E+2, 6.02e23, 12345678901234567890, -7]',
+    '["a\\"b", "\\\\", "\\u00e9\\u2604", "\\ud835\\udd10", "\\/\\b\\f\\n\\r\\t", ""]',
+    '[true, false, null, [], {}, [[1, [2.5]], {"a": [null]}]]',
+    '  \r\n[ 1 ,\n\t2 , "three" ]  ',
+    '[]',
+    '[ ]',
+]
+
+
+def _split_bytes(text_bytes, chunk_size):
+    return [text_bytes[chunk_start:chunk_start + chunk_size] for chunk_start in range(0, len(text_bytes), chunk_size)]
+
+
+def _parse_text(json_text, chunk_size):
+    return list(_parse_json_array(_split_bytes(json_text.encode('utf-8'), chunk_size), 'test.json'))
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_record_arrays_round_trip(chunk_size):
+    for json_text in (json.dumps(RECORDS), json.dumps(RECORDS, indent=4, ensure_ascii=False),
+                      json.dumps(RECORDS, separators=(',', ':'))):
+        assert _parse_text(json_text, chunk_size) == RECORDS
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('json_text', ITEM_TEXTS)
+def test_items_cut_anywhere_round_trip(chunk_size, json_text):
+    parsed_items = _parse_text(json_text, chunk_size)
+    assert parsed_items == json.loads(json_text)
+    # The number types have to survive too, a cut off float must not come back as an int.
+    assert [type(item) for item in parsed_items] == [type(item) for item in json.loads(json_text)]
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_byte_order_mark_is_skipped(chunk_size):
+    json_bytes = b'\xef\xbb\xbf' + json.dumps(RECORDS).encode('utf-8')
+    assert list(_parse_json_array(_split_bytes(json_bytes, chunk_size), 'test.json')) == RECORDS
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('json_text', [
+    '[{"name": "Aachen"}, {"name": }]',
+    '[{"name": "Aachen"}, {"name" "Aachen"}]',
+    '[1, 2 3]',
+    '[1, 2,]',
+    '[1,, 2]',
+    '[1, tru, 3]',
+    '[1, 2.]',
+    '[1, 2e, 3]',
+    '[1, -, 3]',
+    '["a\\q"]',
+    '["\\u12x4"]',
+    '[1, "two"} ',
+])
+def test_malformed_items_report_their_offset(chunk_size, json_text):
+    with pytest.raises(json.JSONDecodeError) as expected_error:
+        json.loads(json_text)
+    with pytest.raises(ValueError, match=f'test.json has invalid JSON at character {expected_error.value.pos}:'):
+        _parse_text(json_text, chunk_size)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('json_text', ['', '   ', '[', '[1, 2', '[1, 2,', '[{"name": "Aachen"}, {"name"',
+                                       '["unterminated', '["cut in an escape \\', '[-25000000000.0'])
+def test_truncated_arrays_are_rejected(chunk_size, json_text):
+    with pytest.raises(ValueError):
+        _parse_text(json_text, chunk_size)
+
+
+@pytest.mark.parametrize('json_text', ['{"name": "Aachen"}', '"text"', '1'])
+def test_other_json_values_are_rejected(json_text):
+    with pytest.raises(ValueError, match='does not contain a JSON array'):
+        _parse_text(json_text, 3)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_json_and_gzip_files_are_read_in_chunks(tmp_path, monkeypatch, chunk_size):
+    monkeypatch.setattr(file_input_adapters, 'READ_CHUNK_SIZE', chunk_size)
+    json_path = tmp_path / 'records.json'
+    json_path.write_text(json.dumps(RECORDS, indent=2), encoding='utf-8')
+    gzip_path = tmp_path / 'records.json.gz'
+    gzip_path.write_bytes(gzip.compress(json_path.read_bytes()))
+    assert list(read_json_file(str(json_path))) == RECORDS
+    assert list(read_gzip_json_file(str(gzip_path))) == RECORDS
@@ -0,0 +1,87 @@
+"""
+Tests for splitting bounding boxes at the antimeridian, classifying coordinates with them, loading region
+definition files and searching the normalized schema with a bounding box.
+Run with: python -m pytest -q
+"""
+import json
+import sqlite3
+import pytest
+from region_classifier import RegionClassifier, split_bounding_box, load_region_definitions
+
+
+@pytest.mark.parametrize('box_values, expected_segments', [
+    ((10, 0, 20, 10), [(10, 0, 20, 10)]),
+    ((170, 0, 190, 10), [(170, 0, 180, 10), (-180, 0, -170, 10)]),
+    ((-190, 0, -170, 10), [(170, 0, 180, 10), (-180, 0, -170, 10)]),
+    ((170, 0, -170, 10), [(170, 0, 180, 10), (-180, 0, -170, 10)]),
+    # Boxes that lie entirely past one side of the 180th meridian are shifted, not split.
+    ((185, 0, 190, 10), [(-175, 0, -170, 10)]),
+    ((-200, 0, -190, 10), [(160, 0, 170, 10)]),
+    # Shifting can leave a box that still crosses the antimeridian.
+    ((190, 0, 185, 10), [(-170, 0, 180, 10), (-180, 0, -175, 10)]),
+])
+def test_split_bounding_box(box_values, expected_segments):
+    assert split_bounding_box(box_values) == expected_segments
+
+
+def test_classify_boxes_past_the_antimeridian():
+    region_classifier = RegionClassifier({'Far_East': (185, 0, 190, 10), 'Far_West': (-200, 0, -190, 10)})
+    assert region_classifier.classify(5, -172) == ['Far_East']
+    assert region_classifier.classify(5, 188) == ['Far_East']
+    assert region_classifier.classify(5, -178) == []
+    assert region_classifier.classify(5, 165) == ['Far_West']
+    assert region_classifier.classify(5, 175) == []
+
+
+def test_classify_box_crossing_the_antimeridian():
+    region_classifier = RegionClassifier({'Pacific': (170, -10, 190, 10), 'Other': (0, 0, 10, 10)})
+    assert region_classifier.classify(0, 180) == ['Pacific']
+    assert region_classifier.classify(0, -175) == ['Pacific']
+    assert region_classifier.classify(0, 185) == ['Pacific']
+    assert region_classifier.classify(0, -165) == []
+    assert region_classifier.classify(95, 175) == []
+
+
+def _write_region_file(tmp_path, region_data):
+    region_path = tmp_path / 'regions.json'
+    region_path.write_text(json.dumps(region_data), encoding='utf-8')
+    return str(region_path)
+
+
+def test_load_region_definitions(tmp_path):
+    region_path = _write_region_file(tmp_path, {'Far_East': [185, 0, 190, 10], 'Europe': [-10, 35, 40, 70]})
+    assert load_region_definitions(region_path) == {'Far_East': (185, 0, 190, 10), 'Europe': (-10, 35, 40, 70)}
+    assert RegionClassifier.from_region_file(region_path).classify(5, -172) == ['Far_East']
+
+
+@pytest.mark.parametrize('region_data', [
+    [[0, 0, 10, 10]],
+    {'Bad name': [0, 0, 10, 10]},
+    {'Short': [0, 0, 10]},
+    {'Text': [0, 0, '10', 10]},
+    {'Upside_Down': [0, 10, 10, 0]},
+    {'Too_Far_East': [350, 0, 370, 10]},
+    {'Too_Far_West': [-400, 0, -390, 10]},
+])
+def test_load_region_definitions_rejects_invalid_boxes(tmp_path, region_data):
+    with pytest.raises(ValueError):
+        load_region_definitions(_write_region_file(tmp_path, region_data))
+
+
+def test_search_bounding_box_past_the_antimeridian():
+    from normalized_schema import create_normalized_schema, add_meteorites_to_normalized_tables
+    from meteorite_queries import search_bounding_box
+    db_connection = sqlite3.connect(':memory:')
+    create_normalized_schema(db_connection.cursor())
+    add_meteorites_to_normalized_tables(db_connection, db_connection.cursor(), [
+        {'id': '1', 'name': 'East of the line', 'reclat': '5.0', 'reclong': '-172.0'},
+        {'id': '2', 'name': 'West of the line', 'reclat': '5.0', 'reclong': '175.0'},
+        {'id': '3', 'name': 'Near the line', 'reclat': '5.0', 'reclong': '-178.0'}])
+
+    def search_names(*box_values):
+        return sorted(row[2] for row in search_bounding_box(db_connection, *box_values))
+
+    assert search_names(185, 0, 190, 10) == ['East of the line']
+    assert search_names(-190, 0, -180, 10) == ['West of the line']
+    assert search_names(-200, 0, -190, 10) == []
+    assert search_names(170, 0, 190, 10) == ['East of the line', 'Near the line', 'West of the line']
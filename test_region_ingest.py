@@ -0,0 +1,221 @@
+"""
+Tests that every way of filling the region tables stores the same rows and region summaries: the scalar, bulk and
+vectorized ingests, and an incremental refresh compared with a full reload of the same data.
+Run with: python -m pytest -q
+"""
+import sqlite3
+import warnings
+import pytest
+import database_functions
+from database_functions import create_all_region_tables, create_region_classifier, add_meteorites_to_tables, \
+    add_meteorites_to_tables_bulk, add_meteorites_to_tables_vectorized, refresh_region_tables_incrementally
+from vectorized_classification import NUMPY_AVAILABLE
+from run_metrics import start_run_metrics, finish_run_metrics
+
+REGION_NAMES = create_region_classifier().region_names
+
+# Records around the edges of the classification: Upper Asia crosses the antimeridian (its box ends at 190.4),
+# longitudes outside of -180 to 180 are wrapped, and missing, unparseable, NaN, infinite and out of range
+# coordinates are skipped. Some records fall in more than one region.
+EDGE_CASE_RECORDS = [
+    {'id': '1', 'name': 'Antimeridian east', 'mass': '120', 'reclat': '50.0', 'reclong': '179.9'},
+    {'id': '2', 'name': 'Antimeridian west', 'mass': '5.5', 'reclat': '50.0', 'reclong': '-175.0'},
+    {'id': '3', 'name': 'Wrapped past 180', 'mass': '8000', 'reclat': '50.0', 'reclong': '185.0'},
+    {'id': '4', 'name': 'Wrapped past -180', 'mass': '0.3', 'reclat': '40.0', 'reclong': '-290.0'},
+    {'id': '5', 'name': 'Past the Upper Asia edge', 'mass': '17', 'reclat': '50.0', 'reclong': '-169.0'},
+    {'id': '6', 'name': 'Europe and Africa', 'mass': '1000000', 'reclat': '36.5', 'reclong': '10.0'},
+    {'id': '7', 'name': 'Asia overlap', 'mass': '44', 'reclat': '37.0', 'reclong': '100.0'},
+    {'id': '8', 'name': 'Integer coordinates', 'mass': '2', 'reclat': '-25', 'reclong': '135'},
+    {'id': '9', 'name': 'Unparseable latitude', 'mass': '3', 'reclat': 'north', 'reclong': '10.0'},
+    {'id': '10', 'name': 'Unparseable longitude', 'mass': '3', 'reclat': '50.0', 'reclong': '10,5'},
+    {'id': '11', 'name': 'NaN coordinate', 'mass': '3', 'reclat': 'nan', 'reclong': '10.0'},
+    {'id': '12', 'name': 'Infinite longitude', 'mass': '3', 'reclat': '50.0', 'reclong': 'inf'},
+    {'id': '13', 'name': 'Latitude out of range', 'mass': '3', 'reclat': '95.0', 'reclong': '10.0'},
+    {'id': '14', 'name': 'Missing latitude', 'mass': '3', 'reclong': '10.0'},
+    {'id': '15', 'name': 'Null longitude', 'mass': '3', 'reclat': '50.0', 'reclong': None},
+    {'id': '16', 'name': 'Missing mass', 'reclat': '-20.0', 'reclong': '-60.0'},
+    {'id': '17', 'name': 'Unparseable mass', 'mass': 'heavy', 'reclat': '40.0', 'reclong': '-100.0'},
+    {'id': '18', 'name': 'No region', 'mass': '9', 'reclat': '-80.0', 'reclong': '0.0'},
+]
+
+
+def _create_records(record_count):
+    """ This function returns the edge case records followed by record_count records spread over the globe. """
+    records = [dict(record) for record in EDGE_CASE_RECORDS]
+    for record_index in range(record_count):
+        records.append({'id': str(100 + record_index),
+                        'name': f'Meteorite {record_index}',
+                        'mass': str(round((record_index * 7919) % 100000 / 7, 2)),
+                        'reclat': str(round((record_index * 37) % 180 - 90 + 0.25, 4)),
+                        'reclong': str(round((record_index * 53) % 400 - 200 + 0.5, 4))})
+    return records
+
+
+def _create_database():
+    """ This function returns a connection to a new in-memory database holding the empty region tables. """
+    db_connection = sqlite3.connect(':memory:')
+    create_all_region_tables(db_connection.cursor())
+    db_connection.commit()
+    return db_connection
+
+
+def _read_region_tables(db_connection, keep_order=True):
+    """ This function returns the rows of every region table, in insertion order or sorted. """
+    region_tables = {}
+    for table_name in REGION_NAMES:
+        rows = db_connection.execute(f'''SELECT name, mass, reclat, reclong FROM {table_name}
+                                         ORDER BY rowid''').fetchall()
+        region_tables[table_name] = rows if keep_order else sorted(rows, key=repr)
+    return region_tables
+
+
+def _read_region_summaries(db_connection):
+    """ This function returns the rows of the three summary tables, with the mass sums rounded so sums added up
+        in a different order still compare equal. """
+    return {
+        'region_summary': [(region_name, meteorite_count, mass_count, round(mass_sum, 6))
+                           for region_name, meteorite_count, mass_count, mass_sum in db_connection.execute(
+                               '''SELECT * FROM region_summary ORDER BY region_name''')],
+        'region_mass_histogram': db_connection.execute(
+            '''SELECT * FROM region_mass_histogram ORDER BY region_name, bucket_index''').fetchall(),
+        'region_density_tiles': db_connection.execute(
+            '''SELECT * FROM region_density_tiles ORDER BY region_name, tile_lat, tile_long''').fetchall()
+    }
+
+
+def _recompute_region_summaries(db_connection):
+    """ This function rebuilds the summaries from the rows of the region tables, in a separate database. """
+    summary_connection = _create_database()
+    region_aggregates_delta = database_functions.AggregateDelta()
+    for table_name, rows in _read_region_tables(db_connection).items():
+        region_aggregates_delta.add_rows(table_name, rows)
+    region_aggregates_delta.apply(summary_connection.cursor())
+    return _read_region_summaries(summary_connection)
+
+
+def _ingest_scalar(db_connection, records):
+    add_meteorites_to_tables(db_connection.cursor(), records)
+    db_connection.commit()
+
+
+def _ingest_bulk(db_connection, records):
+    add_meteorites_to_tables_bulk(db_connection, db_connection.cursor(), records, batch_size=7)
+
+
+def _ingest_vectorized(db_connection, records):
+    add_meteorites_to_tables_vectorized(db_connection, db_connection.cursor(), records, batch_size=50)
+
+
+@pytest.fixture(scope='module')
+def scalar_database():
+    db_connection = _create_database()
+    _ingest_scalar(db_connection, _create_records(500))
+    return db_connection
+
+
+def test_edge_cases_are_classified(scalar_database):
+    region_tables = _read_region_tables(scalar_database)
+    stored_names = {row[0] for rows in region_tables.values() for row in rows}
+    upper_asia_names = {row[0] for row in region_tables['Upper_Asia_Meteorites']}
+    assert {'Antimeridian east', 'Antimeridian west', 'Wrapped past 180', 'Wrapped past -180'} <= upper_asia_names
+    assert 'Past the Upper Asia edge' not in upper_asia_names
+    assert 'Europe and Africa' in {row[0] for row in region_tables['Europe_Meteorites']}
+    assert 'Europe and Africa' in {row[0] for row in region_tables['Africa_MiddleEast_Meteorites']}
+    for skipped_name in ('Unparseable latitude', 'Unparseable longitude', 'NaN coordinate', 'Infinite longitude',
+                         'Latitude out of range', 'Missing latitude', 'Null longitude', 'No region'):
+        assert skipped_name not in stored_names
+
+
+@pytest.mark.parametrize('ingest_function', [_ingest_bulk, _ingest_vectorized])
+def test_ingest_paths_match_scalar_ingest(scalar_database, ingest_function):
+    db_connection = _create_database()
+    ingest_function(db_connection, _create_records(500))
+    assert _read_region_tables(db_connection) == _read_region_tables(scalar_database)
+    assert _read_region_summaries(db_connection) == _read_region_summaries(scalar_database)
+
+
+def test_vectorized_ingest_without_numpy_matches_scalar_ingest(scalar_database, monkeypatch):
+    monkeypatch.setattr(database_functions, 'NUMPY_AVAILABLE', False)
+    db_connection = _create_database()
+    _ingest_vectorized(db_connection, _create_records(500))
+    assert _read_region_tables(db_connection) == _read_region_tables(scalar_database)
+
+
+@pytest.mark.skipif(not NUMPY_AVAILABLE, reason='NumPy is not installed')
+def test_infinite_longitude_does_not_warn():
+    from vectorized_classification import convert_coordinate_values
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        lat_array, long_array = convert_coordinate_values(['50.0', '50.0'], ['inf', '-inf'])
+    assert all(value != value for value in long_array)
+
+
+def _ingest_normalized(db_connection, records):
+    from normalized_schema import create_normalized_schema, add_meteorites_to_normalized_tables
+    create_normalized_schema(db_connection.cursor())
+    add_meteorites_to_normalized_tables(db_connection, db_connection.cursor(), records)
+
+
+def _ingest_without_numpy(db_connection, records):
+    original_numpy_available = database_functions.NUMPY_AVAILABLE
+    database_functions.NUMPY_AVAILABLE = False
+    try:
+        _ingest_vectorized(db_connection, records)
+    finally:
+        database_functions.NUMPY_AVAILABLE = original_numpy_available
+
+
+def _count_ingest(ingest_function):
+    """ This function returns the run counters of ingesting the test records with an ingest function. """
+    start_run_metrics()
+    ingest_function(_create_database(), _create_records(500))
+    return finish_run_metrics()['counters']
+
+
+@pytest.mark.parametrize('ingest_function', [_ingest_bulk, _ingest_vectorized, _ingest_without_numpy,
+                                             _ingest_normalized])
+def test_ingest_paths_count_the_same_records(ingest_function):
+    scalar_counters = _count_ingest(_ingest_scalar)
+    assert scalar_counters['records_skipped_missing_coordinates'] == 2
+    # NaN, infinite and out of range latitudes count as unparseable on every path.
+    assert scalar_counters['records_skipped_unparseable_coordinates'] == 5
+    assert _count_ingest(ingest_function) == scalar_counters
+
+
+def test_summaries_match_the_stored_rows(scalar_database):
+    assert _read_region_summaries(scalar_database) == _recompute_region_summaries(scalar_database)
+
+
+def test_incremental_refresh_matches_full_reload():
+    old_records = _create_records(300)
+    new_records = _create_records(400)
+    # Change the mass of some records, move others to another region and remove a few.
+    for record in new_records[20:60]:
+        record['mass'] = str(float(record['mass']) + 1)
+    for record in new_records[60:80]:
+        record['reclat'], record['reclong'] = '-25.0', '135.0'
+    del new_records[100:130]
+    refreshed_connection = _create_database()
+    _ingest_vectorized(refreshed_connection, old_records)
+    refresh_region_tables_incrementally(refreshed_connection, refreshed_connection.cursor(), old_records)
+    refresh_region_tables_incrementally(refreshed_connection, refreshed_connection.cursor(), new_records)
+    reloaded_connection = _create_database()
+    _ingest_vectorized(reloaded_connection, new_records)
+    assert _read_region_tables(refreshed_connection, keep_order=False) == \
+        _read_region_tables(reloaded_connection, keep_order=False)
+    assert _read_region_summaries(refreshed_connection) == _read_region_summaries(reloaded_connection)
+
+
+def test_incremental_refresh_after_normalized_schema_matches_full_reload():
+    from normalized_schema import create_normalized_schema, add_meteorites_to_normalized_tables
+    records = _create_records(300)
+    switched_connection = _create_database()
+    create_normalized_schema(switched_connection.cursor())
+    add_meteorites_to_normalized_tables(switched_connection, switched_connection.cursor(), records)
+    # The views of the normalized schema are replaced by empty region tables, whose summaries must start empty too.
+    refresh_region_tables_incrementally(switched_connection, switched_connection.cursor(), records)
+    reloaded_connection = _create_database()
+    _ingest_vectorized(reloaded_connection, records)
+    assert _read_region_tables(switched_connection, keep_order=False) == \
+        _read_region_tables(reloaded_connection, keep_order=False)
+    assert _read_region_summaries(switched_connection) == _read_region_summaries(reloaded_connection)
@@ -0,0 +1,103 @@
+"""
+Tests for the on-disk response cache: conditional GETs answered with 304, offline mode and eviction by age and size,
+against the local stub server of conftest.py.
+Run with: python -m pytest -q
+"""
+import os
+import time
+import pytest
+from database_functions import issue_get_request
+from dataset_fetcher import fetch_meteorite_records, fetch_meteorite_records_concurrently, PageDownloadError
+from response_cache import ResponseCache
+
+
+def _fetch_records(stub_server, response_cache):
+    return list(fetch_meteorite_records(stub_server.url, 5, backoff_base=0.001, response_cache=response_cache))
+
+
+def _list_body_files(cache_dir):
+    return sorted(file_name for file_name in os.listdir(cache_dir) if file_name.endswith('.body.gz'))
+
+
+def test_unchanged_pages_are_served_from_the_cache(stub_server, tmp_path):
+    response_cache = ResponseCache(str(tmp_path))
+    assert _fetch_records(stub_server, response_cache) == stub_server.records
+    assert len(_list_body_files(tmp_path)) == 5
+    first_run_count = len(stub_server.requests)
+    assert _fetch_records(stub_server, response_cache) == stub_server.records
+    second_run_requests = stub_server.requests[first_run_count:]
+    assert {status_code for _, status_code, _ in second_run_requests} == {304}
+    for _, _, request_headers in second_run_requests:
+        assert request_headers['If-Modified-Since'] == stub_server.LAST_MODIFIED
+
+
+def test_changed_pages_are_downloaded_again(stub_server, tmp_path):
+    response_cache = ResponseCache(str(tmp_path))
+    _fetch_records(stub_server, response_cache)
+    stub_server.version = 2
+    stub_server.records[0]['name'] = 'Renamed'
+    first_run_count = len(stub_server.requests)
+    assert _fetch_records(stub_server, response_cache)[0]['name'] == 'Renamed'
+    assert {status_code for _, status_code, _ in stub_server.requests[first_run_count:]} == {200}
+
+
+def test_issue_get_request_serves_the_cached_body_on_304(stub_server, tmp_path):
+    response_cache = ResponseCache(str(tmp_path))
+    page_params = {'$limit': 5, '$offset': 0}
+    first_response = issue_get_request(stub_server.url, page_params, response_cache=response_cache)
+    second_response = issue_get_request(stub_server.url, page_params, response_cache=response_cache)
+    assert stub_server.requested_offsets() == [0, 0]
+    assert stub_server.requests[1][1] == 304
+    assert second_response.status_code == 200
+    assert second_response.json() == first_response.json() == stub_server.records[:5]
+
+
+def test_offline_mode_serves_cached_pages_without_the_network(stub_server, tmp_path):
+    _fetch_records(stub_server, ResponseCache(str(tmp_path)))
+    request_count = len(stub_server.requests)
+    offline_cache = ResponseCache(str(tmp_path), offline=True)
+    assert _fetch_records(stub_server, offline_cache) == stub_server.records
+    # The concurrent fetcher also asks for pages past the end, which aren't cached. Those misses are ignored.
+    assert list(fetch_meteorite_records_concurrently(stub_server.url, 5, max_workers=3,
+                                                     response_cache=offline_cache)) == stub_server.records
+    assert issue_get_request(stub_server.url, {'$limit': 5, '$offset': 5, '$order': ':id'},
+                             response_cache=offline_cache).json() == stub_server.records[5:10]
+    assert len(stub_server.requests) == request_count
+
+
+def test_offline_mode_fails_on_a_page_missing_from_the_cache(stub_server, tmp_path):
+    offline_cache = ResponseCache(str(tmp_path), offline=True)
+    with pytest.raises(PageDownloadError) as download_error:
+        _fetch_records(stub_server, offline_cache)
+    assert 'not cached' in download_error.value.failed_pages[0]
+    assert issue_get_request(stub_server.url, {'$limit': 5, '$offset': 0}, response_cache=offline_cache) is None
+    assert stub_server.requests == []
+
+
+def _age_cache_entries(cache_dir, seconds_by_file):
+    """ This function sets when each cache entry was last used to the specified number of seconds ago. """
+    current_time = time.time()
+    for file_name, age_seconds in seconds_by_file.items():
+        os.utime(os.path.join(cache_dir, file_name), (current_time - age_seconds, current_time - age_seconds))
+
+
+def test_entries_unused_for_max_entry_age_are_evicted(stub_server, tmp_path):
+    response_cache = ResponseCache(str(tmp_path), max_entry_age=60)
+    _fetch_records(stub_server, response_cache)
+    body_files = _list_body_files(tmp_path)
+    _age_cache_entries(tmp_path, {body_files[0]: 3600, body_files[1]: 120, body_files[2]: 30})
+    assert response_cache.evict_stale_entries() == 2
+    assert _list_body_files(tmp_path) == body_files[2:]
+    assert len([file_name for file_name in os.listdir(tmp_path) if file_name.endswith('.meta.json')]) == 3
+
+
+def test_least_recently_used_entries_are_evicted_over_max_cache_bytes(stub_server, tmp_path):
+    response_cache = ResponseCache(str(tmp_path))
+    _fetch_records(stub_server, response_cache)
+    body_files = _list_body_files(tmp_path)
+    _age_cache_entries(tmp_path, {file_name: 50 - file_index for file_index, file_name in enumerate(body_files)})
+    # Keep room for only the two most recently used entries.
+    response_cache.max_cache_bytes = sum(os.path.getsize(os.path.join(tmp_path, file_name))
+                                         for file_name in body_files[-2:])
+    assert response_cache.evict_stale_entries() == 3
+    assert _list_body_files(tmp_path) == body_files[-2:]
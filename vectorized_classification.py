@@ -0,0 +1,81 @@
+"""
+This module handles classifying a whole batch of meteors into regions at once using NumPy.
+The reclat and reclong values of the batch are converted into float arrays in one pass and compared
+against every bounding box together, instead of one meteor at a time.
+NumPy is optional, NUMPY_AVAILABLE is False when it isn't installed and the scalar path should be used instead.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUMPY_AVAILABLE = numpy is not None
+
+
+def _convert_column(column_values):
+    """ This function converts a list of coordinate values to a float64 array. Values that are
+        missing or can't be converted to a number become NaN, so they never fall inside a bounding box. """
+    try:
+        # NumPy converts each value the same way float() does and turns None into NaN.
+        return numpy.array(column_values, dtype=numpy.float64)
+    except (TypeError, ValueError):
+        # At least one value isn't a number, so convert the values one at a time.
+        converted_values = numpy.empty(len(column_values), dtype=numpy.float64)
+        for value_index, value in enumerate(column_values):
+            try:
+                converted_values[value_index] = float(value)
+            except (TypeError, ValueError, OverflowError):
+                converted_values[value_index] = numpy.nan
+        return converted_values
+
+
+def convert_coordinate_columns(records):
+    """ This function converts the reclat and reclong values of a list of records into two float64 arrays
+        and returns them as a (lat array, long array) tuple, see convert_coordinate_values. """
+    return convert_coordinate_values([record.get('reclat', None) for record in records],
+                                     [record.get('reclong', None) for record in records])
+
+
+def convert_coordinate_values(lat_values, long_values):
+    """ This function converts a list of reclat values and a list of reclong values into two float64 arrays
+        and returns them as a (lat array, long array) tuple. Missing, unparseable or out of range values become NaN.
+        Longitudes outside of -180 to 180 are wrapped into that range, the same as the region classifier does. """
+    lat_array = _convert_column(lat_values)
+    long_array = _convert_column(long_values)
+    # A latitude outside of -90 to 90 isn't a real coordinate, so it can't be in any region.
+    lat_array[(lat_array < -90) | (lat_array > 90)] = numpy.nan
+    # An infinite longitude can't be wrapped into range, so it can't be in any region either.
+    long_array[numpy.isinf(long_array)] = numpy.nan
+    out_of_range = (long_array < -180) | (long_array > 180)
+    if out_of_range.any():
+        long_array[out_of_range] = ((long_array[out_of_range] + 180) % 360) - 180
+    return lat_array, long_array
+
+
+def compute_membership_matrix(lat_array, long_array, region_classifier):
+    """ This function compares every coordinate against every bounding box of the region classifier at once.
+        It returns a boolean matrix with one row per coordinate and one column per region, in the order of
+        region_classifier.region_names. A cell is True when the coordinate falls inside that region. """
+    segments = numpy.array([segment[1:] for segment in region_classifier.region_segments], dtype=numpy.float64)
+    segment_regions = numpy.array([segment[0] for segment in region_classifier.region_segments], dtype=numpy.intp)
+    # Compare each coordinate against every segment of every bounding box. NaN comparisons are always False.
+    long_column = long_array[:, numpy.newaxis]
+    lat_column = lat_array[:, numpy.newaxis]
+    segment_matrix = (segments[:, 0] <= long_column) & (long_column <= segments[:, 2]) & \
+                     (segments[:, 1] <= lat_column) & (lat_column <= segments[:, 3])
+    # Combine the segments of each region, a region split at the antimeridian has two segments.
+    membership_matrix = numpy.zeros((len(lat_array), len(region_classifier.region_names)), dtype=bool)
+    for segment_index, region_index in enumerate(segment_regions):
+        membership_matrix[:, region_index] |= segment_matrix[:, segment_index]
+    return membership_matrix
+
+
+def count_unusable_coordinates(lat_array, long_array):
+    """ This function returns how many coordinates from convert_coordinate_columns are NaN,
+        meaning the value was missing, couldn't be converted to a number or the latitude was out of range. """
+    return int(numpy.count_nonzero(numpy.isnan(lat_array) | numpy.isnan(long_array)))
+
+
+def count_multi_region_hits(membership_matrix):
+    """ This function returns how many coordinates of a membership matrix fall in more than one region. """
+    return int(numpy.count_nonzero(membership_matrix.sum(axis=1) > 1))